@@ -52,6 +52,10 @@ class Livedronemap:
             except Exception as e:
                 return e
 
+    def ldm_upload_status(self, job_id):
+        r = requests.get(self.url + 'ldm_upload/' + self.current_project_id + '/status/' + job_id)
+        return r.json()
+
 
 if __name__ == '__main__':
     livedronemap = Livedronemap('http://127.0.0.1:5000/')
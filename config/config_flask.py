@@ -11,3 +11,58 @@ class BaseConfig(object, metaclass=ABCMeta):
     MAGO3D_CONFIG = json.load(open('config/config_mago3d.json', 'r'))
     SIMULATION_ID = None
     CALIBRATION = True
+
+    # Ingest queue of ldm_upload
+    INGEST_QUEUE_SIZE = 16      # The maximum number of images waiting for processing
+    INGEST_NUM_WORKERS = 2      # The number of images processed at the same time
+    INGEST_QUEUE_TIMEOUT = 0    # Seconds to block an upload while the queue is full - 0: reject at once
+    INGEST_IN_MEMORY = True     # Process uploads from memory and save them on the background - False: save, then read
+    DISK_WRITER_MAX_BYTES = 256 * 1024 * 1024   # Bytes of uploads waiting to be saved, over which uploads block
+    MAX_CONTENT_LENGTH = 64 * 1024 * 1024       # Bytes of a request, as uploads are read into memory
+
+    # Connections to the inference server and InnoMapViewer
+    PEER_CONNECTION = {
+        'timeout': 10,      # s, of connecting, sending and receiving
+        'retries': 5,       # Attempts to connect for a request
+        'backoff': 0.5,     # s, doubles for each attempt
+        'max_backoff': 8    # s
+    }
+    INFERENCE_TIMEOUT = 30  # s, to wait for bboxes of an image
+    INFERENCE_FORMATS = ['original', 'jpeg', 'png']   # In order of preference - original / raw / jpeg / png
+    INFERENCE_JPEG_QUALITY = 90
+
+    # Orthophotos for InnoMapViewer
+    VIEWER_OUTPUT = 'orthophoto'    # orthophoto / tiles(XYZ tiles in EPSG:3857, optical only) / mosaic(dirty tiles)
+    TILE_MIN_ZOOM = 16
+    TILE_MAX_ZOOM = 23  # Clamped to the native zoom level of each orthophoto
+    TILE_FORMAT = 'png'     # png / webp(lossless)
+    # Live mosaic of a project, whose tiles from MOSAIC_ZOOM to TILE_MIN_ZOOM are in TILE_FORMAT
+    MOSAIC_ZOOM = 21
+    MOSAIC_BLENDING = 'nadir'   # last / nadir(closest to the nadir) / feather
+    MOSAIC_FEATHER_WIDTH = 32   # px
+    MOSAIC_MAX_TILES = 512  # Tiles in memory per project, the others are spilled to disk
+    TILE_STORE_COMPACT_RATIO = 2    # Compacted when its data file is this times the current tiles, None: never
+    # /tiles/<project>/<z>/<x>/<y>.<format>, from the tile stores of projects
+    TILE_CACHE_BYTES = 256 * 1024 * 1024  # LRU of hot tiles, shared by projects
+    TILE_CACHE_MAX_AGE = 5  # s, a tile of the live mosaic may change at any time
+    VIEWER_FORMAT = 'png'   # png / webp(lossless) / jpeg+mask / raw
+    VIEWER_PNG_LEVEL = None     # 0 - 9, None: the default of OpenCV
+    VIEWER_JPEG_QUALITY = 90
+
+    # Orthophoto generation
+    RECTIFY_METHOD = 'homography'   # homography / fused / three_stage
+    RECTIFY_NUM_THREADS = None  # None: all cores, 1: single-threaded
+    RECTIFY_RESAMPLING = 'nearest'  # nearest / bilinear / bicubic
+    RECTIFY_DEM = None  # A path of a GeoTIFF DEM in the EPSG of EOs, None: a flat ground of ground_height
+    RECTIFY_DEM_STEP = 8    # px, pixels of blocks of the orthophoto are interpolated between their centers over the DEM
+    # GSD of an orthophoto is coarsened to fit in both, so that an oblique or a high frame does not exhaust memory
+    RECTIFY_MAX_PIXELS = 40000000   # px of an orthophoto and of its blocks at MOSAIC_ZOOM, None: unlimited
+    RECTIFY_MAX_BYTES = 1024 * 1024 * 1024  # bytes of an orthophoto and the arrays of its size, None: unlimited
+
+    # Resolution against latency, which a project overrides with settings of POST /project or /project/<id>/settings
+    RECTIFY_GSD = 'auto'    # m/px of orthophotos - auto: GSD of each image
+    RECTIFY_DECODE_SCALE = 1    # 1 / 2 / 4 / 8, images are decoded at 1/scale for orthophotos by scaling of JPEG
+    INFERENCE_DECODE_SCALE = 1  # 1 / 2 / 4 / 8, images are decoded at 1/scale for the detector
+
+    # Georeferencing of detected objects
+    GEOREFERENCE_MESH = None   # A path of an OBJ of the terrain in the EPSG of EOs, None: a flat ground of ground_height
@@ -0,0 +1,81 @@
+import os
+import threading
+from collections import deque
+
+
+class DiskWriter:
+    """
+    Write files on a background thread, so that latency of the disk, e.g. a NAS, is off the critical path
+    A file is written to a temporary file and renamed, so it is either complete or absent on the disk
+    Bytes waiting to be written are bounded, and write blocks while the bound is reached
+    """
+    def __init__(self, max_bytes, name='disk-writer'):
+        """
+        :param max_bytes: The maximum bytes waiting to be written - a file larger than it waits for an empty queue
+        """
+        self.max_bytes = max_bytes
+
+        self.condition = threading.Condition()
+        self.files = deque()    # (path, data)
+        self.pending_bytes = 0
+        self.num_written = 0
+        self.num_failed = 0
+        self.max_pending_bytes = 0
+
+        self.thread = threading.Thread(target=self._work, name=name, daemon=True)
+        self.thread.start()
+
+    def write(self, path, data):
+        """
+        Enqueue a file to write, whose directory is made if it does not exist
+        :param data: Bytes of the file, which must not be modified until it is written
+        """
+        with self.condition:
+            while self.files and self.pending_bytes + len(data) > self.max_bytes:
+                self.condition.wait()
+            self.files.append((path, data))
+            self.pending_bytes += len(data)
+            self.max_pending_bytes = max(self.max_pending_bytes, self.pending_bytes)
+            self.condition.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Wait until all files enqueued so far are written
+        :return: True if they are written, False on timeout
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.files, timeout)
+
+    def metrics(self):
+        with self.condition:
+            return {
+                'pending_files': len(self.files),
+                'pending_bytes': self.pending_bytes,
+                'max_pending_bytes': self.max_pending_bytes,
+                'num_written': self.num_written,
+                'num_failed': self.num_failed
+            }
+
+    def _work(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.files)
+                path, data = self.files[0]
+
+            try:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(path + '.tmp', path)
+                failed = False
+            except OSError as e:
+                print(' * Failed to write %s: %s' % (path, e))
+                failed = True
+
+            with self.condition:
+                # The file leaves the queue after it is written, so join waits for it
+                self.files.popleft()
+                self.pending_bytes -= len(data)
+                self.num_failed += failed
+                self.num_written += not failed
+                self.condition.notify_all()
@@ -0,0 +1,44 @@
+import cv2
+import numpy as np
+
+DECODE_SCALES = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def decode_image(img_bytes, scales):
+    """
+    Decode an image as it is, without the rotation for display by its orientation, at 1/scale for each of scales
+    The largest one is decoded by scaling of JPEG, which skips coefficients of DCT, and the others are resized from it
+    :param img_bytes: Bytes of an image file
+    :param scales: Scales to decode at - 1, 2, 4 or 8
+    :return: A dict of scale -> the image, of ceil(rows / scale) x ceil(cols / scale)
+    """
+    smallest = min(scales)
+    image = cv2.imdecode(np.frombuffer(img_bytes, dtype=np.uint8),
+                         DECODE_SCALES[smallest] | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        raise ValueError('Failed to decode the image')
+
+    images = {smallest: image}
+    for scale in scales:
+        if scale not in images:
+            size = (-(-image.shape[1] * smallest // scale), -(-image.shape[0] * smallest // scale))
+            images[scale] = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return images
+
+
+def scale_bboxes(bboxes, from_shape, to_shape):
+    """
+    Scale boundary boxes on an image to another resolution of the image, e.g. from the decoded one for the detector
+    :param bboxes: Boundary boxes - [x1, y1, x2, y2, object type, ...] | list
+    :param from_shape: The shape of the image of bboxes
+    :param to_shape: The shape of the image to scale to
+    :return: Boundary boxes on the image of to_shape, whose values after x1, y1, x2, y2 are kept | list
+    """
+    if from_shape[0:2] == to_shape[0:2]:
+        return bboxes
+    # Edges of pixels are scaled, as the reduced image is averaged over blocks of pixels
+    scale_x = to_shape[1] / from_shape[1]
+    scale_y = to_shape[0] / from_shape[0]
+    return [[bbox[0] * scale_x, bbox[1] * scale_y, bbox[2] * scale_x, bbox[3] * scale_y] + list(bbox[4:])
+            for bbox in bboxes]
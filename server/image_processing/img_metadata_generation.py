@@ -52,7 +52,7 @@ def create_img_metadata_udp(uuid, task_id, path, name, img_type, tm_eo, img_boun
     return img_metadata
 
 
-def create_img_metadata_tcp(uuid, task_id, name, img_type, img_boundary, objects):
+def create_img_metadata_tcp(uuid, task_id, name, img_type, img_boundary, objects, img_encoding=None, img_gsd=None):
     """
     Create a metadata of an orthophoto for tcp transmission
     :param uuid: uuid of the image | string
@@ -61,6 +61,8 @@ def create_img_metadata_tcp(uuid, task_id, name, img_type, img_boundary, objects
     :param img_type: A type of the image - optical(0)/thermal(1) | int
     :param img_boundary: Boundary of the orthophoto | string in wkt
     :param objects: JSON object? array? of the detected object ... from create_obj_metadata
+    :param img_encoding: How the orthophoto is encoded, None for png ... from encode_orthophoto
+    :param img_gsd: GSD of the orthophoto in m/px, None for not reported
     :return: JSON object of the orthophoto ... python dictionary
     """
     img_metadata = {
@@ -71,6 +73,10 @@ def create_img_metadata_tcp(uuid, task_id, name, img_type, img_boundary, objects
         "img_boundary": img_boundary,  # WKT ... string
         "objects": objects
     }
+    if img_encoding is not None:
+        img_metadata["img_encoding"] = img_encoding  # dictionary
+    if img_gsd is not None:
+        img_metadata["img_gsd"] = float(img_gsd)  # m/px
 
     return img_metadata
 
@@ -97,3 +103,14 @@ def create_obj_metadata(object_type, boundary_image, boundary_world):
     # print("obj_metadata: " ,obj_metadata)
 
     return obj_metadata
+
+
+def create_objs_metadata(bboxes, boundaries_world):
+    """
+    Create metadata of all detected objects of an image
+    :param bboxes: Boundary boxes from the inference server - [x1, y1, x2, y2, object type] | list
+    :param boundaries_world: Boundaries of the objects in GCS ... string in wkt, from export_bboxes_to_wkt | list
+    :return: A list of JSON objects of the detected objects, as create_obj_metadata makes ... python dictionary
+    """
+    return [{"obj_type": bbox[4], "obj_boundary_image": str(bbox), "obj_boundary_world": boundary_world}
+            for bbox, boundary_world in zip(bboxes, boundaries_world)]
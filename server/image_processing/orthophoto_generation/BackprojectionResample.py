@@ -1,17 +1,19 @@
+import threading
+from contextlib import contextmanager
 import numpy as np
-from numba import jit
+from numba import jit, prange, config, get_num_threads, set_num_threads
 from osgeo import gdal, osr
 import cv2
 
-@jit(nopython=True)
+# The kernels release the GIL, so that they run along with object detection of the same request
+@jit(nopython=True, nogil=True)
 def projectedCoord(boundary, boundary_rows, boundary_cols, gsd, eo, ground_height):
     proj_coords = np.empty(shape=(3, boundary_rows * boundary_cols))
-    i = 0
-    for row in range(boundary_rows):
+    for row in prange(boundary_rows):
         for col in range(boundary_cols):
+            i = row * boundary_cols + col
             proj_coords[0, i] = boundary[0, 0] + col * gsd - eo[0]
             proj_coords[1, i] = boundary[3, 0] - row * gsd - eo[1]
-            i += 1
     proj_coords[2, :] = ground_height - eo[2]
     return proj_coords
 
@@ -29,55 +31,342 @@ def backProjection(coord, R, focal_length, pixel_size, image_size):
     return coord_out
 
 @jit(nopython=True)
-def resample(coord, boundary_rows, boundary_cols, image):
+def isInside(row, col, image_rows, image_cols):
+    return 0 <= row < image_rows and 0 <= col < image_cols
+
+# Samplers of an image at a point in the pixel coordinate system to a pixel of out
+# A pixel (r, c) covers [r, r + 1) x [c, c + 1), neighbours out of the image are clamped to the edge
+#   image: rows x cols x channels
+#   row, col: The point in the image, which should be inside the image, px
+#   channels: The number of channels to sample
+#   out: An orthophoto - rows x cols x channels
+#   out_row, out_col: The pixel of out to write
+#   to_uint8: Round sampled values to uint8 or not
+# The kernels take one of them as an argument, so that numba compiles a kernel for each sampler
+
+@jit(nopython=True)
+def sampleNearest(image, row, col, channels, out, out_row, out_col, to_uint8):
+    # row, col are not negative, so truncation is the same as flooring
+    r = np.int32(row)
+    c = np.int32(col)
+    for channel in range(channels):
+        out[out_row, out_col, channel] = image[r, c, channel]
+
+@jit(nopython=True)
+def neighbours(coord):
+    """
+    :return: The first of neighbouring centers of pixels around coord and the distance to it
+    """
+    # coord + 0.5 is not negative, so truncation is the same as flooring
+    center = coord + np.float32(0.5)
+    first = np.int32(center) - 1
+    return first, center - np.float32(first + 1)
+
+@jit(nopython=True)
+def sampleBilinear(image, row, col, channels, out, out_row, out_col, to_uint8):
+    image_rows = image.shape[0]
+    image_cols = image.shape[1]
+
+    r0, dy = neighbours(np.float32(row))
+    c0, dx = neighbours(np.float32(col))
+    r1 = min(r0 + 1, image_rows - 1)
+    c1 = min(c0 + 1, image_cols - 1)
+    r0 = max(r0, 0)
+    c0 = max(c0, 0)
+
+    if to_uint8:
+        # Weights in 8 bit fixed point, as uint8 to float32 conversions take most of the time
+        fy = np.int32(dy * 256)
+        fx = np.int32(dx * 256)
+        w00 = (256 - fy) * (256 - fx)
+        w01 = (256 - fy) * fx
+        w10 = fy * (256 - fx)
+        w11 = fy * fx
+        for channel in range(channels):
+            value = np.int32(image[r0, c0, channel]) * w00 + np.int32(image[r0, c1, channel]) * w01 + \
+                    np.int32(image[r1, c0, channel]) * w10 + np.int32(image[r1, c1, channel]) * w11
+            out[out_row, out_col, channel] = (value + 32768) >> 16
+    else:
+        w11 = dy * dx
+        w10 = dy - w11
+        w01 = dx - w11
+        w00 = np.float32(1) - dy - w01
+        for channel in range(channels):
+            out[out_row, out_col, channel] = image[r0, c0, channel] * w00 + image[r0, c1, channel] * w01 + \
+                                             image[r1, c0, channel] * w10 + image[r1, c1, channel] * w11
+
+@jit(nopython=True)
+def cubicWeights(t):
+    # Cubic convolution with a = -0.75, the same as cv2.INTER_CUBIC
+    a = np.float32(-0.75)
+    w0 = ((a * (t + 1) - 5 * a) * (t + 1) + 8 * a) * (t + 1) - 4 * a
+    w1 = ((a + 2) * t - (a + 3)) * t * t + 1
+    w2 = ((a + 2) * (1 - t) - (a + 3)) * (1 - t) * (1 - t) + 1
+    w3 = 1 - w0 - w1 - w2
+    return (w0, w1, w2, w3)
+
+@jit(nopython=True)
+def sampleBicubic(image, row, col, channels, out, out_row, out_col, to_uint8):
+    image_rows = image.shape[0]
+    image_cols = image.shape[1]
+
+    r0, dy = neighbours(np.float32(row))
+    c0, dx = neighbours(np.float32(col))
+    weights_row = cubicWeights(dy)
+    weights_col = cubicWeights(dx)
+
+    for channel in range(channels):
+        value = np.float32(0)
+        for i in range(4):
+            r = min(max(r0 - 1 + i, 0), image_rows - 1)
+            value_row = np.float32(0)
+            for j in range(4):
+                c = min(max(c0 - 1 + j, 0), image_cols - 1)
+                value_row += image[r, c, channel] * weights_col[j]
+            value += value_row * weights_row[i]
+
+        if to_uint8:
+            out[out_row, out_col, channel] = np.uint8(min(max(value + np.float32(0.5), np.float32(0)),
+                                                          np.float32(255)))
+        else:
+            out[out_row, out_col, channel] = value
+
+# Resampling methods
+RESAMPLING = {'nearest': sampleNearest, 'bilinear': sampleBilinear, 'bicubic': sampleBicubic}
+CV2_RESAMPLING = {'nearest': cv2.INTER_NEAREST, 'bilinear': cv2.INTER_LINEAR, 'bicubic': cv2.INTER_CUBIC}
+
+@jit(nopython=True, nogil=True)
+def resample(coord, boundary_rows, boundary_cols, image, sample):
     # Define channels of an orthophoto
-    b = np.zeros(shape=(boundary_rows, boundary_cols), dtype=np.uint8)
-    g = np.zeros(shape=(boundary_rows, boundary_cols), dtype=np.uint8)
-    r = np.zeros(shape=(boundary_rows, boundary_cols), dtype=np.uint8)
-    a = np.zeros(shape=(boundary_rows, boundary_cols), dtype=np.uint8)
+    bgra = np.zeros(shape=(boundary_rows, boundary_cols, 4), dtype=np.uint8)
 
     rows = np.reshape(coord[1], (boundary_rows, boundary_cols))
     cols = np.reshape(coord[0], (boundary_rows, boundary_cols))
 
-    rows = rows.astype(np.int16)
-    #rows = np.int16(rows)
-    cols = cols.astype(np.int16)
-
-    for row in range(boundary_rows):
+    for row in prange(boundary_rows):
         for col in range(boundary_cols):
-            if cols[row, col] < 0 or cols[row, col] >= image.shape[1]:
-                continue
-            elif rows[row, col] < 0 or rows[row, col] >= image.shape[0]:
+            if not isInside(rows[row, col], cols[row, col], image.shape[0], image.shape[1]):
                 continue
             else:
-                b[row, col] = image[rows[row, col], cols[row, col]][0]
-                g[row, col] = image[rows[row, col], cols[row, col]][1]
-                r[row, col] = image[rows[row, col], cols[row, col]][2]
-                a[row, col] = 255
+                sample(image, rows[row, col], cols[row, col], 3, bgra, row, col, True)
+                bgra[row, col, 3] = 255
 
-    return b, g, r, a
+    return bgra[:, :, 0], bgra[:, :, 1], bgra[:, :, 2], bgra[:, :, 3]
 
-@jit(nopython=True)
-def resample_thermal(coord, boundary_rows, boundary_cols, image):
+@jit(nopython=True, nogil=True)
+def resample_thermal(coord, boundary_rows, boundary_cols, image, sample):
     # Define channels of an orthophoto
-    gray = np.zeros(shape=(boundary_rows, boundary_cols))
+    gray = np.zeros(shape=(boundary_rows, boundary_cols, 1))
+    image = np.expand_dims(image, 2)
 
     rows = np.reshape(coord[1], (boundary_rows, boundary_cols))
     cols = np.reshape(coord[0], (boundary_rows, boundary_cols))
 
-    rows = rows.astype(np.int16)
-    cols = cols.astype(np.int16)
+    for row in prange(boundary_rows):
+        for col in range(boundary_cols):
+            if not isInside(rows[row, col], cols[row, col], image.shape[0], image.shape[1]):
+                continue
+            else:
+                sample(image, rows[row, col], cols[row, col], 1, gray, row, col, False)
+
+    return gray[:, :, 0]
+
+@jit(nopython=True)
+def backProjectPoint(R, dx, dy, dz, focal_length, pixel_size, image_rows, image_cols):
+    """
+    Back-project a single ground point to the image, the same as backProjection does for 3 x n points
+    :param R: Rotation matrix from Ground to Camera
+    :param dx, dy, dz: Ground coordinates of the point relative to the projection center, m
+    :return: Row and column of the point in the image, px
+    """
+    coord_CCS_x = R[0, 0] * dx + R[0, 1] * dy + R[0, 2] * dz
+    coord_CCS_y = R[1, 0] * dx + R[1, 1] * dy + R[1, 2] * dz
+    coord_CCS_z = R[2, 0] * dx + R[2, 1] * dy + R[2, 2] * dz
 
-    for row in range(boundary_rows):
+    scale = coord_CCS_z / (-focal_length)
+    row = image_rows / 2 - (coord_CCS_y / scale) / pixel_size
+    col = image_cols / 2 + (coord_CCS_x / scale) / pixel_size
+
+    return row, col
+
+@jit(nopython=True, nogil=True)
+def fusedResample(boundary, boundary_rows, boundary_cols, gsd, eo, ground_height,
+                  R, focal_length, pixel_size, image, sample):
+    """
+    projectedCoord, backProjection and resample in a single pass over the orthophoto
+    No 3 x (row x col) arrays are made, each pixel is projected and sampled in place
+    :return: Orthophoto in BGRA - shape: boundary_rows x boundary_cols x 4
+    """
+    orthophoto = np.zeros(shape=(boundary_rows, boundary_cols, 4), dtype=np.uint8)
+    image_rows = image.shape[0]
+    image_cols = image.shape[1]
+    dz = ground_height - eo[2]
+
+    for row in prange(boundary_rows):
+        dy = boundary[3, 0] - row * gsd - eo[1]
         for col in range(boundary_cols):
-            if cols[row, col] < 0 or cols[row, col] >= image.shape[1]:
+            dx = boundary[0, 0] + col * gsd - eo[0]
+            proj_row, proj_col = backProjectPoint(R, dx, dy, dz, focal_length, pixel_size,
+                                                  image_rows, image_cols)
+            if not isInside(proj_row, proj_col, image_rows, image_cols):
                 continue
-            elif rows[row, col] < 0 or rows[row, col] >= image.shape[0]:
+            else:
+                sample(image, proj_row, proj_col, 3, orthophoto, row, col, True)
+                orthophoto[row, col, 3] = 255
+
+    return orthophoto
+
+@jit(nopython=True, nogil=True)
+def fusedResample_thermal(boundary, boundary_rows, boundary_cols, gsd, eo, ground_height,
+                          R, focal_length, pixel_size, image, sample):
+    gray = np.zeros(shape=(boundary_rows, boundary_cols, 1))
+    image = np.expand_dims(image, 2)
+    image_rows = image.shape[0]
+    image_cols = image.shape[1]
+    dz = ground_height - eo[2]
+
+    for row in prange(boundary_rows):
+        dy = boundary[3, 0] - row * gsd - eo[1]
+        for col in range(boundary_cols):
+            dx = boundary[0, 0] + col * gsd - eo[0]
+            proj_row, proj_col = backProjectPoint(R, dx, dy, dz, focal_length, pixel_size,
+                                                  image_rows, image_cols)
+            if not isInside(proj_row, proj_col, image_rows, image_cols):
                 continue
             else:
-                gray[row, col] = image[rows[row, col], cols[row, col]]
+                sample(image, proj_row, proj_col, 1, gray, row, col, False)
+
+    return gray[:, :, 0]
+
+def homography(boundary, gsd, eo, ground_height, R, focal_length, pixel_size, image_size):
+    """
+    A planar homography from the orthophoto to the image, exact for a flat ground of ground_height
+    :param boundary: Boundary box of the orthophoto - [X min, X max, Y min, Y max], 4 x 1
+    :param image_size: rows, cols of the image, px
+    :return: 3 x 3 homography from (col, row, 1) of the orthophoto to (col, row, 1) of the image
+    """
+    image_rows, image_cols = image_size[0:2]
+
+    # Orthophoto to ground coordinates relative to the projection center
+    G = np.array([[gsd, 0, boundary[0, 0] - eo[0]],
+                  [0, -gsd, boundary[3, 0] - eo[1]],
+                  [0, 0, ground_height - eo[2]]])
+
+    # Camera coordinates to pixel coordinates, as backProjection does
+    K = np.array([[-focal_length / pixel_size, 0, image_cols / 2],
+                  [0, focal_length / pixel_size, image_rows / 2],
+                  [0, 0, 1]])
+
+    # The kernels take a pixel (row, col) as [row, row + 1) x [col, col + 1)
+    # while OpenCV takes it centered at (row, col)
+    T = np.array([[1, 0, -0.5],
+                  [0, 1, -0.5],
+                  [0, 0, 1]])
+
+    return np.linalg.multi_dot([T, K, R, G])
+
+def warpResample(H, boundary_rows, boundary_cols, image, resampling='nearest'):
+    """
+    Resample an image through a homography from homography
+    :param resampling: nearest, bilinear or bicubic
+    :return: Orthophoto in BGRA - shape: boundary_rows x boundary_cols x 4
+    """
+    if resampling == 'nearest':
+        # Alpha band of the image is a mask of 255 warped along with b, g, r
+        image_bgra = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+        orthophoto = cv2.warpPerspective(image_bgra, H, (boundary_cols, boundary_rows),
+                                         flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+                                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        return orthophoto
+
+    border = 2
+    image_bgra = borderedBGRA(image, border)
+    H_border = np.dot(np.array([[1, 0, border],
+                                [0, 1, border],
+                                [0, 0, 1]]), H)
+
+    orthophoto = cv2.warpPerspective(image_bgra, H_border, (boundary_cols, boundary_rows),
+                                     flags=CV2_RESAMPLING[resampling] | cv2.WARP_INVERSE_MAP,
+                                     borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return thresholdAlpha(orthophoto)
+
+def borderedBGRA(image, border):
+    """
+    Clamp neighbours out of the image to the edge as the kernels do, by a border of 2 px
+    whose alpha is 0, then the interpolated alpha crosses 128 on the edge of the image
+    """
+    image_bgra = cv2.cvtColor(cv2.copyMakeBorder(image, border, border, border, border, cv2.BORDER_REPLICATE),
+                              cv2.COLOR_BGR2BGRA)
+    image_bgra[:border, :, 3] = 0
+    image_bgra[-border:, :, 3] = 0
+    image_bgra[:, :border, 3] = 0
+    image_bgra[:, -border:, 3] = 0
+    return image_bgra
+
+def thresholdAlpha(orthophoto):
+    a = cv2.extractChannel(orthophoto, 3)
+    cv2.threshold(a, 127, 255, cv2.THRESH_BINARY, dst=a)
+    cv2.insertChannel(a, orthophoto, 3)
+    return orthophoto
+
+def warpResample_thermal(H, boundary_rows, boundary_cols, image, resampling='nearest'):
+    gray = cv2.warpPerspective(image, H, (boundary_cols, boundary_rows),
+                               flags=CV2_RESAMPLING[resampling] | cv2.WARP_INVERSE_MAP,
+                               borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return gray.astype(np.float64)
+
+def remapResample(map_x, map_y, image, resampling='nearest'):
+    """
+    Resample an image through maps of pixels of the orthophoto to the image, e.g. from demMap
+    :param map_x, map_y: Columns and rows of the image in the center convention of OpenCV, float32
+    :return: Orthophoto in BGRA - the shape of the maps x 4
+    """
+    if resampling == 'nearest':
+        return cv2.remap(cv2.cvtColor(image, cv2.COLOR_BGR2BGRA), map_x, map_y, cv2.INTER_NEAREST,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    border = 2
+    orthophoto = cv2.remap(borderedBGRA(image, border), map_x + np.float32(border), map_y + np.float32(border),
+                           CV2_RESAMPLING[resampling], borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return thresholdAlpha(orthophoto)
+
+def remapResample_thermal(map_x, map_y, image, resampling='nearest'):
+    gray = cv2.remap(image, map_x, map_y, CV2_RESAMPLING[resampling], borderMode=cv2.BORDER_CONSTANT,
+                     borderValue=0)
+    return gray.astype(np.float64)
+
+# Row-parallel variants of the kernels above
+# prange runs as range in the kernels above, and over the rows in parallel below
+projectedCoord_parallel = jit(nopython=True, nogil=True, parallel=True)(projectedCoord.py_func)
+resample_parallel = jit(nopython=True, nogil=True, parallel=True)(resample.py_func)
+resample_thermal_parallel = jit(nopython=True, nogil=True, parallel=True)(resample_thermal.py_func)
+fusedResample_parallel = jit(nopython=True, nogil=True, parallel=True)(fusedResample.py_func)
+fusedResample_thermal_parallel = jit(nopython=True, nogil=True, parallel=True)(fusedResample_thermal.py_func)
+
+# The default threading layer of numba(workqueue) is not thread-safe,
+# so parallel kernels called from concurrent requests run one at a time
+parallel_lock = threading.Lock()
+
+@contextmanager
+def parallel_section(num_threads=None):
+    """
+    Run parallel kernels with a given number of threads
+    :param num_threads: The number of threads - None: all cores, 1: serial kernels, no need to lock
+    """
+    if num_threads == 1:
+        yield
+        return
+
+    if num_threads is None or num_threads > config.NUMBA_NUM_THREADS:
+        num_threads = config.NUMBA_NUM_THREADS
 
-    return gray
+    with parallel_lock:
+        previous_num_threads = get_num_threads()
+        set_num_threads(num_threads)
+        try:
+            yield
+        finally:
+            set_num_threads(previous_num_threads)
 
 def createGeoTiff(b, g, r, a, boundary, gsd, rows, cols, dst):
     # https://stackoverflow.com/questions/33537599/how-do-i-write-create-a-geotiff-rgb-image-file-in-python
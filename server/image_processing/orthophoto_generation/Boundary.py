@@ -2,12 +2,12 @@ import numpy as np
 from osgeo import ogr
 
 
-def boundary(image, eo, R, dem, pixel_size, focal_length):
+def boundary(image, eo, R, dem, pixel_size, focal_length, mesh=None):
     inverse_R = R.transpose()
 
     image_vertex = getVertices(image, pixel_size, focal_length)  # shape: 3 x 4
 
-    proj_coordinates = projection(image_vertex, eo, inverse_R, dem)
+    proj_coordinates = projection(image_vertex, eo, inverse_R, dem, mesh)
 
     bbox = np.empty(shape=(4, 1))
     bbox[0] = min(proj_coordinates[0, :])  # X min
@@ -44,8 +44,17 @@ def getVertices(image, pixel_size, focal_length):
 
     return vertices
 
-def projection(vertices, eo, rotation_matrix, dem):
+def projection(vertices, eo, rotation_matrix, dem, mesh=None):
+    """
+    Project rays of vertices in camera coordinate system to the ground
+    :param dem: A height of the ground, m
+    :param mesh: ray.Mesh of the terrain, which rays are intersected with - None: a flat ground of dem
+                 Rays which miss the mesh are projected to the flat ground of dem
+    :return: Projected coordinates - shape: 2(X, Y) x vertices
+    """
     coord_GCS = np.dot(rotation_matrix, vertices)
+    if mesh is not None:
+        return mesh.project(eo, coord_GCS, dem)[0:2]
     scale = (dem - eo[2]) / coord_GCS[2]
 
     plane_coord_GCS = scale * coord_GCS[0:2] + [[eo[0]], [eo[1]]]
@@ -139,3 +148,37 @@ def transform_bbox(bbox_coords, rows, cols, pixel_size, focal_length, tm_eo, R_C
     proj_coordinates = projection(bbox_camera, tm_eo, R_CG, ground_height)
 
     return proj_coordinates
+
+
+def transform_bboxes(bboxes, rows, cols, pixel_size, focal_length, tm_eo, R_CG, ground_height, mesh=None):
+    """
+    Project boundary boxes to the ground at once, as transform_bbox does for each of them
+    :param bboxes: Boundary boxes in pixel coordinate system - shape: n x 4 or more(x1, y1, x2, y2, ...), px
+    :param mesh: ray.Mesh of the terrain, to project corners on it - None: a flat ground of ground_height
+    :return: Corners of the boxes on the ground, in the order of transform_bbox - shape: n x 4 x 2(X, Y)
+    """
+    if len(bboxes) == 0:
+        return np.empty(shape=(0, 4, 2))
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(len(bboxes), -1)
+    # Rounded half to even, as round() of transform_bbox
+    x1, y1, x2, y2 = np.rint(bboxes[:, 0:4]).T
+
+    bbox_px = np.empty(shape=(2, len(bboxes), 4))
+    bbox_px[0] = np.stack([x1, x2, x2, x1], axis=1)
+    bbox_px[1] = np.stack([y1, y1, y2, y2], axis=1)
+
+    # All corners are converted and projected by one matrix multiplication, or one batch of rays on the mesh
+    bbox_camera = pcs2ccs(bbox_px.reshape(2, -1), rows, cols, pixel_size, focal_length * 1000)
+    proj_coordinates = projection(bbox_camera, tm_eo, R_CG, ground_height, mesh)  # shape: 2 x 4n
+
+    return proj_coordinates.T.reshape(len(bboxes), 4, 2)
+
+
+def export_bboxes_to_wkt(corners):
+    """
+    Format closed polygons in WKT, as export_bbox_to_wkt3 does for each of them
+    :param corners: shape: n x 4 x 2(X, Y) ... from transform_bboxes
+    :return: A list of strings in WKT
+    """
+    polygons = np.concatenate([corners, corners[:, 0:1]], axis=1).reshape(len(corners), 10)
+    return ["POLYGON ((%r %r, %r %r, %r %r, %r %r, %r %r))" % tuple(polygon) for polygon in polygons.tolist()]
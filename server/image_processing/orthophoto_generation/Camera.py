@@ -0,0 +1,90 @@
+"""
+Constants of the camera of a drone, which are the same for every frame
+Only the pose of the camera changes from frame to frame, so rectification of a frame takes
+a rotation and an intersection of the rays of the corners with the ground, and a homography of 3 x 3 matrices
+"""
+import threading
+import numpy as np
+
+from server.image_processing.orthophoto_generation.Boundary import projection
+
+
+class Camera:
+    def __init__(self, sensor_width, focal_length):
+        """
+        :param sensor_width: The width of the sensor, mm
+        :param focal_length: The focal length, m
+        """
+        self.sensor_width = sensor_width
+        self.focal_length = focal_length
+
+        self.lock = threading.Lock()
+        self.geometries = {}
+
+    @classmethod
+    def from_ipod_params(cls, ipod_params):
+        return cls(ipod_params['sensor_width'], ipod_params['focal_length'])
+
+    def geometry(self, rows, cols, focal_length=None):
+        """
+        :param rows: The number of rows of frames, px
+        :param cols: The number of columns of frames, px
+        :param focal_length: The focal length of frames, e.g. in EXIF, m - None: the one of the camera
+        :return: The geometry of frames of a size, which is made at the first frame of the size
+        """
+        key = (rows, cols, self.focal_length if focal_length is None else focal_length)
+        with self.lock:
+            if key not in self.geometries:
+                self.geometries[key] = FrameGeometry(rows, cols, self.sensor_width / cols, key[2])
+            return self.geometries[key]
+
+
+class FrameGeometry:
+    def __init__(self, rows, cols, pixel_size, focal_length):
+        """
+        :param pixel_size: mm/px
+        :param focal_length: m
+        """
+        self.rows = rows
+        self.cols = cols
+        self.pixel_size = pixel_size
+        self.focal_length = focal_length
+
+        pixel_size = pixel_size / 1000  # m/px
+        # Rays of the corners of the frame in camera coordinate system, as getVertices - shape: 3 x 4
+        self.vertices = np.array([[-cols / 2, cols / 2, cols / 2, -cols / 2],
+                                  [rows / 2, rows / 2, -rows / 2, -rows / 2],
+                                  [0, 0, 0, 0]]) * pixel_size
+        self.vertices[2, :] = -focal_length
+
+        # Camera coordinates to pixel coordinates of OpenCV, which are centered at (row, col), as homography
+        self.K = np.array([[-focal_length / pixel_size, 0, cols / 2 - 0.5],
+                           [0, focal_length / pixel_size, rows / 2 - 0.5],
+                           [0, 0, 1]])
+
+    def gsd(self, eo, ground_height):
+        """
+        :return: GSD of the frame at a height of the ground, m/px
+        """
+        return (self.pixel_size / 1000 * (eo[2] - ground_height)) / self.focal_length  # unit: m/px
+
+    def boundary(self, eo, R, ground_height):
+        """
+        The same as Boundary.boundary
+        :return: Boundary box - [X min, X max, Y min, Y max], 4 x 1, and the projected corners - 4 x 2
+        """
+        proj_coordinates = projection(self.vertices, eo, R.T, ground_height)
+        bbox = np.empty(shape=(4, 1))
+        bbox[0:2, 0] = proj_coordinates[0].min(), proj_coordinates[0].max()
+        bbox[2:4, 0] = proj_coordinates[1].min(), proj_coordinates[1].max()
+        return bbox, proj_coordinates.T
+
+    def homography(self, bbox, gsd, eo, ground_height, R):
+        """
+        The same as BackprojectionResample.homography
+        :return: 3 x 3 homography from (col, row, 1) of the orthophoto to (col, row, 1) of the image
+        """
+        G = np.array([[gsd, 0, bbox[0, 0] - eo[0]],
+                      [0, -gsd, bbox[3, 0] - eo[1]],
+                      [0, 0, ground_height - eo[2]]])
+        return self.K @ R @ G
@@ -0,0 +1,326 @@
+"""
+A DEM for rectification over a terrain, instead of a flat ground of ground_height
+Heights are memory-mapped from a cache of the GeoTIFF, and tiles of the DEM keep their min/max heights,
+so that rays skip tiles which they pass over without sampling the heights
+The DEM has to be in the coordinate system of EOs, e.g. EPSG:3857, and its no data is NaN
+"""
+import os
+import numpy as np
+import cv2
+from numba import jit, prange
+from osgeo import gdal
+
+
+class Dem:
+    def __init__(self, heights, geotransform, tile_size=64):
+        """
+        :param heights: Heights of the DEM, m - rows x cols, NaN for no data
+        :param geotransform: GDAL-style geotransform of the DEM - (xmin, dx, 0, ymax, 0, -dy)
+        :param tile_size: The size of tiles of the min/max index, px
+        """
+        # A plain ndarray view of a memmap, which numba takes without copying it
+        self.heights = np.asarray(heights, dtype=np.float32)
+        self.geotransform = np.array(geotransform, dtype=np.float64)
+        self.tile_size = tile_size
+        self.tile_min, self.tile_max = tileMinMax(self.heights, tile_size)
+
+    @classmethod
+    def open(cls, path, tile_size=64):
+        """
+        Open a GeoTIFF DEM, whose heights are converted to a .npy of float32 next to it at the first time
+        :param path: A path of the GeoTIFF
+        """
+        dataset = gdal.Open(path)
+        geotransform = dataset.GetGeoTransform()
+        band = dataset.GetRasterBand(1)
+
+        cache_path = os.path.splitext(path)[0] + '.heights.npy'
+        if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(path):
+            nodata = band.GetNoDataValue()
+            heights = np.lib.format.open_memmap(cache_path + '.tmp', mode='w+', dtype=np.float32,
+                                                shape=(dataset.RasterYSize, dataset.RasterXSize))
+            # Strip by strip, not to load the whole DEM into memory
+            for row in range(0, dataset.RasterYSize, tile_size):
+                strip = band.ReadAsArray(0, row, dataset.RasterXSize, min(tile_size, dataset.RasterYSize - row))
+                strip = strip.astype(np.float32)
+                if nodata is not None:
+                    strip[strip == nodata] = np.nan
+                heights[row:row + strip.shape[0]] = strip
+            heights.flush()
+            del heights
+            os.replace(cache_path + '.tmp', cache_path)
+
+        return cls(np.load(cache_path, mmap_mode='r'), geotransform, tile_size)
+
+    def height_range(self):
+        """
+        :return: The min and max heights of the DEM, NaN if it has no data
+        """
+        valid = ~np.isnan(self.tile_min)
+        if not valid.any():
+            return np.nan, np.nan
+        return float(self.tile_min[valid].min()), float(self.tile_max[valid].max())
+
+    def intersect(self, eo, directions, default_height):
+        """
+        Intersect rays from the projection center with the DEM
+        :param eo: EOP - [x, y, z, o, p, k]
+        :param directions: Directions of the rays in ground coordinate system - 3 x n
+        :param default_height: The height of the ground out of the DEM, m
+        :return: Intersections - 3(X, Y, Z) x n
+        """
+        min_height, max_height = self.height_range()
+        if np.isnan(min_height):
+            min_height = max_height = default_height
+        return intersectRays(np.asarray(eo[0:3], dtype=np.float64), np.asarray(directions, dtype=np.float64),
+                             self.heights, self.geotransform, self.tile_min, self.tile_max, self.tile_size,
+                             min(min_height, default_height), max(max_height, default_height), default_height)
+
+
+def tileMinMax(heights, tile_size):
+    """
+    :return: Min and max heights of tiles of tile_size x tile_size, NaN for tiles of no data
+             Tiles include a pixel around them, which bilinear heights in them interpolate with
+    """
+    tile_rows = -(-heights.shape[0] // tile_size)
+    tile_cols = -(-heights.shape[1] // tile_size)
+    tile_min = np.full((tile_rows, tile_cols), np.nan, dtype=np.float32)
+    tile_max = np.full((tile_rows, tile_cols), np.nan, dtype=np.float32)
+    for i in range(tile_rows):
+        # A strip of tiles at a time, as the heights may be memory-mapped
+        strip = np.asarray(heights[max(i * tile_size - 1, 0):(i + 1) * tile_size + 1])
+        for j in range(tile_cols):
+            tile = strip[:, max(j * tile_size - 1, 0):(j + 1) * tile_size + 1]
+            if not np.isnan(tile).all():
+                tile_min[i, j] = np.nanmin(tile)
+                tile_max[i, j] = np.nanmax(tile)
+    return tile_min, tile_max
+
+
+@jit(nopython=True, nogil=True)
+def demHeight(heights, geotransform, x, y, default_height):
+    """
+    Bilinear height of the DEM at a ground point, whose pixels are centered at (row + 0.5, col + 0.5)
+    :return: The height, or default_height out of the DEM or on no data
+    """
+    col = (x - geotransform[0]) / geotransform[1] - 0.5
+    row = (y - geotransform[3]) / geotransform[5] - 0.5
+    rows, cols = heights.shape
+    if not (-0.5 <= row <= rows - 0.5 and -0.5 <= col <= cols - 0.5):
+        return default_height
+
+    # Clamped to the edge within half a pixel out of the centers
+    r0 = min(max(int(np.floor(row)), 0), rows - 1)
+    c0 = min(max(int(np.floor(col)), 0), cols - 1)
+    r1 = min(r0 + 1, rows - 1)
+    c1 = min(c0 + 1, cols - 1)
+    dy = min(max(row - r0, 0.0), 1.0)
+    dx = min(max(col - c0, 0.0), 1.0)
+    height = (heights[r0, c0] * (1 - dx) + heights[r0, c1] * dx) * (1 - dy) + \
+             (heights[r1, c0] * (1 - dx) + heights[r1, c1] * dx) * dy
+    if np.isnan(height):
+        return default_height
+    return height
+
+
+@jit(nopython=True, nogil=True)
+def slab(origin, direction, low, high):
+    """
+    :return: The range of t where origin + direction * t is in [low, high], which is empty if t_in > t_out
+    """
+    if direction == 0:
+        if low <= origin <= high:
+            return -np.inf, np.inf
+        return np.inf, -np.inf
+    t_low = (low - origin) / direction
+    t_high = (high - origin) / direction
+    return min(t_low, t_high), max(t_low, t_high)
+
+
+@jit(nopython=True, nogil=True)
+def intersectRays(origin, directions, heights, geotransform, tile_min, tile_max, tile_size,
+                  min_height, max_height, default_height):
+    """
+    March each ray between the planes of max_height and min_height in steps of half a pixel of the DEM,
+    and bisect the step where the ray goes under the DEM
+    Steps over tiles whose max height is under the ray are not sampled
+    Only the part of the ray over the DEM is marched, and the ground out of the DEM is the plane of default_height,
+    so rays which miss the DEM, and rays at or over the horizon as the flat ground, are on the plane
+    """
+    num_rays = directions.shape[1]
+    points = np.empty((3, num_rays))
+    cell = min(abs(geotransform[1]), abs(geotransform[5]))
+    rows, cols = heights.shape
+    x0, x1 = sorted((geotransform[0], geotransform[0] + cols * geotransform[1]))
+    y0, y1 = sorted((geotransform[3], geotransform[3] + rows * geotransform[5]))
+    # Steps of half a pixel along the diagonal of the DEM, at most
+    max_steps = 4 * (rows + cols) + 1
+
+    for i in range(num_rays):
+        dx, dy, dz = directions[0, i], directions[1, i], directions[2, i]
+        eps = 1e-9 * np.sqrt(dx * dx + dy * dy + dz * dz)
+        # Rays are parametrised by t, the height which they go down from the projection center
+        t_plane = origin[2] - default_height
+        if dz >= -eps:
+            # Never under the DEM, so on the plane as the flat ground, not to divide by 0
+            scale = t_plane / -(dz if abs(dz) > eps else -eps)
+            points[0, i] = origin[0] + dx * scale
+            points[1, i] = origin[1] + dy * scale
+            points[2, i] = default_height
+            continue
+        ux = dx / -dz
+        uy = dy / -dz
+
+        t0 = max(origin[2] - max_height, 0.0)
+        t1 = max(origin[2] - min_height, t0)
+        tx0, tx1 = slab(origin[0], ux, x0, x1)
+        ty0, ty1 = slab(origin[1], uy, y0, y1)
+        t_in = max(tx0, ty0)
+        t_out = min(tx1, ty1)
+        ta = max(t0, t_in)
+        tb = min(t1, t_out)
+
+        if t_plane < t_in or ta > tb:
+            # On the plane before the ray comes over the DEM, or the ray does not come over the DEM
+            t = max(t_plane, 0.0)
+        else:
+            horizontal = np.sqrt(ux * ux + uy * uy)
+            step = 0.5 * cell / horizontal if horizontal > 0 else tb - ta
+            num_steps = min(max(int(np.ceil((tb - ta) / max(step, 1e-12))), 1), max_steps)
+            step = (tb - ta) / num_steps
+
+            t_above = ta
+            t_hit = -1.0
+            for k in range(1, num_steps + 1):
+                t = ta + k * step
+                x = origin[0] + ux * t
+                y = origin[1] + uy * t
+                z = origin[2] - t
+
+                # Skip the step if the ray is over the highest height of the tile
+                row = int(np.floor((y - geotransform[3]) / geotransform[5]))
+                col = int(np.floor((x - geotransform[0]) / geotransform[1]))
+                if 0 <= row < rows and 0 <= col < cols:
+                    top = tile_max[row // tile_size, col // tile_size]
+                    if not np.isnan(top) and z > top:
+                        t_above = t
+                        continue
+
+                if z <= demHeight(heights, geotransform, x, y, default_height):
+                    t_hit = t
+                    break
+                t_above = t
+
+            if t_hit < 0:
+                # The ray leaves the DEM over it, and goes down to the plane, or is under the plane already
+                t = max(t_plane, tb)
+            else:
+                # Bisect between the last point above the DEM and the first one under it
+                for _ in range(30):
+                    t = 0.5 * (t_above + t_hit)
+                    if origin[2] - t > demHeight(heights, geotransform, origin[0] + ux * t, origin[1] + uy * t,
+                                                 default_height):
+                        t_above = t
+                    else:
+                        t_hit = t
+                t = 0.5 * (t_above + t_hit)
+
+        points[0, i] = origin[0] + ux * t
+        points[1, i] = origin[1] + uy * t
+        points[2, i] = origin[2] - t
+
+    return points
+
+
+@jit(nopython=True, nogil=True)
+def demMap(boundary, map_rows, map_cols, origin, step, gsd, eo, R, focal_length, pixel_size, image_rows, image_cols,
+           heights, geotransform, default_height):
+    """
+    Back-project pixels of the orthophoto at their heights in the DEM to the image
+    :param map_rows, map_cols: The size of the maps
+    :param origin, step: A pixel (row, col) of the maps is (origin + row * step, origin + col * step) of the orthophoto
+    :return: map_x, map_y of cv2.remap, in the center convention of OpenCV - map_rows x map_cols
+    """
+    map_x = np.empty((map_rows, map_cols), dtype=np.float32)
+    map_y = np.empty((map_rows, map_cols), dtype=np.float32)
+
+    for row in prange(map_rows):
+        y = boundary[3, 0] - (origin + row * step) * gsd
+        for col in range(map_cols):
+            x = boundary[0, 0] + (origin + col * step) * gsd
+            dx = x - eo[0]
+            dy = y - eo[1]
+            dz = demHeight(heights, geotransform, x, y, default_height) - eo[2]
+
+            # The same as backProjectPoint
+            coord_CCS_x = R[0, 0] * dx + R[0, 1] * dy + R[0, 2] * dz
+            coord_CCS_y = R[1, 0] * dx + R[1, 1] * dy + R[1, 2] * dz
+            coord_CCS_z = R[2, 0] * dx + R[2, 1] * dy + R[2, 2] * dz
+            scale = coord_CCS_z / (-focal_length)
+            map_y[row, col] = image_rows / 2 - (coord_CCS_y / scale) / pixel_size - 0.5
+            map_x[row, col] = image_cols / 2 + (coord_CCS_x / scale) / pixel_size - 0.5
+
+    return map_x, map_y
+
+
+def demMaps(dem, boundary, boundary_rows, boundary_cols, gsd, eo, R, focal_length, pixel_size, image_shape,
+            default_height, step=8, num_threads=None):
+    """
+    Maps of the orthophoto to the image over the DEM
+    Pixels at the centers of step x step blocks are back-projected, and the maps are linearly interpolated between them
+    by cv2.resize, whose samples of the blocks are at their centers
+    :param step: 1: every pixel is back-projected
+    :return: map_x, map_y of cv2.remap - boundary_rows x boundary_cols
+    """
+    kernel = demMap if num_threads == 1 else demMap_parallel
+    args = (gsd, eo, R, focal_length, pixel_size, image_shape[0], image_shape[1], dem.heights, dem.geotransform,
+            default_height)
+    if step == 1:
+        return kernel(boundary, boundary_rows, boundary_cols, 0.0, 1.0, *args)
+
+    # A block more around the orthophoto, not to clamp the maps on its edges
+    map_rows = -(-boundary_rows // step) + 2
+    map_cols = -(-boundary_cols // step) + 2
+    coarse_x, coarse_y = kernel(boundary, map_rows, map_cols, (step - 1) / 2 - step, float(step), *args)
+    size = (map_cols * step, map_rows * step)
+    map_x = cv2.resize(coarse_x, size, interpolation=cv2.INTER_LINEAR)[step:step + boundary_rows,
+                                                                        step:step + boundary_cols]
+    map_y = cv2.resize(coarse_y, size, interpolation=cv2.INTER_LINEAR)[step:step + boundary_rows,
+                                                                        step:step + boundary_cols]
+    return map_x, map_y
+
+
+def demMapsMargin(step):
+    """
+    :return: Rows and columns which the maps of demMaps are resized with around the orthophoto, at most
+    """
+    return 0 if step == 1 else 3 * step
+
+
+def demBoundary(dem, image_shape, eo, R, pixel_size, focal_length, default_height, samples_per_edge=8):
+    """
+    The same as Boundary.boundary over the DEM, whose boundary bulges between the corners over a terrain
+    :param image_shape: rows, cols of the image, px
+    :param R: Rotation matrix from Ground to Camera
+    :return: Boundary box - [X min, X max, Y min, Y max], 4 x 1, the projected corners - 4 x 2,
+             and the height of the ground at the center of the image
+    """
+    rows, cols = image_shape[0:2]
+    # Points along the edges from the corner (1) clockwise as getVertices, and the center at last
+    t = np.arange(samples_per_edge) / samples_per_edge
+    edge_cols = np.concatenate([t * cols, np.full_like(t, cols), cols - t * cols, np.zeros_like(t), [cols / 2]])
+    edge_rows = np.concatenate([np.zeros_like(t), t * rows, np.full_like(t, rows), rows - t * rows, [rows / 2]])
+    vertices = np.empty(shape=(3, len(edge_cols)))
+    vertices[0] = (edge_cols - cols / 2) * pixel_size
+    vertices[1] = (rows / 2 - edge_rows) * pixel_size
+    vertices[2] = -focal_length
+
+    points = dem.intersect(eo, np.dot(R.T, vertices), default_height)
+    bbox = np.empty(shape=(4, 1))
+    bbox[0:2, 0] = points[0].min(), points[0].max()
+    bbox[2:4, 0] = points[1].min(), points[1].max()
+    corners = points[0:2, 0:4 * samples_per_edge:samples_per_edge].T
+    return bbox, corners, points[2, -1]
+
+
+demMap_parallel = jit(nopython=True, nogil=True, parallel=True)(demMap.py_func)
@@ -1,8 +1,13 @@
 import numpy as np
 import math
+import threading
 from osgeo.osr import SpatialReference, CoordinateTransformation
 from copy import copy
 
+# Coordinate transformations by (source EPSG, target EPSG), each with a lock as GDAL transformations are not thread-safe
+_transformations = {}
+_transformations_lock = threading.Lock()
+
 def readEO(path):
     eo_line = np.genfromtxt(path, delimiter='\t',
                             dtype={'names': ('Image', 'Longitude', 'Latitude', 'Height', 'Omega', 'Phi', 'Kappa'),
@@ -18,53 +23,68 @@ def readEO(path):
 
     return eo
 
-def latlon2tmcentral(eo):
-    # Define the TM central coordinate system (EPSG 5186)
-    epsg5186 = SpatialReference()
-    epsg5186.ImportFromEPSG(3857)
-
-    # Define the wgs84 system (EPSG 4326)
-    epsg4326 = SpatialReference()
-    epsg4326.ImportFromEPSG(4326)
+def get_transformation(source_epsg, target_epsg):
+    """
+    A coordinate transformation from source_epsg to target_epsg, which is made at the first use
+    Lookups of the EPSG database are slow, so transformations are cached
+    :return: The transformation, and the lock to hold while using it
+    """
+    key = (source_epsg, target_epsg)
+    with _transformations_lock:
+        if key not in _transformations:
+            source = SpatialReference()
+            source.ImportFromEPSG(source_epsg)
+            target = SpatialReference()
+            target.ImportFromEPSG(target_epsg)
+            _transformations[key] = (CoordinateTransformation(source, target), threading.Lock())
+        return _transformations[key]
+
+
+def transform_point(x, y, source_epsg, target_epsg):
+    transformation, lock = get_transformation(source_epsg, target_epsg)
+    with lock:
+        return transformation.TransformPoint(float(x), float(y))
+
+
+def transform_points(points, source_epsg, target_epsg):
+    """
+    :param points: N x 2 or more, the rest of the columns are ignored
+    :return: N x 2 transformed points
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, np.shape(points)[-1])
+    if len(points) == 0:
+        return np.empty((0, 2))
+    transformation, lock = get_transformation(source_epsg, target_epsg)
+    with lock:
+        transformed = transformation.TransformPoints(points[:, 0:2].tolist())
+    return np.array(transformed)[:, 0:2]
 
-    latlon2tm = CoordinateTransformation(epsg4326, epsg5186)
 
-    # Check the transformation for a point close to the centre of the projected grid
-    xy = latlon2tm.TransformPoint(float(eo[0]), float(eo[1]))  # The order: Lon, Lat
+def latlon2tmcentral(eo):
+    # Transform from the wgs84 system (EPSG 4326) to the TM central coordinate system
+    xy = transform_point(eo[0], eo[1], 4326, 3857)  # The order: Lon, Lat
     eo[0:2] = xy[0:2]
 
     return eo
 
 def geographic2plane(eo, epsg):
-    # Define the Plane Coordinate System (EPSG 5186)
-    plane = SpatialReference()
-    plane.ImportFromEPSG(epsg)
-
-    # Define the wgs84 system (EPSG 4326)
-    geographic = SpatialReference()
-    geographic.ImportFromEPSG(4326)
-
-    coord_transformation = CoordinateTransformation(geographic, plane)
-
-    # Check the transformation for a point close to the centre of the projected grid
-    xy = coord_transformation.TransformPoint(float(eo[0]), float(eo[1]))  # The order: Lon, Lat
+    # Transform from the wgs84 system (EPSG 4326) to the Plane Coordinate System
+    xy = transform_point(eo[0], eo[1], 4326, epsg)  # The order: Lon, Lat
     eo[0:2] = xy[0:2]
 
     return eo
 
-def tmcentral2latlon(eo):
-    # Define the TM central coordinate system (EPSG 5186)
-    epsg5186 = SpatialReference()
-    epsg5186.ImportFromEPSG(5186)
-
-    # Define the wgs84 system (EPSG 4326)
-    epsg4326 = SpatialReference()
-    epsg4326.ImportFromEPSG(4326)
+def geographic2plane_many(lonlat, epsg):
+    """
+    Transform points from the wgs84 system (EPSG 4326) to the Plane Coordinate System at once
+    :param lonlat: N x 2(Lon, Lat) or more, e.g. EOs
+    :return: N x 2(X, Y)
+    """
+    return transform_points(lonlat, 4326, epsg)
 
-    tm2latlon = CoordinateTransformation(epsg5186, epsg4326)
-
-    # Check the transformation for a point close to the centre of the projected grid
-    lonlat = tm2latlon.TransformPoint(float(eo[0]), float(eo[1]))  # The order: x, y
+def tmcentral2latlon(eo):
+    # Transform from the TM central coordinate system (EPSG 5186) to the wgs84 system (EPSG 4326)
+    lonlat = transform_point(eo[0], eo[1], 5186, 4326)  # The order: x, y
     eo[0:2] = lonlat[0:2]
 
     return eo
@@ -1,9 +1,38 @@
+import re
+import struct
+from fractions import Fraction
+from typing import NamedTuple
+from xml.sax.saxutils import unescape
 import cv2
 import numpy as np
 from PIL import Image
-import subprocess
 from pyexiv2 import metadata
 
+# Tags of TIFF/EXIF which get_metadata takes, by IFD
+IFD0_TAGS = {0x010F: 'Exif.Image.Make', 0x0112: 'Exif.Image.Orientation', 0x02BC: 'Exif.Image.XMLPacket',
+             0x8769: 'Exif.Image.ExifTag', 0x8825: 'Exif.Image.GPSTag'}
+EXIF_TAGS = {0x920A: 'Exif.Photo.FocalLength'}
+GPS_TAGS = {0x0006: 'Exif.GPSInfo.GPSAltitude'}
+# Type of TIFF -> format of struct and size of a value
+TIFF_TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 7: ('B', 1), 9: ('i', 4),
+              10: ('ii', 8), 11: ('f', 4), 12: ('d', 8)}
+XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+# Properties of XMP as attributes, prefix:name="value", or as elements, <prefix:name>value</prefix:name>
+XMP_PROPERTY = re.compile(rb'(?<![/\w-])(DLS|drone-dji):(\w+)(?:="([^"]*)"|>([^<]*)</)')
+
+
+class ImageMetadata(NamedTuple):
+    """
+    Metadata of an image for IPOD, which is unpacked in the order of the fields as the tuple of get_metadata was
+    """
+    focal_length: float         # m
+    orientation: int            # Orientation of EXIF
+    eo: np.ndarray              # [longitude, latitude, altitude, roll, pitch, yaw] - deg, deg, m, deg, deg, deg
+    before_lonlat: np.ndarray   # [longitude, latitude] of the previous capture, deg - NaN if unknown
+    uuid: str
+    task_id: str
+    maker: str
+
 def getExif(path):
     src_image = Image.open(path)
     info = src_image._getexif()
@@ -21,173 +50,229 @@ def getExif(path):
 
     return focal_length, orientation
 
-def restoreOrientation(image, orientation):
-    if orientation == 8:
-        restored_image = rotate(image, -90)
-    elif orientation == 6:
-        restored_image = rotate(image, 90)
+def restoreOrientation(image, orientation, view=False):
+    """
+    Restore an image by its orientation of EXIF, by permutation of pixels, which is lossless
+    3, 6 and 8 rotate by 180, 90 counterclockwise and 90 clockwise, the inverse of the rotations for display,
+    as OpenCV decodes an image with them already, and 2, 4, 5 and 7 flip, transpose and transverse the image
+    :param view: True - a strided view of the image, which is not copied, False - a contiguous copy
+                 The image is returned as it is for the other orientations in both cases
+    :return: The restored image, rows and columns of which are swapped for 5 - 8
+    """
+    if orientation == 2:
+        restored_image = image[:, ::-1] if view else cv2.flip(image, 1)
     elif orientation == 3:
-        restored_image = rotate(image, 180)
+        restored_image = image[::-1, ::-1] if view else cv2.rotate(image, cv2.ROTATE_180)
+    elif orientation == 4:
+        restored_image = image[::-1] if view else cv2.flip(image, 0)
+    elif orientation == 5:
+        restored_image = image.swapaxes(0, 1) if view else cv2.transpose(image)
+    elif orientation == 6:
+        restored_image = np.rot90(image, 1) if view else cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    elif orientation == 7:
+        restored_image = image.swapaxes(0, 1)[::-1, ::-1] if view else cv2.flip(cv2.transpose(image), -1)
+    elif orientation == 8:
+        restored_image = np.rot90(image, -1) if view else cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
     else:
         restored_image = image
 
     return restored_image
 
-def rotate(image, angle):
-    # https://www.pyimagesearch.com/2017/01/02/rotate-images-correctly-with-opencv-and-python/
-
-    height = image.shape[0]
-    width = image.shape[1]
-    center = (width/2, height/2)
-
-    # grab the rotation matrix (applying the negative of the
-    # angle to rotate clockwise), then grab the sine and cosine
-    # (i.e., the rotation components of the matrix)
-    rotation_mat = cv2.getRotationMatrix2D(center, angle, 1.0)
-    abs_cos = abs(rotation_mat[0, 0])
-    abs_sin = abs(rotation_mat[0, 1])
-
-    # compute the new bounding dimensions of the image
-    bound_w = int(height * abs_sin + width * abs_cos)
-    bound_h = int(height * abs_cos + width * abs_sin)
-
-    # adjust the rotation matrix to take into account translation
-    rotation_mat[0, 2] += bound_w / 2 - center[0]
-    rotation_mat[1, 2] += bound_h / 2 - center[1]
+def orientationHomography(orientation, image_shape):
+    """
+    Fold the orientation into a homography to the image, instead of restoring the pixels of the image
+    :param image_shape: The shape of the image before restoring
+    :return: 3 x 3 matrix from (col, row, 1) of the image of restoreOrientation to (col, row, 1) of the image
+    """
+    rows, cols = image_shape[0:2]
+    # col, row of the image by col', row' of the restored image - [[col by col', col by row', col offset], ...]
+    if orientation == 2:
+        matrix = [[-1, 0, cols - 1], [0, 1, 0]]
+    elif orientation == 3:
+        matrix = [[-1, 0, cols - 1], [0, -1, rows - 1]]
+    elif orientation == 4:
+        matrix = [[1, 0, 0], [0, -1, rows - 1]]
+    elif orientation == 5:
+        matrix = [[0, 1, 0], [1, 0, 0]]
+    elif orientation == 6:
+        matrix = [[0, -1, cols - 1], [1, 0, 0]]
+    elif orientation == 7:
+        matrix = [[0, -1, cols - 1], [-1, 0, rows - 1]]
+    elif orientation == 8:
+        matrix = [[0, 1, 0], [-1, 0, rows - 1]]
+    else:
+        matrix = [[1, 0, 0], [0, 1, 0]]
 
-    # perform the actual rotation and return the image
-    rotated_mat = cv2.warpAffine(image, rotation_mat, (bound_w, bound_h))
-    return rotated_mat
+    return np.array(matrix + [[0, 0, 1]], dtype=np.float64)
 
 def get_metadata(input_file, os_name):
+    """
+    :param input_file: A path of an image, or bytes of an image which are parsed by parse_metadata
+    :param os_name: Linux - read by pyexiv2, otherwise by parse_metadata
+    :return: ImageMetadata of the image
+    """
+    if isinstance(input_file, (bytes, bytearray, memoryview)):
+        return parse_metadata(input_file)
+
     if os_name == "Linux":
         meta = metadata.ImageMetadata(input_file)
         meta.read()
+        return create_image_metadata(lambda key: meta[key].value)
 
-        focal_length = convert_fractions_to_float(meta['Exif.Photo.FocalLength'].value) / 1000  # unit: m
-        orientation = meta['Exif.Image.Orientation'].value
-        uuid = meta['Xmp.DLS.FrameID'].value
-        task_id = meta['Xmp.DLS.TaskID'].value
-        maker = meta["Exif.Image.Make"].value
-
-        # longitude = convert_dms_to_deg(meta["Exif.GPSInfo.GPSLongitude"].value)
-        # latitude = convert_dms_to_deg(meta["Exif.GPSInfo.GPSLatitude"].value)
-        longitude = float(meta["Xmp.DLS.GPSLongitude"].value)
-        latitude = float(meta["Xmp.DLS.GPSLatitude"].value)
-
-        if maker == "DJI":
-            altitude = float(meta['Xmp.drone-dji.RelativeAltitude'].value)
-            roll = float(meta['Xmp.drone-dji.GimbalRollDegree'].value)
-            pitch = float(meta['Xmp.drone-dji.GimbalPitchDegree'].value)
-            yaw = float(meta['Xmp.drone-dji.GimbalYawDegree'].value)
-        elif maker == "samsung" or maker == "LGE":
-            altitude = convert_fractions_to_float(meta['Exif.GPSInfo.GPSAltitude'].value)
-            roll = float(meta['Xmp.DLS.Roll'].value) * 180 / np.pi
-            pitch = float(meta['Xmp.DLS.Pitch'].value) * 180 / np.pi
-            yaw = float(meta['Xmp.DLS.Yaw'].value) * 180 / np.pi
-
-            before_longitude = float(meta["Xmp.DLS.BeforeGPSLongitude"].value)
-            before_latitude = float(meta["Xmp.DLS.BeforeGPSLatitude"].value)
-            # before_altitude = float(meta["Xmp.DLS.BeforeGPSAltitude"].value)
-        else:
-            altitude = 0
-            roll = 0
-            pitch = 0
-            yaw = 0
-
-        before_lonlat = np.array([before_longitude, before_latitude])
-        eo = np.array([longitude, latitude, altitude, roll, pitch, yaw])
-    else:
-        exe = "exiftool.exe"
-
-        process = subprocess.Popen([exe, input_file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        meta = process.stdout.read().decode()
-        focal_length_field = meta.find("Focal Length")
-        orientation_field = meta.find("Orientation")
-
-        focal_length_value = float(meta[focal_length_field + 34:focal_length_field + 34 + 6].split(" ")[0])  # mm
-        focal_length = focal_length_value / 1000  # m
-
-        try:
-            orientation_value = meta[orientation_field + 34:orientation_field + 34 + 20].split(" ")[0]
-            if orientation_value == "Horizontal":
-                orientation = 0
-        except:
-            orientation = 0
-
-        """ GPS Longitude """
-        longitude_field = "-gpslongitude"
-        process = subprocess.Popen([exe, longitude_field, input_file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        meta = process.stdout.read().decode()
-
-        start = meta.find(":")
-        deg = meta.find("deg")
-        min = meta.find("'")
-        sec = meta.find("\"")
-
-        lon_deg_value = float(meta[start + 2:deg - 1])
-        lon_min_value = float(meta[deg + 4:min])
-        lon_sec_value = float(meta[min + 2:sec])
-        lon_value = lon_deg_value + lon_min_value / 60 + lon_sec_value / 3600
+    # Read the file once, instead of running exiftool for each tag
+    with open(input_file, 'rb') as f:
+        return parse_metadata(f.read())
 
-        """ GPS Latitude """
-        latitude_field = "-gpslatitude"
-        process = subprocess.Popen([exe, latitude_field, input_file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        meta = process.stdout.read().decode()
 
-        start = meta.find(":")
-        deg = meta.find("deg")
-        min = meta.find("'")
-        sec = meta.find("\"")
-
-        lat_deg_value = float(meta[start + 2:deg - 1])
-        lat_min_value = float(meta[deg + 4:min])
-        lat_sec_value = float(meta[min + 2:sec])
-        lat_value = lat_deg_value + lat_min_value / 60 + lat_sec_value / 3600
-
-        """" GPS Altitude """
-        altitude_field = "-relativealtitude"
-        process = subprocess.Popen([exe, altitude_field, input_file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        meta = process.stdout.read().decode()
-
-        start = meta.find(":")
-        end = meta.find("\r")
-
-        alt_value = float(meta[start + 2:end])
-
-        """" Gimbal Roll Degree """
-        roll_field = "-gimbalrolldegree"
-        process = subprocess.Popen([exe, roll_field, input_file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        meta = process.stdout.read().decode()
-
-        start = meta.find(":")
-        end = meta.find("\r")
-
-        roll_value = float(meta[start + 2:end])
-
-        """" Gimbal Pitch Degree """
-        pitch_field = "-gimbalpitchdegree"
-        process = subprocess.Popen([exe, pitch_field, input_file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        meta = process.stdout.read().decode()
-
-        start = meta.find(":")
-        end = meta.find("\r")
-
-        pitch_value = float(meta[start + 2:end])
-
-        """" Gimbal Yaw Degree """
-        yaw_field = "-gimbalyawdegree"
-        process = subprocess.Popen([exe, yaw_field, input_file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        meta = process.stdout.read().decode()
-
-        start = meta.find(":")
-        end = meta.find("\r")
-
-        yaw_value = float(meta[start + 2:end])
-
-        eo = np.array([lon_value, lat_value, alt_value, roll_value, pitch_value, yaw_value])
+def create_image_metadata(value):
+    """
+    :param value: A function of a key of pyexiv2, e.g. Exif.Image.Make, to its value as pyexiv2 has
+                  - Fraction for rationals of EXIF, str for XMP - which raises KeyError if the image does not have it
+    :return: ImageMetadata
+    """
+    focal_length = convert_fractions_to_float(value('Exif.Photo.FocalLength')) / 1000  # unit: m
+    try:
+        orientation = value('Exif.Image.Orientation')
+    except KeyError:
+        orientation = 0
+    uuid = value('Xmp.DLS.FrameID')
+    task_id = value('Xmp.DLS.TaskID')
+    maker = value("Exif.Image.Make")
+
+    # longitude = convert_dms_to_deg(value("Exif.GPSInfo.GPSLongitude"))
+    # latitude = convert_dms_to_deg(value("Exif.GPSInfo.GPSLatitude"))
+    longitude = float(value("Xmp.DLS.GPSLongitude"))
+    latitude = float(value("Xmp.DLS.GPSLatitude"))
+    before_lonlat = np.array([np.nan, np.nan])
+
+    if maker == "DJI":
+        altitude = float(value('Xmp.drone-dji.RelativeAltitude'))
+        roll = float(value('Xmp.drone-dji.GimbalRollDegree'))
+        pitch = float(value('Xmp.drone-dji.GimbalPitchDegree'))
+        yaw = float(value('Xmp.drone-dji.GimbalYawDegree'))
+    elif maker == "samsung" or maker == "LGE":
+        altitude = convert_fractions_to_float(value('Exif.GPSInfo.GPSAltitude'))
+        roll = float(value('Xmp.DLS.Roll')) * 180 / np.pi
+        pitch = float(value('Xmp.DLS.Pitch')) * 180 / np.pi
+        yaw = float(value('Xmp.DLS.Yaw')) * 180 / np.pi
+
+        before_lonlat[0] = float(value("Xmp.DLS.BeforeGPSLongitude"))
+        before_lonlat[1] = float(value("Xmp.DLS.BeforeGPSLatitude"))
+        # before_altitude = float(value("Xmp.DLS.BeforeGPSAltitude"))
+    else:
+        altitude = 0
+        roll = 0
+        pitch = 0
+        yaw = 0
+
+    eo = np.array([longitude, latitude, altitude, roll, pitch, yaw])
+    return ImageMetadata(focal_length, orientation, eo, before_lonlat, uuid, task_id, maker)
+
+
+def parse_metadata(image_bytes):
+    """
+    Parse EXIF and XMP of an image in memory, without reading the file again or running a process
+    Only the segments before the compressed data of a JPEG are read, and only the tags which IPOD takes are decoded
+    :param image_bytes: Bytes of a JPEG or a TIFF, e.g. the uploaded file, which are decoded by cv2.imdecode as well
+    :return: ImageMetadata, the same as of pyexiv2
+    """
+    image_bytes = memoryview(image_bytes)
+    values = {}
+    if image_bytes[0:4] in (b'II*\x00', b'MM\x00*'):
+        parse_tiff(image_bytes, values)
+    elif image_bytes[0:2] == b'\xff\xd8':
+        for marker, segment in jpeg_segments(image_bytes):
+            if marker != 0xE1:  # APP1
+                continue
+            if segment[0:6] == b'Exif\x00\x00':
+                parse_tiff(segment[6:], values)
+            elif segment[0:len(XMP_HEADER)] == XMP_HEADER:
+                parse_xmp(segment[len(XMP_HEADER):], values)
+    else:
+        raise ValueError('Not a JPEG or a TIFF')
+
+    def value(key):
+        if key not in values:
+            raise KeyError(key)
+        return values[key]
+    return create_image_metadata(value)
+
+
+def jpeg_segments(image_bytes):
+    """
+    :return: A generator of (marker, bytes of the segment) of a JPEG, until the start of the compressed data
+    """
+    offset = 2
+    while offset + 4 <= len(image_bytes):
+        if image_bytes[offset] != 0xFF:
+            raise ValueError('A marker of JPEG is expected at %d' % offset)
+        marker = image_bytes[offset + 1]
+        if marker == 0xFF:  # Fill byte
+            offset += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:    # Markers without segments
+            offset += 2
+            continue
+        if marker in (0xD9, 0xDA):  # EOI, SOS
+            return
+        length = struct.unpack_from('>H', image_bytes, offset + 2)[0]
+        yield marker, image_bytes[offset + 4:offset + 2 + length]
+        offset += 2 + length
+
+
+def parse_tiff(tiff, values):
+    """
+    Decode the tags of IFD0_TAGS, EXIF_TAGS and GPS_TAGS in a TIFF structure, e.g. EXIF of a JPEG, into values
+    """
+    endian = '<' if tiff[0:2] == b'II' else '>'
+    ifd0 = read_ifd(tiff, struct.unpack_from(endian + 'I', tiff, 4)[0], endian, IFD0_TAGS, values)
+    if 'Exif.Image.ExifTag' in ifd0:
+        read_ifd(tiff, ifd0['Exif.Image.ExifTag'], endian, EXIF_TAGS, values)
+    if 'Exif.Image.GPSTag' in ifd0:
+        read_ifd(tiff, ifd0['Exif.Image.GPSTag'], endian, GPS_TAGS, values)
+    if 'Exif.Image.XMLPacket' in ifd0:
+        parse_xmp(bytes(ifd0['Exif.Image.XMLPacket']), values)
+
+
+def read_ifd(tiff, offset, endian, tags, values):
+    """
+    :param tags: Tags to decode -> keys of pyexiv2
+    :return: values, with the decoded tags of the IFD - str for ASCII, Fraction for rationals,
+             and a tuple if a tag has more than a value
+    """
+    num_entries = struct.unpack_from(endian + 'H', tiff, offset)[0]
+    for i in range(num_entries):
+        tag, tiff_type, count, value_offset = struct.unpack_from(endian + 'HHI4s', tiff, offset + 2 + 12 * i)
+        if tag not in tags or tiff_type not in TIFF_TYPES:
+            continue
+        value_format, value_size = TIFF_TYPES[tiff_type]
+        if value_size * count > 4:
+            start = struct.unpack_from(endian + 'I', value_offset)[0]
+            data = tiff[start:start + value_size * count]
+        else:
+            data = value_offset
 
-    return focal_length, orientation, eo, before_lonlat, uuid, task_id, maker
+        if tag == 0x02BC:   # XMP packet of a TIFF
+            value = bytes(data[0:value_size * count])
+        elif tiff_type == 2:
+            value = bytes(data[0:count]).split(b'\x00')[0].decode(errors='replace').strip()
+        else:
+            value = struct.unpack_from(endian + value_format * count, data)
+            if tiff_type in (5, 10):
+                value = tuple(Fraction(value[j], value[j + 1]) if value[j + 1] else Fraction(0)
+                              for j in range(0, len(value), 2))
+            value = value[0] if len(value) == 1 else value
+        values[tags[tag]] = value
+    return values
+
+
+def parse_xmp(packet, values):
+    """
+    Decode properties of DLS and drone-dji in an XMP packet into values, as Xmp.DLS.FrameID and so on
+    """
+    for prefix, name, attribute, element in XMP_PROPERTY.findall(bytes(packet)):
+        value = attribute or element
+        values['Xmp.%s.%s' % (prefix.decode(), name.decode())] = unescape(value.decode(), {'&quot;': '"'}).strip()
 
 def convert_fractions_to_float(fraction):
     return fraction.numerator / fraction.denominator
@@ -0,0 +1,210 @@
+"""
+A live mosaic of a project, which composites orthophotos into a sparse canvas of XYZ tiles in EPSG:3857
+Only tiles which an orthophoto touches are updated, and they are tracked as dirty until flush
+Tiles in memory are bounded by an LRU, and the least recently used ones are spilled to disk
+Changed tiles are saved to disk as well on flush, so the mosaic resumes from the last flush after a restart
+"""
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+from server.image_processing.orthophoto_generation.Tiles import TILE_SIZE, resolution, tile_bounds, tile_range, \
+    warp_to_tiles, downsample
+
+BLENDING = ['last', 'nadir', 'feather']
+
+
+class Mosaic:
+    def __init__(self, path, zoom, min_zoom, blending='last', max_tiles=512, feather_width=32, max_pixels=None):
+        """
+        :param path: The directory to spill tiles
+        :param zoom: The zoom level which orthophotos are composited at
+        :param min_zoom: The lowest zoom level of overviews
+        :param blending: last - the last orthophoto wins,
+                         nadir - the orthophoto whose nadir is the closest to the pixel wins,
+                         feather - the last orthophoto is blended over the mosaic along its boundary
+        :param max_tiles: The maximum number of tiles in memory
+        :param feather_width: The width of blending along the boundary of an orthophoto for feather, px
+        :param max_pixels: The maximum pixels of an orthophoto resampled at zoom at once, None: unlimited
+        """
+        if blending not in BLENDING:
+            raise ValueError('Unknown blending: %s' % blending)
+        self.path = path
+        self.zoom = zoom
+        self.min_zoom = min_zoom
+        self.blending = blending
+        self.max_tiles = max_tiles
+        self.feather_width = feather_width
+        self.max_pixels = max_pixels
+
+        self.lock = threading.Lock()
+        self.tiles = OrderedDict()  # (z, x, y) -> BGRA, and distance to the nadir for nadir
+        self.dirty = set()          # (x, y) of tiles at zoom, which changed since the last flush
+
+    def add(self, orthophoto, geotransform, nadir=None):
+        """
+        Composite an orthophoto into the mosaic
+        Tiles are resampled in blocks of at most max_pixels, as the footprint of an oblique orthophoto at zoom
+        may be far larger than the orthophoto itself
+        :param orthophoto: An orthophoto in EPSG:3857 - rows x cols x 4(BGRA)
+        :param geotransform: GDAL-style geotransform of the orthophoto - (xmin, gsd, 0, ymax, 0, -gsd)
+        :param nadir: X, Y of the nadir point of the orthophoto in EPSG:3857, for nadir
+        :return: The number of updated tiles
+        """
+        x0, y0, x1, y1 = tile_range(geotransform, orthophoto.shape[0], orthophoto.shape[1], self.zoom)
+        if self.max_pixels is None:
+            block_cols, block_rows = x1 - x0, y1 - y0
+        else:
+            # At least a tile
+            block_cols = min(x1 - x0, max(1, self.max_pixels // TILE_SIZE ** 2))
+            block_rows = min(y1 - y0, max(1, self.max_pixels // (block_cols * TILE_SIZE ** 2)))
+
+        if self.blending == 'feather':
+            # Weight of the orthophoto grows from 0 on its boundary to 1 at feather_width inside, px of zoom
+            # It is measured on the orthophoto, not to end on the boundary of blocks
+            covered = cv2.copyMakeBorder((orthophoto[:, :, 3] > 0).astype(np.uint8), 1, 1, 1, 1,
+                                         cv2.BORDER_CONSTANT, value=0)
+            distance = cv2.distanceTransform(covered, cv2.DIST_L2, 3)[1:-1, 1:-1]
+            feather = np.minimum(distance * (geotransform[1] / resolution(self.zoom)) / self.feather_width,
+                                 1).astype(np.float32)
+
+        updated = 0
+        for block_y in range(y0, y1, block_rows):
+            for block_x in range(x0, x1, block_cols):
+                block = (block_x, block_y, min(block_x + block_cols, x1), min(block_y + block_rows, y1))
+                updated += self._add_block(orthophoto, geotransform, block, nadir,
+                                           feather if self.blending == 'feather' else None)
+        return updated
+
+    def _add_block(self, orthophoto, geotransform, block, nadir, feather):
+        canvas, (x0, y0, x1, y1) = warp_to_tiles(orthophoto, geotransform, self.zoom, cv2.INTER_NEAREST, block)
+        alpha = canvas[:, :, 3]
+
+        if self.blending == 'nadir':
+            # Distance from the center of each pixel to the nadir, m
+            res = resolution(self.zoom)
+            tile_xmin, _, _, tile_ymax = tile_bounds(self.zoom, x0, y0)
+            # Coordinates relative to the nadir, as float32 of EPSG:3857 are too coarse
+            xs = np.float32(tile_xmin - nadir[0]) + (np.arange(canvas.shape[1], dtype=np.float32) + 0.5) * res
+            ys = np.float32(tile_ymax - nadir[1]) - (np.arange(canvas.shape[0], dtype=np.float32) + 0.5) * res
+            weights = np.sqrt(xs[np.newaxis, :] ** 2 + ys[:, np.newaxis] ** 2)
+        elif self.blending == 'feather':
+            weights = warp_to_tiles(feather, geotransform, self.zoom, cv2.INTER_NEAREST, block)[0]
+        else:
+            weights = None
+
+        updated = 0
+        with self.lock:
+            for y in range(y0, y1):
+                for x in range(x0, x1):
+                    rows = slice((y - y0) * TILE_SIZE, (y - y0 + 1) * TILE_SIZE)
+                    cols = slice((x - x0) * TILE_SIZE, (x - x0 + 1) * TILE_SIZE)
+                    if not alpha[rows, cols].any():
+                        continue
+                    self._composite((x, y), canvas[rows, cols], None if weights is None else weights[rows, cols])
+                    self.dirty.add((x, y))
+                    updated += 1
+        return updated
+
+    def _composite(self, key, new, weights):
+        tile = self._get((self.zoom,) + key, create=True)
+        bgra = tile[0]
+        covered = new[:, :, 3] > 0
+
+        if self.blending == 'nadir':
+            distance = tile[1]
+            closer = covered & (weights < distance)
+            bgra[closer] = new[closer]
+            distance[closer] = weights[closer]
+        elif self.blending == 'feather':
+            # Pixels which are not in the mosaic yet take the orthophoto as it is
+            w = np.where(bgra[:, :, 3] > 0, weights, 1)[:, :, np.newaxis]
+            w[~covered] = 0
+            bgra[:] = (bgra * (1 - w) + new * w + 0.5).astype(np.uint8)
+        else:
+            bgra[covered] = new[covered]
+
+    def flush(self):
+        """
+        Update overviews of dirty tiles, save the changed tiles to disk, and clear the dirty tiles
+        :return: A list of ((z, x, y), BGRA) of the tiles which changed since the last flush, from zoom to min_zoom
+        """
+        with self.lock:
+            changed = []
+            dirty = self.dirty
+            self.dirty = set()
+            for z in range(self.zoom, self.min_zoom - 1, -1):
+                if z < self.zoom:
+                    dirty = {(x // 2, y // 2) for x, y in dirty}
+                    for x, y in dirty:
+                        self._put((z, x, y), self._overview(z, x, y))
+                for x, y in sorted(dirty):
+                    changed.append(((z, x, y), self._get((z, x, y))[0].copy()))
+            # A tile out of memory was spilled as it is now, as tiles only change in memory
+            for key, _ in changed:
+                if key in self.tiles:
+                    self._spill(key, self.tiles[key])
+            return changed
+
+    def tile(self, z, x, y):
+        """
+        :return: BGRA of a tile, or None if the mosaic does not cover it
+        """
+        with self.lock:
+            tile = self._get((z, x, y))
+            return None if tile is None else tile[0].copy()
+
+    def _overview(self, z, x, y):
+        canvas = np.zeros((2 * TILE_SIZE, 2 * TILE_SIZE, 4), dtype=np.uint8)
+        for dy in range(2):
+            for dx in range(2):
+                child = self._get((z + 1, 2 * x + dx, 2 * y + dy))
+                if child is not None:
+                    canvas[dy * TILE_SIZE:(dy + 1) * TILE_SIZE, dx * TILE_SIZE:(dx + 1) * TILE_SIZE] = child[0]
+        overview, _ = downsample(canvas, (2 * x, 2 * y, 2 * x + 2, 2 * y + 2))
+        return (overview,)
+
+    def _tile_path(self, key):
+        z, x, y = key
+        return os.path.join(self.path, str(z), str(x), '%d.npz' % y)
+
+    def _get(self, key, create=False):
+        """
+        Get a tile from memory or disk, with self.lock held
+        :return: A tuple of arrays of the tile - (BGRA,) or (BGRA, distance to the nadir)
+        """
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            return tile
+
+        tile_path = self._tile_path(key)
+        if os.path.exists(tile_path):
+            with np.load(tile_path) as arrays:
+                tile = tuple(arrays['arr_%d' % i] for i in range(len(arrays.files)))
+        elif create:
+            tile = (np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8),)
+            if self.blending == 'nadir':
+                tile += (np.full((TILE_SIZE, TILE_SIZE), np.inf, dtype=np.float32),)
+        else:
+            return None
+        self._put(key, tile)
+        return tile
+
+    def _put(self, key, tile):
+        self.tiles[key] = tile
+        self.tiles.move_to_end(key)
+        while len(self.tiles) > self.max_tiles:
+            spilled_key, spilled_tile = self.tiles.popitem(last=False)
+            self._spill(spilled_key, spilled_tile)
+
+    def _spill(self, key, tile):
+        tile_path = self._tile_path(key)
+        os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+        # Write to a temporary file and rename, not to leave a broken tile
+        with open(tile_path + '.tmp', 'wb') as f:
+            np.savez(f, *tile)
+        os.replace(tile_path + '.tmp', tile_path)
+
@@ -4,15 +4,94 @@ import cv2
 import time
 from osgeo import ogr
 from osgeo import gdal
-from server.image_processing.orthophoto_generation.ExifData import restoreOrientation, getExif
+from server.image_processing.orthophoto_generation.ExifData import restoreOrientation, orientationHomography, getExif
 from server.image_processing.orthophoto_generation.EoData import geographic2plane, Rot3D
 from server.image_processing.orthophoto_generation.Boundary import boundary, export_bbox_to_wkt3
 from server.image_processing.orthophoto_generation.BackprojectionResample import projectedCoord, backProjection, \
-    resample, resample_thermal, create_pnga
+    resample, resample_thermal, create_pnga, fusedResample, fusedResample_thermal, projectedCoord_parallel, \
+    resample_parallel, resample_thermal_parallel, fusedResample_parallel, fusedResample_thermal_parallel, \
+    parallel_section, homography, warpResample, warpResample_thermal, remapResample, remapResample_thermal, \
+    RESAMPLING
+from server.image_processing.orthophoto_generation.Dem import demBoundary, demMaps, demMapsMargin
+
+SERIAL_KERNELS = {
+    'projectedCoord': projectedCoord,
+    'resample': resample,
+    'resample_thermal': resample_thermal,
+    'fusedResample': fusedResample,
+    'fusedResample_thermal': fusedResample_thermal
+}
+PARALLEL_KERNELS = {
+    'projectedCoord': projectedCoord_parallel,
+    'resample': resample_parallel,
+    'resample_thermal': resample_thermal_parallel,
+    'fusedResample': fusedResample_parallel,
+    'fusedResample_thermal': fusedResample_thermal_parallel
+}
+
+
+def rectifyBytesPerPixel(method, img_type, channels=3, dem=None, resampling='nearest', orientation=1):
+    """
+    Bytes held per pixel of the orthophoto at the peak of rectify_SIC, without the image
+    The maps over a DEM are resized from blocks with a margin around the orthophoto, from demMapsMargin
+    :param channels: The number of channels of the image, which a thermal orthophoto keeps
+    :param orientation: Orientation of EXIF of the image, as rectify_SIC
+    :return: Bytes of the orthophoto and the arrays of the size of the orthophoto which are held at once
+    """
+    folded = orientation not in (0, 1) and (dem is not None or method == 'homography')
+    if img_type == 0:
+        # BGRA, and its alpha which is thresholded after interpolation
+        output = 4 if resampling == 'nearest' else 5
+    else:
+        # Of the image in uint8, which is converted to float64
+        output = 9 * channels
+    if dem is not None:
+        # map_x, map_y of float32, and the products and the sums of them while the orientation is folded,
+        # or the maps shifted by the border of the image while BGRA is interpolated
+        shifted = 8 if img_type == 0 and resampling != 'nearest' else 0
+        return 8 + max(16 if folded else 0, shifted + output)
+    if method == 'three_stage':
+        # 3 x (row x col) projected coordinates, and 3 x (row x col) coordinates in the camera, the scale and
+        # 2 x (row x col) coordinates on the plane, in px and in the image of backProjection, of float64
+        return 24 + 24 + 8 + 16 + 16 + 16
+    if method == 'fused' and img_type == 1:
+        return 8    # gray of float64
+    return output
+
+
+def budgetGsd(bbox, gsd, max_pixels, margin=0):
+    """
+    Coarsen a GSD until the orthophoto of a boundary box fits in a number of pixels
+    :param bbox: Boundary box - 4 x 1, xmin, xmax, ymin, ymax
+    :param gsd: GSD of the orthophoto, m/px
+    :param max_pixels: The maximum pixels of the orthophoto, None: unlimited
+    :param margin: Rows and columns which are counted along with the ones of the orthophoto, px
+    :return: The GSD, which is gsd if the orthophoto fits already
+    """
+    if max_pixels is None:
+        return gsd
+    width = bbox[1, 0] - bbox[0, 0]
+    height = bbox[3, 0] - bbox[2, 0]
+
+    def pixels(gsd):
+        return (int(width / gsd) + margin) * (int(height / gsd) + margin)
+
+    if pixels(gsd) > max_pixels:
+        # (width / gsd + margin) x (height / gsd + margin) = max_pixels, for 1 / gsd
+        a = width * height
+        b = margin * (width + height)
+        c = margin * margin - max_pixels
+        gsd = 2 * a / max(-b + np.sqrt(b * b - 4 * a * c), 1e-12)
+        # Rounding of the scale, which int() of the size absorbs mostly
+        while pixels(gsd) > max_pixels and (int(width / gsd) > 0 or int(height / gsd) > 0):
+            gsd *= 1 + 1e-6
+    return gsd
 
 
 def rectify_SIC(output_path, img_fname, restored_image, focal_length, pixel_size,
-             eo, R_GC, ground_height, epsg, img_type, gsd='auto'):
+             eo, R_GC, ground_height, epsg, img_type, gsd='auto', method='homography',
+                num_threads=None, resampling='nearest', camera=None, dem=None, dem_step=8,
+                orientation=1, max_pixels=None, max_bytes=None):
     """
     Rectifies a given drone image on a reference plane
     :param output_path: A path which an individual orthophoto will be generated
@@ -26,69 +105,188 @@ def rectify_SIC(output_path, img_fname, restored_image, focal_length, pixel_size
     :param epsg: An EPSG number of a coordinate system of a generated individual orthophoto
     :param img_type: A type of the image - 0: optical, 1: thermal
     :param gsd: Ground Sampling Distance of a raw image
-    :return: Boundary box of a generated orthophoto in wkt format
+    :param method: 'homography' - resample through a planar homography of the ground plane by OpenCV,
+                   'fused' - project and resample in a single pass,
+                   'three_stage' - projectedCoord -> backProjection -> resample
+    :param num_threads: The number of threads for row-parallel kernels - None: all cores, 1: single-threaded
+    :param resampling: nearest, bilinear or bicubic
+    :param camera: FrameGeometry of the camera for the size of the image, to reuse its constants
+                   None: computed from focal_length and pixel_size
+    :param dem: Dem of the terrain, to rectify over it instead of a flat ground of ground_height
+                ground_height is the height of the ground out of the DEM then, and method is not used
+    :param dem_step: Pixels of every dem_step x dem_step block of the orthophoto are back-projected at once
+                     over the DEM, and interpolated between the blocks - 1: every pixel
+    :param orientation: Orientation of EXIF of restored_image, which is not restored yet - 1: already restored
+                        It is folded into the homography or the maps of the DEM, without restoring the pixels,
+                        and restoreOrientation restores the pixels for the other methods
+    :param max_pixels: The maximum pixels of the orthophoto, None: unlimited
+    :param max_bytes: The maximum bytes of the orthophoto and the arrays of its size, None: unlimited
+                      gsd is coarsened to fit in both, so that an oblique or a high frame does not run out of memory
+    :return: Boundary box of a generated orthophoto in wkt format, the orthophoto,
+             GDAL-style geotransform of the orthophoto - (xmin, gsd, 0, ymax, 0, -gsd), with the GSD of the budget
     """
 
     rectify_time = time.time()
 
     dst = os.path.join(output_path, img_fname.split(".")[0])
 
+    if orientation not in (0, 1) and (dem is not None or method == 'homography'):
+        # Pixels are resampled from the image as it is, by the homography or the maps to the restored image
+        image = restored_image
+        restored_image = restoreOrientation(image, orientation, view=True)     # Only for the shape
+        O = orientationHomography(orientation, image.shape)
+    else:
+        restored_image = restoreOrientation(restored_image, orientation)
+        image, O = restored_image, None
+
     # 2. Extract a projected boundary of the image
     print('boundary')
     start_time = time.time()
-    bbox, proj_bbox = boundary(restored_image, eo, R_GC, ground_height, pixel_size, focal_length)   # 4x1, 4x3
+    if dem is not None:
+        bbox, proj_bbox, center_height = demBoundary(dem, restored_image.shape, eo, R_GC, pixel_size, focal_length,
+                                                     ground_height)
+    elif camera is None:
+        bbox, proj_bbox = boundary(restored_image, eo, R_GC, ground_height, pixel_size, focal_length)   # 4x1, 4x2
+    else:
+        bbox, proj_bbox = camera.boundary(eo, R_GC, ground_height)
     print("--- %s seconds ---" % (time.time() - start_time))
 
     if gsd == 'auto':
-        gsd = (pixel_size * (eo[2] - ground_height)) / focal_length  # unit: m/px
+        # At the height of the ground under the center of the image over the DEM
+        reference_height = ground_height if dem is None else center_height
+        if camera is None:
+            gsd = (pixel_size * (eo[2] - reference_height)) / focal_length  # unit: m/px
+        else:
+            gsd = camera.gsd(eo, reference_height)
+
+    budget_gsd = budgetGsd(bbox, gsd, max_pixels)
+    if max_bytes is not None:
+        channels = 1 if restored_image.ndim == 2 else restored_image.shape[2]
+        bytes_per_pixel = rectifyBytesPerPixel(method, img_type, channels, dem, resampling, orientation)
+        margin = 0 if dem is None else demMapsMargin(dem_step)
+        budget_gsd = budgetGsd(bbox, budget_gsd, max_bytes // bytes_per_pixel, margin)
+    if budget_gsd != gsd:
+        print(' * GSD %f m/px is coarsened to %f m/px for the budget of %s px and %s bytes'
+              % (gsd, budget_gsd, max_pixels, max_bytes))
+        gsd = budget_gsd
 
     # Boundary size
     boundary_cols = int((bbox[1, 0] - bbox[0, 0]) / gsd)
     boundary_rows = int((bbox[3, 0] - bbox[2, 0]) / gsd)
     print(boundary_rows, boundary_cols)
 
-    print('projectedCoord')
-    start_time = time.time()
-    proj_coords = projectedCoord(bbox, boundary_rows, boundary_cols, gsd, eo, ground_height)
-    print("--- %s seconds ---" % (time.time() - start_time))
-
-    # Image size
-    image_size = np.reshape(restored_image.shape[0:2], (2, 1))
-
-    print('backProjection')
-    start_time = time.time()
-    backProj_coords = backProjection(proj_coords, R_GC, focal_length, pixel_size, image_size)
-    print("--- %s seconds ---" % (time.time() - start_time))
-
-    if img_type == 0:
-        print('resample - optical')
+    if dem is not None:
+        print('demMap')
         start_time = time.time()
-        b, g, r, a = resample(backProj_coords, boundary_rows, boundary_cols, restored_image)
+        with parallel_section(num_threads):
+            map_x, map_y = demMaps(dem, bbox, boundary_rows, boundary_cols, gsd, eo, R_GC, focal_length, pixel_size,
+                                   restored_image.shape, ground_height, dem_step, num_threads)
+            if O is not None:
+                O_32 = O.astype(np.float32)    # Maps of cv2.remap are float32
+                map_x, map_y = O_32[0, 0] * map_x + O_32[0, 1] * map_y + O_32[0, 2], \
+                               O_32[1, 0] * map_x + O_32[1, 1] * map_y + O_32[1, 2]
         print("--- %s seconds ---" % (time.time() - start_time))
 
-        # print('Save the image in png')
-        # start_time = time.time()
-        # create_pnga(b, g, r, a, bbox, gsd, epsg, dst)
-        # print("--- %s seconds ---" % (time.time() - start_time))
-
-        print('Merge each band(b, g, r, a)')
+        print('remapResample')
         start_time = time.time()
-        orthophoto_array = cv2.merge((b, g, r, a))
+        if img_type == 0:
+            orthophoto_array = remapResample(map_x, map_y, image, resampling)
+        elif img_type == 1:
+            orthophoto_array = remapResample_thermal(map_x, map_y, image, resampling)
+        else:
+            return
         print("--- %s seconds ---" % (time.time() - start_time))
-
-        print('*** Processing time per each image')
-        print("--- %s seconds ---" % (time.time() - rectify_time))
-    elif img_type == 1:
-        print('resample - thermal')
+    elif method == 'homography':
+        print('homography')
         start_time = time.time()
-        gray = resample_thermal(backProj_coords, boundary_rows, boundary_cols, restored_image)
-        orthophoto_array = gray
+        if camera is None:
+            H = homography(bbox, gsd, eo, ground_height, R_GC, focal_length, pixel_size, restored_image.shape)
+        else:
+            H = camera.homography(bbox, gsd, eo, ground_height, R_GC)
+        if O is not None:
+            H = O @ H
         print("--- %s seconds ---" % (time.time() - start_time))
 
-        print('*** Processing time per each image')
-        print("--- %s seconds ---" % (time.time() - rectify_time))
+        if img_type == 0:
+            print('warpResample - optical')
+            start_time = time.time()
+            orthophoto_array = warpResample(H, boundary_rows, boundary_cols, image, resampling)
+            print("--- %s seconds ---" % (time.time() - start_time))
+        elif img_type == 1:
+            print('warpResample - thermal')
+            start_time = time.time()
+            orthophoto_array = warpResample_thermal(H, boundary_rows, boundary_cols, image, resampling)
+            print("--- %s seconds ---" % (time.time() - start_time))
+        else:
+            return
     else:
-        return
+        # Kernels running on a single core or row-parallel on num_threads cores
+        if num_threads == 1:
+            kernels = SERIAL_KERNELS
+        else:
+            kernels = PARALLEL_KERNELS
+
+        with parallel_section(num_threads):
+            if method == 'fused':
+                if img_type == 0:
+                    print('fusedResample - optical')
+                    start_time = time.time()
+                    orthophoto_array = kernels['fusedResample'](bbox, boundary_rows, boundary_cols, gsd, eo,
+                                                                ground_height, R_GC, focal_length, pixel_size,
+                                                                restored_image, RESAMPLING[resampling])
+                    print("--- %s seconds ---" % (time.time() - start_time))
+                elif img_type == 1:
+                    print('fusedResample - thermal')
+                    start_time = time.time()
+                    orthophoto_array = kernels['fusedResample_thermal'](bbox, boundary_rows, boundary_cols, gsd, eo,
+                                                                        ground_height, R_GC, focal_length, pixel_size,
+                                                                        restored_image, RESAMPLING[resampling])
+                    print("--- %s seconds ---" % (time.time() - start_time))
+                else:
+                    return
+            else:
+                print('projectedCoord')
+                start_time = time.time()
+                proj_coords = kernels['projectedCoord'](bbox, boundary_rows, boundary_cols, gsd, eo, ground_height)
+                print("--- %s seconds ---" % (time.time() - start_time))
+
+                # Image size
+                image_size = np.reshape(restored_image.shape[0:2], (2, 1))
+
+                print('backProjection')
+                start_time = time.time()
+                backProj_coords = backProjection(proj_coords, R_GC, focal_length, pixel_size, image_size)
+                print("--- %s seconds ---" % (time.time() - start_time))
+
+                if img_type == 0:
+                    print('resample - optical')
+                    start_time = time.time()
+                    b, g, r, a = kernels['resample'](backProj_coords, boundary_rows, boundary_cols, restored_image,
+                                                     RESAMPLING[resampling])
+                    print("--- %s seconds ---" % (time.time() - start_time))
+
+                    # print('Save the image in png')
+                    # start_time = time.time()
+                    # create_pnga(b, g, r, a, bbox, gsd, epsg, dst)
+                    # print("--- %s seconds ---" % (time.time() - start_time))
+
+                    print('Merge each band(b, g, r, a)')
+                    start_time = time.time()
+                    orthophoto_array = cv2.merge((b, g, r, a))
+                    print("--- %s seconds ---" % (time.time() - start_time))
+                elif img_type == 1:
+                    print('resample - thermal')
+                    start_time = time.time()
+                    gray = kernels['resample_thermal'](backProj_coords, boundary_rows, boundary_cols,
+                                                       restored_image, RESAMPLING[resampling])
+                    orthophoto_array = gray
+                    print("--- %s seconds ---" % (time.time() - start_time))
+                else:
+                    return
+
+    print('*** Processing time per each image')
+    print("--- %s seconds ---" % (time.time() - rectify_time))
 
     bbox_wkt = export_bbox_to_wkt3(proj_bbox)
-    return bbox_wkt, orthophoto_array
+    geotransform = (bbox[0, 0], gsd, 0, bbox[3, 0], 0, -gsd)
+    return bbox_wkt, orthophoto_array, geotransform
@@ -0,0 +1,159 @@
+"""
+XYZ tiles of orthophotos in EPSG:3857 (web mercator)
+A tile (z, x, y) is 256 x 256 px, x grows to the east and y grows to the south from the north-west corner of the world
+"""
+import math
+import os
+import numpy as np
+import cv2
+
+TILE_SIZE = 256
+ORIGIN_SHIFT = 20037508.342789244   # m, half of the circumference of the earth in EPSG:3857
+
+
+def resolution(z):
+    """
+    :return: Ground size of a pixel of tiles at zoom level z, m/px
+    """
+    return 2 * ORIGIN_SHIFT / (TILE_SIZE * 2 ** z)
+
+
+def native_zoom(gsd):
+    """
+    :return: The highest zoom level whose resolution is coarser than or equal to gsd, so that tiles are not upsampled
+    """
+    # Tolerate rounding errors of gsd at a resolution of a zoom level
+    return int(math.floor(math.log2(2 * ORIGIN_SHIFT / (TILE_SIZE * gsd)) + 1e-9))
+
+
+def tile_bounds(z, x, y):
+    """
+    :return: xmin, ymin, xmax, ymax of a tile in EPSG:3857, m
+    """
+    size = TILE_SIZE * resolution(z)
+    xmin = -ORIGIN_SHIFT + x * size
+    ymax = ORIGIN_SHIFT - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+
+def tile_range(geotransform, rows, cols, z):
+    """
+    :param geotransform: GDAL-style geotransform of an orthophoto - (xmin, gsd, 0, ymax, 0, -gsd)
+    :return: The range of tiles which the orthophoto touches at zoom level z - x0, y0, x1, y1 (exclusive)
+    """
+    xmin, gsd, _, ymax, _, _ = geotransform
+    size = TILE_SIZE * resolution(z)
+    # Tolerate rounding errors of boundaries on the edges of tiles
+    eps = 1e-6
+    x0 = int(math.floor((xmin + ORIGIN_SHIFT) / size + eps))
+    y0 = int(math.floor((ORIGIN_SHIFT - ymax) / size + eps))
+    x1 = int(math.ceil((xmin + cols * gsd + ORIGIN_SHIFT) / size - eps))
+    y1 = int(math.ceil((ORIGIN_SHIFT - (ymax - rows * gsd)) / size - eps))
+    return x0, y0, max(x1, x0 + 1), max(y1, y0 + 1)
+
+
+def warp_to_tiles(orthophoto, geotransform, z, interpolation=cv2.INTER_LINEAR, tiles=None):
+    """
+    Resample an orthophoto onto the pixel grid of tiles at zoom level z
+    :param tiles: The range of tiles to resample - x0, y0, x1, y1 (exclusive), None: all tiles the orthophoto touches
+    :return: A canvas covering the tiles, and the range of the tiles
+    """
+    rows, cols = orthophoto.shape[0:2]
+    xmin, gsd, _, ymax, _, _ = geotransform
+    x0, y0, x1, y1 = tile_range(geotransform, rows, cols, z) if tiles is None else tiles
+    res = resolution(z)
+
+    # Pixel (u, v) of the canvas(its center) to pixel (col, row) of the orthophoto, in the center convention of OpenCV
+    scale = res / gsd
+    M = np.array([[scale, 0, (-ORIGIN_SHIFT + x0 * TILE_SIZE * res - xmin + 0.5 * res) / gsd - 0.5],
+                  [0, scale, (ymax - ORIGIN_SHIFT + y0 * TILE_SIZE * res + 0.5 * res) / gsd - 0.5]])
+    canvas = cv2.warpAffine(orthophoto, M, ((x1 - x0) * TILE_SIZE, (y1 - y0) * TILE_SIZE),
+                            flags=interpolation | cv2.WARP_INVERSE_MAP,
+                            borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return canvas, (x0, y0, x1, y1)
+
+
+def downsample(canvas, tiles):
+    """
+    Build the overview of a canvas at one lower zoom level by box-filtering 2 x 2 pixels
+    Colors are averaged with weights of alpha, not to darken the boundary of orthophotos
+    :param canvas: A canvas covering tiles - x0, y0, x1, y1 (exclusive)
+    :return: The canvas and the range of tiles at one lower zoom level
+    """
+    x0, y0, x1, y1 = tiles
+    # Align the canvas to tiles of the lower level, which cover 2 x 2 tiles
+    left = (x0 % 2) * TILE_SIZE
+    top = (y0 % 2) * TILE_SIZE
+    right = (x1 % 2) * TILE_SIZE
+    bottom = (y1 % 2) * TILE_SIZE
+    canvas = cv2.copyMakeBorder(canvas, top, bottom, left, right, cv2.BORDER_CONSTANT, value=0)
+    half = (canvas.shape[1] // 2, canvas.shape[0] // 2)
+
+    if canvas.ndim == 3 and canvas.shape[2] == 4:
+        # INTER_AREA by a half is the mean of 2 x 2 pixels
+        alpha = cv2.extractChannel(canvas, 3)
+        alpha3 = cv2.merge((alpha, alpha, alpha))
+        premultiplied = cv2.multiply(cv2.cvtColor(canvas, cv2.COLOR_BGRA2BGR), alpha3, dtype=cv2.CV_32F)
+        premultiplied = cv2.resize(premultiplied, half, interpolation=cv2.INTER_AREA)
+        alpha3 = cv2.resize(alpha3.astype(np.float32), half, interpolation=cv2.INTER_AREA)
+        # Division by alpha of 0 is 0
+        bgr = cv2.divide(premultiplied, alpha3, dtype=cv2.CV_8U)
+        overview = cv2.merge((bgr, cv2.convertScaleAbs(cv2.extractChannel(alpha3, 0))))
+    else:
+        overview = cv2.resize(canvas, half, interpolation=cv2.INTER_AREA)
+
+    return overview, (x0 // 2, y0 // 2, (x1 + 1) // 2, (y1 + 1) // 2)
+
+
+def is_empty(tile):
+    if tile.ndim == 3 and tile.shape[2] == 4:
+        return not tile[:, :, 3].any()
+    return not tile.any()
+
+
+def cut_tiles(orthophoto, geotransform, min_zoom, max_zoom, interpolation=cv2.INTER_LINEAR):
+    """
+    Cut an orthophoto into tiles from max_zoom to min_zoom
+    Tiles above the native zoom level of the orthophoto would be upsampled, so max_zoom is clamped to it
+    :param orthophoto: An orthophoto in EPSG:3857 - rows x cols x 4(BGRA) or rows x cols
+    :param geotransform: GDAL-style geotransform of the orthophoto - (xmin, gsd, 0, ymax, 0, -gsd)
+    :param min_zoom: The lowest zoom level
+    :param max_zoom: The highest zoom level
+    :return: A generator of ((z, x, y), tile), skipping empty tiles
+    """
+    max_zoom = max(min(max_zoom, native_zoom(geotransform[1])), min_zoom)
+    canvas, tiles = warp_to_tiles(orthophoto, geotransform, max_zoom, interpolation)
+
+    for z in range(max_zoom, min_zoom - 1, -1):
+        if z < max_zoom:
+            canvas, tiles = downsample(canvas, tiles)
+        x0, y0, x1, y1 = tiles
+        for y in range(y0, y1):
+            for x in range(x0, x1):
+                row = (y - y0) * TILE_SIZE
+                col = (x - x0) * TILE_SIZE
+                tile = canvas[row:row + TILE_SIZE, col:col + TILE_SIZE]
+                if not is_empty(tile):
+                    yield (z, x, y), tile
+
+
+def encode_tile(tile, tile_format='png'):
+    """
+    :param tile_format: png or webp(lossless)
+    :return: Bytes of the tile
+    """
+    if tile_format == 'webp':
+        return cv2.imencode('.webp', tile, [cv2.IMWRITE_WEBP_QUALITY, 101])[1].tobytes()
+    return cv2.imencode('.' + tile_format, tile)[1].tobytes()
+
+
+def save_tiles(tiles, tiles_path, tile_format='png'):
+    """
+    Save encoded tiles in the directory layout of XYZ tiles - tiles_path/z/x/y.tile_format
+    :param tiles: An iterable of ((z, x, y), bytes of a tile)
+    """
+    for (z, x, y), tile_bytes in tiles:
+        tile_dir = os.path.join(tiles_path, str(z), str(x))
+        os.makedirs(tile_dir, exist_ok=True)
+        with open(os.path.join(tile_dir, '%d.%s' % (y, tile_format)), 'wb') as f:
+            f.write(tile_bytes)
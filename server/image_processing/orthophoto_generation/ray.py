@@ -2,68 +2,281 @@
 ray.py
 ----------------
 
-Do simple mesh- ray queries. Base functionality only
-requires numpy, but if you install `pyembree` you get the
-same API with a roughly 50x speedup.
+Mesh-ray queries of a terrain mesh, e.g. an OBJ of a point cloud of the site
+The mesh is loaded once and its triangles are kept in a bounding volume hierarchy(BVH),
+which is saved next to the OBJ, so the OBJ is parsed and the BVH is built only at the first time
+Rays are traversed through the BVH by numba kernels, in parallel over rays
 """
-
-import trimesh
+import os
 import numpy as np
+from numba import jit, prange
 
-if __name__ == '__main__':
+from server.image_processing.orthophoto_generation.BackprojectionResample import parallel_section
 
-    # test on a sphere mesh
-    #mesh = trimesh.primitives.Sphere()
-    #mesh = trimesh.load('./models/cube_compressed.obj')
-    #mesh = trimesh.load('./models/cube.OBJ')
-    #mesh = trimesh.load('./models/cube_test.OBJ')
-    mesh = trimesh.load('./models/DEM_yeosu/34707 - Cloud.obj')
+BVH_ARRAYS = ['vertices', 'faces', 'node_min', 'node_max', 'node_child', 'node_first', 'node_count', 'order']
 
-    # create some rays
-    # DJI_0386.JPG in Data
-    ray_origins = np.array([[266277.339, 237080.832, 214.9540]])
-    direction = [1.697624393, - 2.926766149, - 54.16184732]
-    ray_directions = np.array([[0, 0, -1]])
 
+class Mesh:
+    def __init__(self, vertices, faces, bvh=None, leaf_size=4):
+        """
+        :param vertices: Vertices of the mesh - n x 3(X, Y, Z)
+        :param faces: Indices of vertices of triangles - m x 3
+        :param bvh: Arrays of the BVH of the mesh, from Mesh.open - None: built from the triangles
+        :param leaf_size: The maximum number of triangles in a leaf of the BVH
+        """
+        self.vertices = np.ascontiguousarray(vertices, dtype=np.float64)
+        self.faces = np.ascontiguousarray(faces, dtype=np.int32)
+        if bvh is None:
+            triangles = self.vertices[self.faces]   # m x 3(vertices) x 3(X, Y, Z)
+            bvh = buildBvh(triangles.min(axis=1), triangles.max(axis=1), triangles.mean(axis=1), leaf_size)
+        self.node_min, self.node_max, self.node_child, self.node_first, self.node_count, self.order = bvh
+
+        # Triangles in the order of leaves of the BVH, as a vertex and two edges for Moller-Trumbore
+        triangles = self.vertices[self.faces[self.order]]
+        self.v0 = np.ascontiguousarray(triangles[:, 0])
+        self.e1 = np.ascontiguousarray(triangles[:, 1] - triangles[:, 0])
+        self.e2 = np.ascontiguousarray(triangles[:, 2] - triangles[:, 0])
+
+    @classmethod
+    def open(cls, path, leaf_size=4):
+        """
+        Open an OBJ mesh, whose BVH is saved to a .bvh.npz next to it at the first time
+        :param path: A path of the OBJ
+        """
+        cache_path = os.path.splitext(path)[0] + '.bvh.npz'
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+            with np.load(cache_path) as arrays:
+                return cls(arrays['vertices'], arrays['faces'], tuple(arrays[name] for name in BVH_ARRAYS[2:]))
+
+        mesh = cls(*loadObj(path), leaf_size=leaf_size)
+        # Write to a temporary file and rename, not to leave a broken BVH
+        with open(cache_path + '.tmp', 'wb') as f:
+            np.savez(f, **{name: getattr(mesh, name) for name in BVH_ARRAYS})
+        os.replace(cache_path + '.tmp', cache_path)
+        return mesh
+
+    def intersect(self, origins, directions, num_threads=None):
+        """
+        Intersect rays with the mesh, at the closest hit of each ray
+        :param origins: Origins of rays - n x 3, or 3 for all rays
+        :param directions: Directions of rays - n x 3, which need not be unit vectors
+        :param num_threads: The number of threads - None: all cores, 1: single-threaded
+        :return: locations - n x 3, NaN for rays which miss the mesh
+                 index_tri - n, indices of hit faces, -1 for rays which miss the mesh
+        """
+        directions = np.ascontiguousarray(directions, dtype=np.float64).reshape(-1, 3)
+        origins = np.ascontiguousarray(np.broadcast_to(np.asarray(origins, dtype=np.float64), directions.shape))
+        kernel = intersectMesh if num_threads == 1 else intersectMesh_parallel
+        with parallel_section(num_threads):
+            locations, index_tri = kernel(origins, directions, self.node_min, self.node_max, self.node_child,
+                                          self.node_first, self.node_count, self.v0, self.e1, self.e2)
+        hit = index_tri >= 0
+        index_tri[hit] = self.order[index_tri[hit]]
+        return locations, index_tri
+
+    def project(self, eo, directions, default_height, num_threads=None):
+        """
+        Intersect rays from the projection center with the mesh, as Dem.intersect
+        :param eo: EOP - [x, y, z, o, p, k]
+        :param directions: Directions of the rays in ground coordinate system - 3 x n
+        :param default_height: The height of the ground out of the mesh, m
+        :return: Intersections - 3(X, Y, Z) x n, on the plane of default_height for rays which miss the mesh
+        """
+        directions = np.asarray(directions, dtype=np.float64)
+        locations, index_tri = self.intersect(eo[0:3], directions.T, num_threads)
+
+        missed = index_tri < 0
+        if missed.any():
+            scale = (default_height - eo[2]) / directions[2, missed]
+            locations[missed, 0:2] = scale[:, np.newaxis] * directions[0:2, missed].T + eo[0:2]
+            locations[missed, 2] = default_height
+        return locations.T
+
+
+def loadObj(path):
     """
-    Signature: mesh.ray.intersects_location(ray_origins,
-                                            ray_directions,
-                                            multiple_hits=True)
-    Docstring:
+    Read vertices and faces of an OBJ, whose polygons are split into triangles as fans
+    :return: vertices - n x 3, faces - m x 3
+    """
+    vertices = []
+    faces = []
+    with open(path) as f:
+        for line in f:
+            values = line.split()
+            if not values:
+                continue
+            if values[0] == 'v':
+                vertices.append([float(value) for value in values[1:4]])
+            elif values[0] == 'f':
+                # v, v/vt, v//vn or v/vt/vn, 1-based or negative from the end
+                polygon = [int(value.split('/')[0]) for value in values[1:]]
+                polygon = [index - 1 if index > 0 else len(vertices) + index for index in polygon]
+                for i in range(1, len(polygon) - 1):
+                    faces.append([polygon[0], polygon[i], polygon[i + 1]])
+    return np.array(vertices, dtype=np.float64).reshape(-1, 3), np.array(faces, dtype=np.int32).reshape(-1, 3)
+
+
+@jit(nopython=True, nogil=True)
+def buildBvh(tri_min, tri_max, centroids, leaf_size):
+    """
+    Split triangles at the median of their centroids along the longest axis, until leaves have leaf_size of them
+    Children of a node are next to each other, at node_child and node_child + 1
+    Triangles of a leaf are order[node_first:node_first + node_count], and node_count is 0 for inner nodes
+    """
+    num_tris = tri_min.shape[0]
+    max_nodes = max(2 * num_tris - 1, 1)
+    node_min = np.empty((max_nodes, 3))
+    node_max = np.empty((max_nodes, 3))
+    node_child = np.full(max_nodes, -1, dtype=np.int32)
+    node_first = np.zeros(max_nodes, dtype=np.int32)
+    node_count = np.zeros(max_nodes, dtype=np.int32)
+    order = np.arange(num_tris).astype(np.int32)
+
+    # (node, first, end) of nodes to split
+    stack = np.empty((64, 3), dtype=np.int32)
+    stack[0, 0], stack[0, 1], stack[0, 2] = 0, 0, num_tris
+    stack_size = 1 if num_tris > 0 else 0
+    num_nodes = 1
+    while stack_size > 0:
+        stack_size -= 1
+        node, first, end = stack[stack_size, 0], stack[stack_size, 1], stack[stack_size, 2]
 
-    Return the location of where a ray hits a surface.
+        lower = np.full(3, np.inf)
+        upper = np.full(3, -np.inf)
+        c_lower = np.full(3, np.inf)
+        c_upper = np.full(3, -np.inf)
+        for i in range(first, end):
+            tri = order[i]
+            for axis in range(3):
+                lower[axis] = min(lower[axis], tri_min[tri, axis])
+                upper[axis] = max(upper[axis], tri_max[tri, axis])
+                c_lower[axis] = min(c_lower[axis], centroids[tri, axis])
+                c_upper[axis] = max(c_upper[axis], centroids[tri, axis])
+        node_min[node] = lower
+        node_max[node] = upper
 
-    Parameters
-    ----------
-    ray_origins:    (n,3) float, origins of rays
-    ray_directions: (n,3) float, direction (vector) of rays
+        if end - first <= leaf_size:
+            node_first[node] = first
+            node_count[node] = end - first
+            continue
 
+        axis = np.argmax(c_upper - c_lower)
+        tris = order[first:end].copy()
+        order[first:end] = tris[np.argsort(centroids[tris, axis], kind='mergesort')]
+        middle = (first + end) // 2
 
-    Returns
-    ---------
-    locations: (n) sequence of (m,3) intersection points
-    index_ray: (n,) int, list of ray index
-    index_tri: (n,) int, list of triangle (face) indexes
+        node_child[node] = num_nodes
+        stack[stack_size, 0], stack[stack_size, 1], stack[stack_size, 2] = num_nodes, first, middle
+        stack[stack_size + 1, 0], stack[stack_size + 1, 1], stack[stack_size + 1, 2] = num_nodes + 1, middle, end
+        stack_size += 2
+        num_nodes += 2
+
+    return (node_min[:num_nodes].copy(), node_max[:num_nodes].copy(), node_child[:num_nodes].copy(),
+            node_first[:num_nodes].copy(), node_count[:num_nodes].copy(), order)
+
+
+@jit(nopython=True, nogil=True)
+def rayBox(origin, inverse_direction, box_min, box_max, t_max):
     """
+    :return: The distance to the box along the ray by slabs, or inf if the ray misses it before t_max
+    """
+    t_near = 0.0
+    t_far = t_max
+    for axis in range(3):
+        t0 = (box_min[axis] - origin[axis]) * inverse_direction[axis]
+        t1 = (box_max[axis] - origin[axis]) * inverse_direction[axis]
+        if t0 > t1:
+            t0, t1 = t1, t0
+        # NaN of 0 * inf is ignored by the comparisons
+        if t0 > t_near:
+            t_near = t0
+        if t1 < t_far:
+            t_far = t1
+    return t_near if t_near <= t_far else np.inf
+
+
+@jit(nopython=True, nogil=True)
+def intersectMesh(origins, directions, node_min, node_max, node_child, node_first, node_count, v0, e1, e2):
+    """
+    Traverse the BVH with each ray, the nearer child first, and intersect triangles of leaves by Moller-Trumbore
+    Triangles are hit from both sides
+    """
+    num_rays = origins.shape[0]
+    locations = np.full((num_rays, 3), np.nan)
+    index_tri = np.full(num_rays, -1, dtype=np.int32)
+
+    for i in prange(num_rays):
+        origin = origins[i]
+        direction = directions[i]
+        inverse_direction = 1 / direction
+        t_hit = np.inf
+        hit = -1
 
-    # run the mesh- ray test
-    locations, index_ray, index_tri = mesh.ray.intersects_location(
-        ray_origins=ray_origins,
-        ray_directions=ray_directions)
+        stack = np.empty(64, dtype=np.int32)
+        stack[0] = 0
+        stack_size = 1 if v0.shape[0] > 0 and \
+            rayBox(origin, inverse_direction, node_min[0], node_max[0], t_hit) < np.inf else 0
+        while stack_size > 0:
+            stack_size -= 1
+            node = stack[stack_size]
+            if node_count[node] > 0:
+                for tri in range(node_first[node], node_first[node] + node_count[node]):
+                    p0 = direction[1] * e2[tri, 2] - direction[2] * e2[tri, 1]
+                    p1 = direction[2] * e2[tri, 0] - direction[0] * e2[tri, 2]
+                    p2 = direction[0] * e2[tri, 1] - direction[1] * e2[tri, 0]
+                    det = e1[tri, 0] * p0 + e1[tri, 1] * p1 + e1[tri, 2] * p2
+                    if abs(det) < 1e-15:
+                        continue
+                    s0 = origin[0] - v0[tri, 0]
+                    s1 = origin[1] - v0[tri, 1]
+                    s2 = origin[2] - v0[tri, 2]
+                    u = (s0 * p0 + s1 * p1 + s2 * p2) / det
+                    if u < 0 or u > 1:
+                        continue
+                    q0 = s1 * e1[tri, 2] - s2 * e1[tri, 1]
+                    q1 = s2 * e1[tri, 0] - s0 * e1[tri, 2]
+                    q2 = s0 * e1[tri, 1] - s1 * e1[tri, 0]
+                    v = (direction[0] * q0 + direction[1] * q1 + direction[2] * q2) / det
+                    if v < 0 or u + v > 1:
+                        continue
+                    t = (e2[tri, 0] * q0 + e2[tri, 1] * q1 + e2[tri, 2] * q2) / det
+                    if 0 < t < t_hit:
+                        t_hit = t
+                        hit = tri
+                continue
 
-    # stack rays into line segments for visualization as Path3D
-    ray_visualize = trimesh.load_path(np.hstack((
-        ray_origins,
-        ray_origins + ray_directions)).reshape(-1, 2, 3))
+            left = node_child[node]
+            right = left + 1
+            t_left = rayBox(origin, inverse_direction, node_min[left], node_max[left], t_hit)
+            t_right = rayBox(origin, inverse_direction, node_min[right], node_max[right], t_hit)
+            # Push the farther child first, so the nearer one is traversed first and shortens t_hit
+            if t_left > t_right:
+                t_left, t_right = t_right, t_left
+                left, right = right, left
+            if t_right < np.inf:
+                stack[stack_size] = right
+                stack_size += 1
+            if t_left < np.inf:
+                stack[stack_size] = left
+                stack_size += 1
 
-    # make mesh transparent- ish
-    mesh.visual.face_colors = [100, 100, 100, 100]
+        if hit >= 0:
+            index_tri[i] = hit
+            for axis in range(3):
+                locations[i, axis] = origin[axis] + t_hit * direction[axis]
 
-    # create a visualization scene with rays, hits, and mesh
-    scene = trimesh.Scene([
-        mesh,
-        ray_visualize,
-        trimesh.points.PointCloud(locations)])
+    return locations, index_tri
+
+
+intersectMesh_parallel = jit(nopython=True, nogil=True, parallel=True)(intersectMesh.py_func)
+
+
+if __name__ == '__main__':
+    mesh = Mesh.open('./models/DEM_yeosu/34707 - Cloud.obj')
+
+    # DJI_0386.JPG in Data
+    ray_origins = np.array([[266277.339, 237080.832, 214.9540]])
+    ray_directions = np.array([[1.697624393, - 2.926766149, - 54.16184732]])
 
-    # display the scene
-    scene.show()
+    locations, index_tri = mesh.intersect(ray_origins, ray_directions)
+    print(locations, index_tri)
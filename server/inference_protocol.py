@@ -0,0 +1,271 @@
+"""
+Framed request/response protocol between LDM and the inference server
+Every message is a frame of a 12-byte header and a payload
+    magic(2s, b'LI') | type(B) | request id(I) | payload length(I), big-endian
+A response carries the request id of its request, so that several requests can be in flight over one connection
+and the inference server may answer them in any order
+
+An image is sent in one of the formats below, which the client negotiates with the server per connection
+    png: An image encoded in PNG
+    raw: Raw pixels with a shape header - width(H) | height(H) | channels(B), big-endian, and rows x cols x channels
+    jpeg: An image encoded in JPEG at a configurable quality
+    original: The uploaded file as it is, when the image needs no change of orientation
+"""
+import json
+import select
+import socket
+import threading
+from concurrent.futures import Future, TimeoutError
+from struct import Struct
+
+import cv2
+import numpy as np
+
+from server.peer_connection import connect
+
+HEADER = Struct('>2sBII')
+MAGIC = b'LI'
+
+# Types of requests
+REQUEST_PNG = 0         # payload: an image encoded in PNG
+REQUEST_RAW = 1         # payload: RAW_HEADER and raw pixels
+REQUEST_JPEG = 2        # payload: an image encoded in JPEG
+REQUEST_ORIGINAL = 3    # payload: the uploaded file
+REQUEST_FORMATS = 4     # payload: empty, to query formats which the server supports
+# Types of responses
+RESPONSE_BBOXES = 128   # payload: JSON of bboxes - [[x1, y1, x2, y2, class_id], ...]
+RESPONSE_FORMATS = 129  # payload: JSON of names of formats - ["png", "raw", ...]
+RESPONSE_ERROR = 255    # payload: An error message in utf-8
+
+FORMATS = {'png': REQUEST_PNG, 'raw': REQUEST_RAW, 'jpeg': REQUEST_JPEG, 'original': REQUEST_ORIGINAL}
+RAW_HEADER = Struct('>HHB')
+
+
+def recv_exactly(sock, size):
+    """
+    Receive exactly size bytes
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError('The connection is closed')
+        received += n
+    return buf
+
+
+def write_frame(sock, msg_type, request_id, payload):
+    header = HEADER.pack(MAGIC, msg_type, request_id, len(payload))
+    if len(payload) < 65536:
+        sock.sendall(header + payload)
+    else:
+        # Not to copy a large payload only to prepend the header
+        sock.sendall(header)
+        sock.sendall(payload)
+
+
+def read_frame(sock):
+    """
+    :return: msg_type, request_id, payload
+    """
+    magic, msg_type, request_id, length = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    if magic != MAGIC:
+        raise ConnectionError('Invalid frame: %s' % magic)
+    return msg_type, request_id, bytes(recv_exactly(sock, length))
+
+
+def encode_image(image, image_format, jpeg_quality=90, original=None):
+    """
+    Encode an image for a request
+    :param image: An image - rows x cols x channels, uint8
+    :param image_format: png, raw, jpeg or original
+    :param jpeg_quality: Quality of jpeg, 0 - 100
+    :param original: Bytes of the uploaded file, for original
+    :return: payload, msg_type - arguments of InferenceClient.request
+    """
+    if image_format == 'png':
+        payload = cv2.imencode('.png', image)[1].tobytes()
+    elif image_format == 'raw':
+        image = np.ascontiguousarray(image)
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        # Concatenation with a memoryview copies the pixels only once
+        payload = RAW_HEADER.pack(image.shape[1], image.shape[0], channels) + memoryview(image).cast('B')
+    elif image_format == 'jpeg':
+        payload = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1].tobytes()
+    elif image_format == 'original':
+        payload = original
+    else:
+        raise ValueError('Unknown format of images: %s' % image_format)
+    return payload, FORMATS[image_format]
+
+
+def decode_image(msg_type, payload):
+    """
+    Decode an image of a request, for the inference server
+    :return: An image - rows x cols x channels, uint8
+    """
+    if msg_type == REQUEST_RAW:
+        width, height, channels = RAW_HEADER.unpack_from(payload)
+        image = np.frombuffer(payload, dtype=np.uint8, offset=RAW_HEADER.size)
+        return image.reshape((height, width, channels))
+    elif msg_type in (REQUEST_PNG, REQUEST_JPEG, REQUEST_ORIGINAL):
+        return cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+    raise ValueError('Unknown type of requests: %d' % msg_type)
+
+
+def choose_format(preferences, server_formats, passthrough):
+    """
+    :param preferences: Names of formats in order of preference
+    :param server_formats: Names of formats which the server supports
+    :param passthrough: The uploaded file can be sent as it is or not
+    :return: The first of preferences which the server supports, png if none of them
+    """
+    for image_format in preferences:
+        if image_format == 'original' and not passthrough:
+            continue
+        if image_format in server_formats:
+            return image_format
+    return 'png'
+
+
+class InferenceClient:
+    """
+    A multiplexed connection to the inference server
+    Callers send requests under a lock, and a dispatcher thread hands responses to the waiting callers by request id
+    The connection is made lazily on the first request, and made again with backoff after it drops
+    """
+    def __init__(self, name, host, port, timeout=10, retries=5, backoff=0.5, max_backoff=8):
+        """
+        :param name: The name of the peer for logs
+        :param host: IP address of the inference server
+        :param port: Port of the inference server
+        :param timeout: Timeout of connecting, sending and receiving a frame, s - None: blocking
+        :param retries: The number of attempts to connect for a request
+        :param backoff: The first delay between attempts to connect, which doubles for each attempt, s
+        :param max_backoff: The maximum delay between attempts to connect, s
+        """
+        self.name = name
+        self.address = (host, port)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.lock = threading.Lock()
+        self.sock = None
+        self.pending = {}   # request id -> Future
+        self.next_request_id = 0
+        self.server_formats = None  # Formats which the server of the current connection supports
+
+    def submit(self, payload, msg_type=REQUEST_PNG):
+        """
+        Send a request without waiting for the response
+        :return: A Future of the response payload
+        """
+        future = Future()
+        with self.lock:
+            if self.sock is None:
+                self.sock = connect(self.name, self.address, self.timeout, self.retries, self.backoff,
+                                    self.max_backoff)
+                threading.Thread(target=self._dispatch, args=(self.sock,), name='%s-dispatcher' % self.name,
+                                 daemon=True).start()
+
+            request_id = self.next_request_id
+            self.next_request_id = (self.next_request_id + 1) % 2 ** 32
+            self.pending[request_id] = future
+            try:
+                write_frame(self.sock, msg_type, request_id, payload)
+            except OSError as e:
+                self._drop(self.sock, e)
+        return future
+
+    def request(self, payload, msg_type=REQUEST_PNG, timeout=None):
+        """
+        Send a request and wait for the response
+        If the connection drops before the response, the request is sent once more over a new connection
+        :param timeout: Seconds to wait for the response - None: until the connection drops
+        :return: The response payload
+        """
+        for attempt in range(2):
+            future = self.submit(payload, msg_type)
+            try:
+                return future.result(timeout)
+            except TimeoutError:
+                with self.lock:
+                    self.pending = {request_id: f for request_id, f in self.pending.items() if f is not future}
+                raise
+            except ConnectionError:
+                if attempt == 1:
+                    raise
+
+    def formats(self, timeout=None):
+        """
+        Query formats of images which the server supports, once per connection
+        A server which does not know REQUEST_FORMATS answers an error or nothing, and gets png, as before
+        :param timeout: Seconds to wait for the answer - None: until the connection drops
+        :return: Names of formats - ["png", "raw", ...]
+        """
+        server_formats = self.server_formats
+        if server_formats is None:
+            try:
+                server_formats = json.loads(self.request(b'', REQUEST_FORMATS, timeout))
+            except (RuntimeError, TimeoutError) as e:
+                # An error or no answer of an old server, which is the same for the rest of the connection
+                print(' * %s does not tell formats, png is sent: %r' % (self.name, e))
+                server_formats = ['png']
+            except OSError as e:
+                # The connection dropped or is not made, so the next connection is queried again
+                print(' * Failed to query formats of %s, png is sent: %s' % (self.name, e))
+                return ['png']
+            with self.lock:
+                if self.sock is not None:
+                    self.server_formats = server_formats
+        return server_formats
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                self._drop(self.sock, ConnectionError('%s is closed' % self.name))
+
+    def _drop(self, sock, error):
+        """
+        Close a connection and fail the requests waiting on it, with self.lock held
+        """
+        if self.sock is not sock:
+            return
+        print(' * Connection to %s dropped: %s' % (self.name, error))
+        try:
+            # Wake up the dispatcher
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+        self.sock = None
+        self.server_formats = None
+
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError('Connection to %s dropped: %s' % (self.name, error)))
+
+    def _dispatch(self, sock):
+        while True:
+            try:
+                # Wait for a frame without the timeout, which applies once a frame starts
+                select.select([sock], [], [])
+                msg_type, request_id, payload = read_frame(sock)
+            except (OSError, ValueError) as e:
+                with self.lock:
+                    self._drop(sock, e)
+                return
+
+            with self.lock:
+                future = self.pending.pop(request_id, None)
+            if future is None:
+                # The caller gave up waiting
+                continue
+            if msg_type == RESPONSE_ERROR:
+                future.set_exception(RuntimeError('%s: %s' % (self.name, payload.decode(errors='replace'))))
+            else:
+                future.set_result(payload)
@@ -0,0 +1,133 @@
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class Job:
+    def __init__(self, job_id, func, args):
+        self.job_id = job_id
+        self.func = func
+        self.args = args
+        self.state = 'queued'   # queued / processing / done / failed
+        self.stage = None       # The current stage of processing, which the job reports itself
+        self.error = None
+        self.submitted_time = time.time()
+        self.started_time = None
+        self.finished_time = None
+
+    def to_dict(self):
+        now = time.time()
+        return {
+            'job_id': self.job_id,
+            'state': self.state,
+            'stage': self.stage,
+            'error': self.error,
+            'queue_wait': (self.started_time or now) - self.submitted_time,
+            'processing_time': None if self.started_time is None else (self.finished_time or now) - self.started_time
+        }
+
+
+class IngestQueue:
+    """
+    A bounded job queue with a pool of worker threads
+    Jobs are callables which take the job itself as the first argument, to report the stage of processing
+    """
+    def __init__(self, max_size, num_workers, max_finished_jobs=1000):
+        """
+        :param max_size: The maximum number of queued jobs, which are not being processed
+        :param num_workers: The number of worker threads
+        :param max_finished_jobs: The number of finished jobs to keep for status queries
+        """
+        self.queue = queue.Queue(maxsize=max_size)
+        self.num_workers = num_workers
+        self.max_finished_jobs = max_finished_jobs
+
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.finished_jobs = OrderedDict()
+        self.busy_workers = 0
+        self.max_queue_depth = 0
+        self.num_rejected = 0
+
+        self.workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._work, name='ingest-worker-%d' % i, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, func, *args, timeout=0):
+        """
+        Enqueue a job
+        :param func: A callable - func(job, *args)
+        :param timeout: Seconds to block while the queue is full - 0: reject at once, None: block until enqueued
+        :return: job_id, or None if the queue is full
+        """
+        job = Job(uuid.uuid4().hex, func, args)
+        with self.lock:
+            self.jobs[job.job_id] = job
+        try:
+            if timeout == 0:
+                self.queue.put_nowait(job)
+            else:
+                self.queue.put(job, timeout=timeout)
+        except queue.Full:
+            with self.lock:
+                del self.jobs[job.job_id]
+                self.num_rejected += 1
+            return None
+
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return job.job_id
+
+    def status(self, job_id):
+        """
+        :return: A dict of the state of a job, or None if it is unknown
+        """
+        with self.lock:
+            job = self.jobs.get(job_id) or self.finished_jobs.get(job_id)
+            if job is None:
+                return None
+            return job.to_dict()
+
+    def metrics(self):
+        """
+        :return: Queue depth and usage of workers, to size the queue and the pool
+        """
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'queue_size': self.queue.maxsize,
+                'busy_workers': self.busy_workers,
+                'num_workers': self.num_workers,
+                'num_rejected': self.num_rejected
+            }
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                job.state = 'processing'
+                job.started_time = time.time()
+                self.busy_workers += 1
+
+            try:
+                job.func(job, *job.args)
+                state, error = 'done', None
+            except Exception as e:
+                print(' * Job %s failed: %s' % (job.job_id, e))
+                state, error = 'failed', str(e)
+
+            with self.lock:
+                job.state = state
+                job.error = error
+                job.finished_time = time.time()
+                self.busy_workers -= 1
+                del self.jobs[job.job_id]
+                self.finished_jobs[job.job_id] = job
+                while len(self.finished_jobs) > self.max_finished_jobs:
+                    self.finished_jobs.popitem(last=False)
+            self.queue.task_done()
@@ -1,69 +1,87 @@
+import io
 import json
 import os
 import time
+import threading
 import cv2
-import socket
 import numpy as np
 from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, request
+from flask import Flask, Request, request, Response
 from werkzeug.utils import secure_filename
 
 from config import config_flask, config_watchdog
-from server.image_processing.img_metadata_generation import create_img_metadata_tcp, create_obj_metadata
+from server.ingest_queue import IngestQueue
+from server.disk_writer import DiskWriter
+from server.tile_store import TileStore, TileCache
+from server.peer_connection import PeerConnection
+from server.inference_protocol import InferenceClient, encode_image, choose_format
+from server.viewer_protocol import encode_orthophoto, encode_tiles, write_ipod_frame
+from server.image_processing.img_metadata_generation import create_img_metadata_tcp, create_objs_metadata
+from server.image_processing.img_decoding import DECODE_SCALES, decode_image, scale_bboxes
 from clients.webodm import WebODM
 from clients.mago3d import Mago3D
 
 from server.image_processing.orthophoto_generation.Orthophoto import rectify_SIC
-from server.image_processing.orthophoto_generation.ExifData import get_metadata, restoreOrientation
-from server.image_processing.orthophoto_generation.EoData import rpy_to_opk_smartphone, geographic2plane, \
-                                                                 Rot3D, kappa_from_location_diff
-from server.image_processing.orthophoto_generation.Boundary import transform_bbox
-
-from struct import *
-
-# socket for sending
+from server.image_processing.orthophoto_generation.ExifData import parse_metadata
+from server.image_processing.orthophoto_generation.EoData import rpy_to_opk, rpy_to_opk_smartphone, \
+                                                                 geographic2plane_many, Rot3D, kappa_from_location_diff
+from server.image_processing.orthophoto_generation.Boundary import transform_bboxes, export_bboxes_to_wkt
+from server.image_processing.orthophoto_generation.Tiles import cut_tiles, encode_tile, save_tiles
+from server.image_processing.orthophoto_generation.Mosaic import Mosaic
+from server.image_processing.orthophoto_generation.Camera import Camera
+from server.image_processing.orthophoto_generation.Dem import Dem
+from server.image_processing.orthophoto_generation.ray import Mesh
+
+
+# Connection to inference server
 TCP_IP = '192.168.0.24'
 TCP_PORT = 5010
 
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-s.connect((TCP_IP, TCP_PORT))
-print('connected! - inference')
-
-
-def recvall(sock,headersize):
-    buf = b''
-    header = unpack('>H', sock.recv(headersize)) # length(4byte) + data
-    count = header[0]
-    while count:
-        newbuf = sock.recv(count)
-        if not newbuf:
-            return None
-        buf += newbuf
-        count -= len(newbuf)
-    return buf
-
-
 #########################
 # Client for map viewer #
 #########################
 TCP_IP1 = '192.168.0.5'
 TCP_PORT1 = 57821
 
-s1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s1.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-# dest = ("192.168.0.5", 57821)
-s1.connect((TCP_IP1, TCP_PORT1))
-print('connected! - viewer')
+
+
+class InMemoryRequest(Request):
+    """
+    A request whose uploaded files are kept in memory, instead of temporary files for ones over 500 KB
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
 
 # Initialize flask
 app = Flask(__name__)
 app.config.from_object(config_flask.BaseConfig)
+if app.config['INGEST_IN_MEMORY']:
+    app.request_class = InMemoryRequest
+
+# Connect to the peers lazily, so that the server starts before them
+inference = InferenceClient('inference', TCP_IP, TCP_PORT, **app.config['PEER_CONNECTION'])
+viewer = PeerConnection('viewer', TCP_IP1, TCP_PORT1, **app.config['PEER_CONNECTION'])
 
 # Initialize multi-thread
-executor = ThreadPoolExecutor(2)
+# Workers of ingest_queue run IPOD chains, and each chain runs orthophoto generation on executor
+ingest_queue = IngestQueue(max_size=app.config['INGEST_QUEUE_SIZE'], num_workers=app.config['INGEST_NUM_WORKERS'])
+executor = ThreadPoolExecutor(app.config['INGEST_NUM_WORKERS'])
+# Uploaded files are saved on this thread, while IPOD chains run on their bytes in memory
+disk_writer = DiskWriter(app.config['DISK_WRITER_MAX_BYTES'])
+
+# Live mosaics of projects and their tile stores, by the directory of a project
+mosaics = {}
+tile_stores = {}
+# Frames of a project are added to its mosaic and their tiles are put in its tile store one by one, under its lock
+mosaic_locks = {}
+projects_lock = threading.Lock()
+# Settings of projects, which override the config for a project - setting -> the key of the config
+PROJECT_SETTINGS = {'gsd': 'RECTIFY_GSD', 'decode_scale': 'RECTIFY_DECODE_SCALE',
+                    'inference_decode_scale': 'INFERENCE_DECODE_SCALE'}
+project_settings = {}
+tile_cache = TileCache(app.config['TILE_CACHE_BYTES'])
 
 # Initialize Mago3D client
 mago3d = Mago3D(
@@ -78,11 +96,233 @@ epsg = 3857
 
 from server.my_drones import GalaxyS10_SIC
 my_drone = GalaxyS10_SIC(pre_calibrated=False)
+# Constants of the camera of the drone, which rectification reuses for every frame
+camera = Camera.from_ipod_params(my_drone.ipod_params)
+# The terrain to rectify over, instead of a flat ground of ground_height
+dem = Dem.open(app.config['RECTIFY_DEM']) if app.config['RECTIFY_DEM'] else None
+# The terrain mesh to georeference boundary boxes on, whose BVH is loaded once
+mesh = Mesh.open(app.config['GEOREFERENCE_MESH']) if app.config['GEOREFERENCE_MESH'] else None
 
 def allowed_file(fname):
     return '.' in fname and fname.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
 
+def detect_objects(restored_img, original, pixel_size, transformed_eo, R_CG, inference_img=None):
+    """
+    IPOD chain 2: Object detection
+    Send an image to the inference server and georeference the received boundary boxes
+    :param original: Bytes of the uploaded file, if it is the same as inference_img. Otherwise, None
+    :param inference_img: The image for the detector, e.g. decoded at a reduced scale - None: restored_img
+                          Boundary boxes on it are scaled to restored_img, which pixel_size is of
+    :return: obj_metadata, elapsed time(s)
+    """
+    if inference_img is None:
+        inference_img = restored_img
+    start_time = time.time()
+    print("IPOD chain 2: Object detection")
+
+    ####################################
+    # Send the image to inference server
+    print(" * start sending...")
+    # The uploaded file can be sent as it is, if its orientation is not changed
+    image_format = choose_format(app.config['INFERENCE_FORMATS'], inference.formats(app.config['INFERENCE_TIMEOUT']),
+                                 passthrough=original is not None)
+    encode_start_time = time.time()
+    string_data, msg_type = encode_image(inference_img, image_format, app.config['INFERENCE_JPEG_QUALITY'], original)
+    print("  * %s: %d bytes, encoded in %f s" % (image_format, len(string_data), time.time() - encode_start_time))
+
+    # Receiving Bbox info
+    # Requests of other uploads may be in flight over the same connection
+    bbox_coords_bytes = inference.request(string_data, msg_type, timeout=app.config['INFERENCE_TIMEOUT'])
+    bbox_coords = scale_bboxes(json.loads(bbox_coords_bytes), inference_img.shape, restored_img.shape)
+    # bbox_coords_bytes = s.recv(65534)
+    # bbox_coords = json.loads(bbox_coords_bytes)
+    print("  * received!")
+    ####################################
+
+    # bboxed_img = highlighting_bbox(imgencode, [x1, y1, x2, y2, cls_id])
+
+    img_rows = restored_img.shape[0]
+    img_cols = restored_img.shape[1]
+
+    print(" * Georeferencing boundary boxes...")
+    # All boxes are projected at once
+    bboxes_world = transform_bboxes(bbox_coords, img_rows, img_cols, pixel_size,
+                                    my_drone.ipod_params['focal_length'],
+                                    transformed_eo, R_CG, my_drone.ipod_params['ground_height'], mesh)
+    obj_metadata = create_objs_metadata(bbox_coords, export_bboxes_to_wkt(bboxes_world))
+
+    # x1 = [603, 800, 289]
+    # x2 = [708, 988, 392]
+    # y1 = [776, 588, 1491]
+    # y2 = [860, 947, 1572]
+    # class_id = [3, 3, 3]
+
+    return obj_metadata, time.time() - start_time
+
+
+def get_mosaic(project_path):
+    """
+    :return: The live mosaic of a project, which is made at the first frame of the project
+    """
+    with projects_lock:
+        if project_path not in mosaics:
+            mosaics[project_path] = Mosaic(os.path.join(project_path, 'mosaic'), app.config['MOSAIC_ZOOM'],
+                                           app.config['TILE_MIN_ZOOM'], app.config['MOSAIC_BLENDING'],
+                                           app.config['MOSAIC_MAX_TILES'], app.config['MOSAIC_FEATHER_WIDTH'],
+                                           app.config['RECTIFY_MAX_PIXELS'])
+            mosaic_locks[project_path] = threading.Lock()
+        return mosaics[project_path]
+
+
+def get_mosaic_lock(project_path):
+    """
+    :return: The lock of the mosaic of a project, to add a frame and to put its tiles in the tile store at once
+    """
+    get_mosaic(project_path)
+    with projects_lock:
+        return mosaic_locks[project_path]
+
+
+def get_project_settings(project_path):
+    """
+    :return: Settings of a project, which are read from settings.json of the project at the first use after start,
+             and the config for the ones the project does not have
+    """
+    with projects_lock:
+        return _project_settings(project_path)
+
+
+def _project_settings(project_path):
+    """
+    get_project_settings with projects_lock held
+    """
+    if project_path not in project_settings:
+        settings = {setting: app.config[key] for setting, key in PROJECT_SETTINGS.items()}
+        settings_path = os.path.join(project_path, 'settings.json')
+        if os.path.exists(settings_path):
+            with open(settings_path) as f:
+                settings.update(json.load(f))
+        project_settings[project_path] = settings
+    return project_settings[project_path]
+
+
+def validate_project_settings(settings):
+    """
+    Validate settings of a project, without a project
+    :param settings: Settings to change, of PROJECT_SETTINGS
+    :raise ValueError: For an unknown setting or an invalid value
+    """
+    if not isinstance(settings, dict):
+        raise ValueError('Settings have to be an object: %r' % (settings,))
+    for setting, value in settings.items():
+        if setting not in PROJECT_SETTINGS:
+            raise ValueError('Unknown setting: %s' % setting)
+        if setting == 'gsd' and value != 'auto' and \
+                (isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0):
+            raise ValueError('gsd has to be auto or m/px over 0: %r' % (value,))
+        if setting != 'gsd' and (isinstance(value, bool) or value not in DECODE_SCALES):
+            raise ValueError('%s has to be one of %s: %r' % (setting, sorted(DECODE_SCALES), value))
+
+
+def save_project_settings(project_path, settings):
+    """
+    Validate settings of a project and save them in settings.json of the project
+    :param settings: Settings to change, of PROJECT_SETTINGS
+    :return: All settings of the project
+    """
+    validate_project_settings(settings)
+    # Read, merged and written at once, not to lose a change of another request in between
+    with projects_lock:
+        settings = dict(_project_settings(project_path), **settings)
+        with open(os.path.join(project_path, 'settings.json'), 'w') as f:
+            json.dump({setting: settings[setting] for setting in PROJECT_SETTINGS}, f)
+        project_settings[project_path] = settings
+    return settings
+
+
+def get_tile_store(project_path):
+    """
+    :return: The tile store of a project, which is opened at the first use after start
+    """
+    with projects_lock:
+        if project_path not in tile_stores:
+            tile_stores[project_path] = TileStore(os.path.join(project_path, 'mosaic'), app.config['TILE_FORMAT'],
+                                                  app.config['TILE_STORE_COMPACT_RATIO'])
+        return tile_stores[project_path]
+
+
+def generate_orthophoto(img_fname, restored_img, focal_length, pixel_size, transformed_eo, R_GC, img_type,
+                        tiles_path, mosaic, tile_store, mosaic_lock, geometry, gsd='auto'):
+    """
+    IPOD chain 3: Individual orthophoto generation
+    :param tiles_path: The directory to save tiles of the orthophoto
+    :param mosaic: The live mosaic of the project
+    :param tile_store: The tile store of the project, where the tiles of the mosaic are kept
+    :param mosaic_lock: The lock of the mosaic of the project, from get_mosaic_lock
+    :param geometry: FrameGeometry of the camera for the size of the image
+    :param gsd: GSD of the orthophoto, m/px - auto: GSD of the image
+    :return: bbox_wkt, buffers of the encoded orthophoto or tiles, img_encoding, elapsed time(s), encode time(s), bytes,
+             GSD of the orthophoto in m/px, which is coarser than gsd for the budget of RECTIFY_MAX_PIXELS/BYTES
+    """
+    start_time = time.time()
+    print("IPOD chain 3: Individual orthophoto generation")
+    bbox_wkt, orthophoto, geotransform = rectify_SIC(
+        output_path=config_watchdog.BaseConfig.DIRECTORY_FOR_OUTPUT,
+        img_fname=img_fname,
+        restored_image=restored_img,
+        focal_length=focal_length,
+        pixel_size=pixel_size/1000,
+        eo=transformed_eo,
+        R_GC=R_GC,
+        ground_height=my_drone.ipod_params['ground_height'],
+        epsg=epsg,
+        img_type=img_type,
+        gsd=gsd,
+        method=app.config['RECTIFY_METHOD'],
+        num_threads=app.config['RECTIFY_NUM_THREADS'],
+        resampling=app.config['RECTIFY_RESAMPLING'],
+        camera=geometry,
+        dem=dem,
+        dem_step=app.config['RECTIFY_DEM_STEP'],
+        max_pixels=app.config['RECTIFY_MAX_PIXELS'],
+        max_bytes=app.config['RECTIFY_MAX_BYTES']
+    )
+    # Write image to memory
+    encode_start_time = time.time()
+    if app.config['VIEWER_OUTPUT'] == 'tiles' and img_type == 0:
+        # Tiles in EPSG:3857, which the viewer loads incrementally
+        tile_format = app.config['TILE_FORMAT']
+        tiles = [(key, encode_tile(tile, tile_format))
+                 for key, tile in cut_tiles(orthophoto, geotransform, app.config['TILE_MIN_ZOOM'],
+                                            app.config['TILE_MAX_ZOOM'])]
+        save_tiles(tiles, tiles_path, tile_format)
+        orthophoto_buffers, img_encoding = encode_tiles(tiles, tile_format)
+        output_name = '%d tiles' % len(tiles)
+    elif app.config['VIEWER_OUTPUT'] == 'mosaic' and img_type == 0:
+        # Only the tiles of the mosaic which changed since the last push, including ones of other frames
+        tile_format = app.config['TILE_FORMAT']
+        # Flushes of frames on other workers may not be put in the tile store in between, or older tiles of
+        # an earlier flush would replace newer ones
+        with mosaic_lock:
+            mosaic.add(orthophoto, geotransform, transformed_eo[0:2])
+            tiles = [(key, encode_tile(tile, tile_format)) for key, tile in mosaic.flush()]
+            tile_store.put(tiles)
+        orthophoto_buffers, img_encoding = encode_tiles(tiles, tile_format)
+        output_name = '%d dirty tiles of the mosaic' % len(tiles)
+    else:
+        orthophoto_buffers, img_encoding = encode_orthophoto(orthophoto, app.config['VIEWER_FORMAT'],
+                                                             app.config['VIEWER_PNG_LEVEL'],
+                                                             app.config['VIEWER_JPEG_QUALITY'])
+        output_name = app.config['VIEWER_FORMAT']
+    encode_elapsed = time.time() - encode_start_time
+    orthophoto_length = sum(memoryview(buffer).nbytes for buffer in orthophoto_buffers)
+    print(" * %s: %d bytes, encoded in %f s" % (output_name, orthophoto_length, encode_elapsed))
+
+    return bbox_wkt, orthophoto_buffers, img_encoding, time.time() - start_time, encode_elapsed, orthophoto_length, \
+        geotransform[1]
+
+
 @app.route('/project/', methods=['GET', 'POST'])
 def project():
     """
@@ -94,6 +334,12 @@ def project():
         project_list = os.listdir(app.config['UPLOAD_FOLDER'])
         return json.dumps(project_list)
     if request.method == 'POST':
+        # Before the project is made on Mago3D and LDM, not to leave a project behind for invalid settings
+        try:
+            validate_project_settings(request.json.get('settings') or {})
+        except ValueError as e:
+            return Response(json.dumps({'error': str(e)}), status=400, mimetype='application/json')
+
         if request.json['visualization_module'] == 'MAGO3D':
             # Create a new project on Mago3D
             res = mago3d.create_project(request.json['name'], request.json['project_type'],
@@ -107,11 +353,153 @@ def project():
         new_project_dir = os.path.join(app.config['UPLOAD_FOLDER'], project_id)
         os.mkdir(new_project_dir)
         # os.mkdir(os.path.join(new_project_dir, 'rectified'))
+        if request.json.get('settings'):
+            save_project_settings(new_project_dir, request.json['settings'])
 
         # LDM returns the project ID that Mago3D assigned
         return project_id
 
 
+def ipod_chain(job, project_path, fname_dict, img_bytes=None):
+    """
+    The image processing and object detection chain of LDM, which runs on a worker of ingest_queue
+    :param job: The job of ingest_queue, to report the stage of processing
+    :param project_path: The directory of the project, where the uploaded image is saved
+    :param fname_dict: File names of the uploaded files
+    :param img_bytes: Bytes of the uploaded image in memory - None: read from the saved file
+    """
+    ############# Log for checking processing time #############
+    # Name | Queue wait | System Calibration | Inference | Rectify | Inference + Rectify(overlapped) | Metadata | Mago3D
+    # | Encode of orthophoto(included in Rectify) | Bytes of orthophoto
+    start_time = time.time()
+
+    ################################
+    # IPOD chain 1: Pre-processing #
+    ################################
+    job.stage = 'pre-processing'
+    print("IPOD chain 1: Pre-processing")
+    print(" * Metadata extraction...")
+    # Bytes of the image once, to parse its metadata, to decode it and to send it to the inference server as it is
+    if img_bytes is None:
+        with open(os.path.join(project_path, fname_dict["img"]), 'rb') as f:
+            img_bytes = f.read()
+    focal_length, orientation, parsed_eo, before_lonlat, \
+    uuid, task_id, maker = parse_metadata(img_bytes)  # unit: m, _, deg, deg, _, _, _
+    img_type = int(os.path.splitext(os.path.join(project_path, fname_dict["img"]))[0][-1])
+
+    # if parsed_eo[2] - my_drone.ipod_params["ground_height"] <= height_threshold:
+    #     print("  * The height is too low: ", parsed_eo[2] - my_drone.ipod_params["ground_height"], " m")
+    #     return "The height of the image is too low"
+
+    if not my_drone.pre_calibrated:
+        print(' * System calibration...')
+        transformed_eo = parsed_eo
+        if np.isfinite(before_lonlat[0:2]).all():
+            # The current and the previous locations in one transformation
+            transformed_eo[0:2], before_xy = geographic2plane_many(np.array([parsed_eo[0:2], before_lonlat[0:2]]),
+                                                                   epsg)
+        else:
+            # No previous location in the metadata, e.g. of DJI, which is not transformed with NaN
+            transformed_eo[0:2] = geographic2plane_many(np.array([parsed_eo[0:2]]), epsg)[0]
+            before_xy = None
+
+        # # Sensor
+        # opk = rpy_to_opk_smartphone(transformed_eo[3:])
+        # transformed_eo[3:] = opk * np.pi / 180  # degree to radian
+
+        # Location
+        opk = np.empty(3)
+        opk[0:2] = 0
+        if before_xy is not None and np.isfinite(before_xy).all():
+            opk[-1] = kappa_from_location_diff(transformed_eo, before_xy)
+        else:
+            # No previous location, or one out of the coordinate system, so kappa is of the parsed yaw
+            print(' * No previous location, kappa from the yaw')
+            if maker == 'DJI':
+                opk[-1] = rpy_to_opk(transformed_eo[3:])[-1]
+            else:
+                opk[-1] = rpy_to_opk_smartphone(transformed_eo[3:])[-1]
+        transformed_eo[3:] = opk * np.pi / 180  # degree to radian
+        print(transformed_eo)
+
+        # if abs(opk[0]) > omega_phi_threshold or abs(opk[1]) > omega_phi_threshold:
+        #     print('Too much omega/phi will kill you')
+        #     return 'Too much omega/phi will kill you'
+
+    R_GC = Rot3D(transformed_eo)
+    R_CG = R_GC.T
+
+    preprocess_time = time.time()
+
+    # Decoded as it is, without the rotation for display by OpenCV, which restoreOrientation would undo
+    # So the image is already restored, and no pixel is rotated
+    # The orthophoto and the detector take the image at the scales of the project, which are decoded at once
+    settings = get_project_settings(project_path)
+    images = decode_image(img_bytes, {settings['decode_scale'], settings['inference_decode_scale']})
+    restored_img = images[settings['decode_scale']]
+    inference_img = images[settings['inference_decode_scale']]
+
+    img_rows = restored_img.shape[0]
+    img_cols = restored_img.shape[1]
+    geometry = camera.geometry(img_rows, img_cols, focal_length)
+    pixel_size = geometry.pixel_size
+
+    job.stage = 'object detection and orthophoto generation'
+    # IPOD chain 2 and 3 are independent of each other, so they run at the same time
+    # Orthophoto generation runs on the executor, while object detection runs on this thread
+    fname_dict['img_rectified'] = fname_dict['img'].split('.')[0] + '.png'
+    tiles_path = os.path.join(project_path, 'tiles', os.path.splitext(fname_dict['img'])[0])
+    future_orthophoto = executor.submit(generate_orthophoto, fname_dict['img'], restored_img, focal_length,
+                                        pixel_size, transformed_eo, R_GC, img_type, tiles_path,
+                                        get_mosaic(project_path), get_tile_store(project_path),
+                                        get_mosaic_lock(project_path), geometry,
+                                        settings['gsd'])
+    # The inference server decodes the uploaded file with its orientation, so only one without it is sent as it is
+    passthrough = orientation in (0, 1) and settings['inference_decode_scale'] == 1
+    obj_metadata, inference_elapsed = detect_objects(restored_img, img_bytes if passthrough else None,
+                                                     pixel_size, transformed_eo, R_CG, inference_img)
+    bbox_wkt, orthophoto_buffers, img_encoding, rectify_elapsed, encode_elapsed, orthophoto_length, img_gsd = \
+        future_orthophoto.result()
+
+    rectify_time = time.time()
+
+    job.stage = 'transmission'
+    # Generate metadata for InnoMapViewer
+    img_metadata = create_img_metadata_tcp(
+        uuid=uuid,
+        task_id=task_id,
+        name=fname_dict['img'],
+        img_type=img_type,
+        img_boundary=bbox_wkt,
+        objects=obj_metadata,
+        img_encoding=img_encoding,
+        img_gsd=img_gsd
+    )
+    metadata_time = time.time()
+
+    img_metadata_bytes = json.dumps(img_metadata).encode()
+    #############################################
+    # Send object information to web map viewer #
+    #############################################
+    # Send the buffers of the orthophoto as they are, with scatter-gather I/O
+    viewer.run(lambda sock: write_ipod_frame(sock, img_metadata_bytes, orthophoto_buffers))
+
+    transmission_time = time.time()
+
+    cur_time = "%s\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%d\n" % (fname_dict['img'], start_time - job.submitted_time,
+                                                             preprocess_time - start_time,
+                                                             inference_elapsed, rectify_elapsed,
+                                                             rectify_time - preprocess_time,
+                                                             metadata_time - rectify_time,
+                                                             transmission_time - metadata_time,
+                                                             encode_elapsed, orthophoto_length)
+    with open("log_processing_time.txt", "a") as f:
+        f.write(cur_time)
+    print("Name | Queue wait | Pre-processing | Object Detection | Orthophoto | Overlapped | Metadata | Transmission | "
+          "Encode | Bytes")
+    print(cur_time)
+
+
 # 라이브 드론맵: 이미지 업로드, 기하보정 및 가시화
 @app.route('/ldm_upload/<project_id_str>', methods=['POST'])
 def ldm_upload(project_id_str):
@@ -121,15 +509,10 @@ def ldm_upload(project_id_str):
         1) Pre-processing: Metadata extraction, System calibration
         2) Object detection
         3) Individual orthophoto generation
+    The uploaded image is saved and queued, and the chain runs on a worker of ingest_queue
     :param project_id_str: project_id which Mago3D/LOCAL assigned for each projects
-    :return:
+    :return: 202 with job_id, or 503 if the queue is full
     """
-
-    ############# Log for checking processing time #############
-    f = open("log_processing_time.txt", "a")
-    # Name | System Calibration | Inference | Rectify | Metadata | Mago3D
-    start_time = time.time()
-
     if request.method == 'POST':
         # Initialize variables
         project_path = os.path.join(app.config['UPLOAD_FOLDER'], project_id_str)
@@ -140,6 +523,7 @@ def ldm_upload(project_id_str):
         }
 
         # Check integrity of uploaded files
+        files_bytes = {}
         for key in ['img']:
             if key not in request.files:  # Key check
                 return 'No %s part' % key
@@ -148,154 +532,111 @@ def ldm_upload(project_id_str):
                 return 'No selected file'
             if file and allowed_file(file.filename):  # If the keys and corresponding values are OK
                 fname_dict[key] = secure_filename(file.filename)
-                file.save(os.path.join(project_path, fname_dict[key]))  # Save the file from client
+                if app.config['INGEST_IN_MEMORY']:
+                    # Processed from memory, and saved on the background
+                    files_bytes[key] = file.read()
+                else:
+                    file.save(os.path.join(project_path, fname_dict[key]))  # Save the file from client
             else:
                 return 'Failed to save the uploaded files'
 
-        ################################
-        # IPOD chain 1: Pre-processing #
-        ################################
-        print("IPOD chain 1: Pre-processing")
-        print(" * Metadata extraction...")
-        focal_length, orientation, parsed_eo, before_lonlat, \
-        uuid, task_id, maker = get_metadata(os.path.join(project_path, fname_dict["img"]),
-                                            "Linux")  # unit: m, _, deg, deg, _, _, _
-        img_type = int(os.path.splitext(os.path.join(project_path, fname_dict["img"]))[0][-1])
-
-        # if parsed_eo[2] - my_drone.ipod_params["ground_height"] <= height_threshold:
-        #     print("  * The height is too low: ", parsed_eo[2] - my_drone.ipod_params["ground_height"], " m")
-        #     return "The height of the image is too low"
-
-        if not my_drone.pre_calibrated:
-            print(' * System calibration...')
-            transformed_eo = geographic2plane(parsed_eo, epsg)
-
-            # # Sensor
-            # opk = rpy_to_opk_smartphone(transformed_eo[3:])
-            # transformed_eo[3:] = opk * np.pi / 180  # degree to radian
-
-            # Location
-            before_xy = geographic2plane(before_lonlat, epsg)
-            opk = np.empty(3)
-            opk[0:2] = 0
-            opk[-1] = kappa_from_location_diff(transformed_eo, before_xy)
-            transformed_eo[3:] = opk * np.pi / 180  # degree to radian
-            print(transformed_eo)
-
-            # if abs(opk[0]) > omega_phi_threshold or abs(opk[1]) > omega_phi_threshold:
-            #     print('Too much omega/phi will kill you')
-            #     return 'Too much omega/phi will kill you'
-
-        R_GC = Rot3D(transformed_eo)
-        R_CG = R_GC.T
-
-        preprocess_time = time.time()
-
-        ##################################
-        # IPOD chain 2: Object detection #
-        ##################################
-        print("IPOD chain 2: Object detection")
-        img = cv2.imread(os.path.join(project_path, fname_dict["img"]))
-
-        # Restore the image based on orientation information
-        restored_img = restoreOrientation(img, orientation)
-
-        ####################################
-        # Send the image to inference server
-        print(" * start sending...")
-        # string_data = restored_img.tostring()
-        # hei, wid, _ = restored_img.shape
-        # header = pack('>2s2H', b'st', wid, hei)
-        # s.send(header + string_data)
-        string_data = cv2.imencode('.png', restored_img)[1].tobytes()
-        string_data_size = pack('>I', len(string_data))
-        s.send(b'st' + string_data_size + string_data)
-
-        # Receiving Bbox info
-        bbox_coords_bytes = recvall(s, 2)
-        bbox_coords = json.loads(bbox_coords_bytes)
-        # bbox_coords_bytes = s.recv(65534)
-        # bbox_coords = json.loads(bbox_coords_bytes)
-        print("  * received!")
-        ####################################
-
-        # bboxed_img = highlighting_bbox(imgencode, [x1, y1, x2, y2, cls_id])
-
-        img_rows = restored_img.shape[0]
-        img_cols = restored_img.shape[1]
-        pixel_size = my_drone.ipod_params['sensor_width'] / img_cols
-
-        print(" * Georeferencing boundary boxes...")
-        obj_metadata = []
-        for bbox in bbox_coords:
-            bbox_world = transform_bbox(bbox, img_rows, img_cols, pixel_size,
-                                        my_drone.ipod_params['focal_length'],
-                                        transformed_eo, R_CG, my_drone.ipod_params['ground_height'])
-
-            obj_metadata.append(create_obj_metadata(bbox[4], str(bbox), bbox_world))
-
-        # x1 = [603, 800, 289]
-        # x2 = [708, 988, 392]
-        # y1 = [776, 588, 1491]
-        # y2 = [860, 947, 1572]
-        # class_id = [3, 3, 3]
-
-        inference_time = time.time()
-
-        ##################################################
-        # IPOD chain 3: Individual orthophoto generation #
-        ##################################################
-        print("IPOD chain 3: Individual orthophoto generation")
-        fname_dict['img_rectified'] = fname_dict['img'].split('.')[0] + '.png'
-        bbox_wkt, orthophoto = rectify_SIC(
-            output_path=config_watchdog.BaseConfig.DIRECTORY_FOR_OUTPUT,
-            img_fname=fname_dict['img'],
-            restored_image=restored_img,
-            focal_length=focal_length,
-            pixel_size=pixel_size/1000,
-            eo=transformed_eo,
-            R_GC=R_GC,
-            ground_height=my_drone.ipod_params['ground_height'],
-            epsg=epsg,
-            img_type=img_type
-        )
-        # Write image to memory
-        orthophoto_encode = cv2.imencode('.png', orthophoto)
-        orthophoto_bytes = orthophoto_encode[1].tostring()
-
-        rectify_time = time.time()
-
-        # Generate metadata for InnoMapViewer
-        img_metadata = create_img_metadata_tcp(
-            uuid=uuid,
-            task_id=task_id,
-            name=fname_dict['img'],
-            img_type=img_type,
-            img_boundary=bbox_wkt,
-            objects=obj_metadata
-        )
-        metadata_time = time.time()
-
-        img_metadata_bytes = json.dumps(img_metadata).encode()
-        #############################################
-        # Send object information to web map viewer #
-        #############################################
-        full_length = len(img_metadata_bytes) + len(orthophoto_bytes)
-        fmt = '<4siii' + str(len(img_metadata_bytes)) + 's' + str(len(orthophoto_bytes)) + 's'  # s: string, i: int
-        data_to_send = pack(fmt, b"IPOD", full_length, len(img_metadata_bytes), len(orthophoto_bytes),
-                            img_metadata_bytes, orthophoto_bytes)
-        s1.send(data_to_send)
-
-        transmission_time = time.time()
-
-        cur_time = "%s\t%f\t%f\t%f\t%f\t%f\n" % (fname_dict['img'], preprocess_time - start_time,
-                                                 inference_time - preprocess_time, rectify_time - inference_time,
-                                                 metadata_time - rectify_time, transmission_time - metadata_time)
-        f.write(cur_time)
-        print("Name | Pre-processing | Object Detection | Orthophoto | Metadata | Transmission")
-        print(cur_time)
+        job_id = ingest_queue.submit(ipod_chain, project_path, fname_dict, files_bytes.get('img'),
+                                     timeout=app.config['INGEST_QUEUE_TIMEOUT'])
+        # Kept even if the queue is full, as the file was saved before
+        for key, file_bytes in files_bytes.items():
+            disk_writer.write(os.path.join(project_path, fname_dict[key]), file_bytes)
+        metrics = ingest_queue.metrics()
+        print(' * Queue depth: %d/%d' % (metrics['queue_depth'], metrics['queue_size']))
+        if job_id is None:
+            return Response(json.dumps({'error': 'The ingest queue is full', 'queue': metrics}), status=503,
+                            headers={'Retry-After': '1'}, mimetype='application/json')
+
+        return Response(json.dumps({'job_id': job_id,
+                                    'status': '/ldm_upload/%s/status/%s' % (project_id_str, job_id),
+                                    'queue': metrics}), status=202, mimetype='application/json')
+
+
+@app.route('/project/<project_id_str>/settings', methods=['GET', 'PUT'])
+def settings_of_project(project_id_str):
+    """
+    GET : Query settings of a project
+    PUT : Change settings of a project, which apply to images uploaded after
+        gsd: GSD of orthophotos, m/px - auto: GSD of each image
+        decode_scale: Images are decoded at 1/decode_scale for orthophotos - 1, 2, 4 or 8
+        inference_decode_scale: Images are decoded at 1/inference_decode_scale for the detector - 1, 2, 4 or 8
+    :param project_id_str: project_id which Mago3D/LOCAL assigned for each projects
+    :return: All settings of the project, 400 for an invalid setting, or 404 if there is no such project
+    """
+    project_path = os.path.join(app.config['UPLOAD_FOLDER'], project_id_str)
+    if secure_filename(project_id_str) != project_id_str or not os.path.isdir(project_path):
+        return Response(json.dumps({'error': 'Unknown project %s' % project_id_str}), status=404,
+                        mimetype='application/json')
+    if request.method == 'PUT':
+        try:
+            settings = save_project_settings(project_path, request.json)
+        except ValueError as e:
+            return Response(json.dumps({'error': str(e)}), status=400, mimetype='application/json')
+    else:
+        settings = get_project_settings(project_path)
+    return Response(json.dumps(settings), mimetype='application/json')
+
+
+@app.route('/ldm_upload/<project_id_str>/status/<job_id>', methods=['GET'])
+def ldm_upload_status(project_id_str, job_id):
+    """
+    GET : Query the state of a job of ldm_upload
+    :param project_id_str: project_id which Mago3D/LOCAL assigned for each projects
+    :param job_id: job_id which ldm_upload returned
+    :return: state, stage, error, queue_wait, processing_time of the job
+    """
+    status = ingest_queue.status(job_id)
+    if status is None:
+        return Response(json.dumps({'error': 'Unknown job %s' % job_id}), status=404, mimetype='application/json')
+    return Response(json.dumps(status), mimetype='application/json')
+
+
+@app.route('/ldm_upload/queue', methods=['GET'])
+def ldm_upload_queue():
+    """
+    GET : Query the depth of the ingest queue and the usage of workers, and uploads waiting to be saved
+    """
+    return Response(json.dumps(dict(ingest_queue.metrics(), disk_writer=disk_writer.metrics())),
+                    mimetype='application/json')
+
 
-        return 'Image upload and IPOD chain complete'
+@app.route('/tiles/<project_id_str>/<int:z>/<int:x>/<int:y>.<tile_format>', methods=['GET'])
+def tiles(project_id_str, z, x, y, tile_format):
+    """
+    GET : A tile of the live mosaic of a project, as it is in the tile store
+    ETags are strong, as bytes of a tile at an offset of the store never change, so viewers revalidate with 304
+    :param project_id_str: project_id which Mago3D/LOCAL assigned for each projects
+    :return: The tile, 304 if it is not modified, or 404 if there is no such tile
+    """
+    project_path = os.path.join(app.config['UPLOAD_FOLDER'], project_id_str)
+    if secure_filename(project_id_str) != project_id_str or \
+            not os.path.exists(os.path.join(project_path, 'mosaic', 'tiles.sqlite')):
+        return Response('No tiles of project %s' % project_id_str, status=404)
+    tile_store = get_tile_store(project_path)
+    location = tile_store.locate(z, x, y)
+    if tile_format != tile_store.tile_format or location is None:
+        return Response('No tile %d/%d/%d.%s' % (z, x, y, tile_format), status=404)
+
+    etag = '%d-%d-%d' % location
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+    else:
+        tile_bytes = tile_cache.get((project_path,) + location[0:2], lambda: tile_store.read(*location))
+        if tile_bytes is None:
+            # The store is compacted after locate, so the tile is at another offset
+            return tiles(project_id_str, z, x, y, tile_format)
+        response = Response(tile_bytes, mimetype='image/' + tile_format)
+        response.set_etag(etag)
+        # Range requests are served from the bytes of the tile
+        response.make_conditional(request, accept_ranges=True, complete_length=len(tile_bytes))
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['TILE_CACHE_MAX_AGE']
+    return response
 
 
 if __name__ == '__main__':
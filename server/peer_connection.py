@@ -0,0 +1,131 @@
+import socket
+import threading
+import time
+
+
+def connect(name, address, timeout, retries, backoff, max_backoff):
+    """
+    Connect to a peer, attempting again with exponential backoff
+    :return: A connected socket
+    """
+    delay = backoff
+    for attempt in range(retries):
+        try:
+            sock = socket.create_connection(address, timeout=timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            print('connected! - %s' % name)
+            return sock
+        except OSError as e:
+            print(' * Failed to connect to %s %s (%d/%d): %s' % (name, address, attempt + 1, retries, e))
+            if attempt + 1 < retries:
+                time.sleep(delay)
+                delay = min(delay * 2, max_backoff)
+    raise ConnectionError('Cannot connect to %s %s' % (name, address))
+
+
+def sendall_buffers(sock, buffers):
+    """
+    Send buffers with scatter-gather I/O(sendmsg) until all of them are sent, not to copy them into one
+    :param buffers: A list of bytes-like objects
+    """
+    views = [view for view in (memoryview(buffer).cast('B') for buffer in buffers) if len(view) > 0]
+    while views:
+        sent = sock.sendmsg(views)
+        # Skip the sent part, as sendmsg may send a part of buffers
+        while sent > 0:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+class PeerConnection:
+    """
+    A persistent TCP connection to a peer of LDM, e.g. the inference server or InnoMapViewer
+    The connection is made lazily on the first use, and made again with backoff after it drops
+    A lock serializes requests of concurrent threads, so that their messages do not interleave
+    """
+    def __init__(self, name, host, port, timeout=10, retries=5, backoff=0.5, max_backoff=8):
+        """
+        :param name: The name of the peer for logs
+        :param host: IP address of the peer
+        :param port: Port of the peer
+        :param timeout: Timeout of connecting, sending and receiving, s - None: blocking
+        :param retries: The number of attempts to connect for a request
+        :param backoff: The first delay between attempts to connect, which doubles for each attempt, s
+        :param max_backoff: The maximum delay between attempts to connect, s
+        """
+        self.name = name
+        self.address = (host, port)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.lock = threading.Lock()
+        self.sock = None
+
+    def _connect(self):
+        return connect(self.name, self.address, self.timeout, self.retries, self.backoff, self.max_backoff)
+
+    def _close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def run(self, func, retry=True):
+        """
+        Run a function on the socket under the lock
+        :param func: A function which sends and receives with the socket - func(sock)
+        :param retry: Run func once more over a new connection if the connection drops or not
+        :return: The return value of func
+        """
+        with self.lock:
+            attempts = 2 if retry else 1
+            for attempt in range(attempts):
+                if self.sock is None:
+                    self.sock = self._connect()
+                try:
+                    return func(self.sock)
+                except OSError as e:
+                    print(' * Connection to %s dropped: %s' % (self.name, e))
+                    self._close()
+                    if attempt + 1 == attempts:
+                        raise
+
+    def request(self, data, receive=None):
+        """
+        Send data, and receive a response if needed
+        If the connection drops, the request is sent once more over a new connection
+        :param data: Bytes to send, or a list of bytes-like objects to send with scatter-gather I/O
+        :param receive: A function which receives a response from the socket - receive(sock), None: no response
+        :return: The response, or None if receive is None
+        """
+        def send_and_receive(sock):
+            if isinstance(data, list):
+                sendall_buffers(sock, data)
+            else:
+                sock.sendall(data)
+            if receive is None:
+                return None
+            response = receive(sock)
+            if response is None:
+                raise ConnectionError('%s closed the connection' % self.name)
+            return response
+
+        return self.run(send_and_receive)
+
+    def send(self, data):
+        """
+        Send data without a response
+        """
+        self.request(data)
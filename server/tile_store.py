@@ -0,0 +1,218 @@
+import mmap
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class TileStore:
+    """
+    Encoded XYZ tiles of a project, in a single append-only data file and an index in SQLite
+        tiles.<generation>.dat: Bytes of tiles one after another, which is memory-mapped to read tiles
+        tiles.sqlite: (z, x, y) -> offset and length in the data file, in the style of MBTiles
+    A tile is appended to the data file, which is synced before the index is committed,
+    so the index never points to bytes which are not on disk, and a crash only leaves unreferenced bytes
+    Bytes of replaced tiles are dropped by compaction, once the data file is compact_ratio times the current tiles
+    Nothing is loaded at start, so a store of a long flight opens instantly
+    """
+    def __init__(self, path, tile_format='png', compact_ratio=2):
+        """
+        :param path: The directory of the store, e.g. the directory of a project
+        :param tile_format: The format of tiles, which is kept in the metadata of the store
+        :param compact_ratio: The ratio of the data file to the bytes of the current tiles to compact at,
+                              None: never compacted by put
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.index_path = os.path.join(path, 'tiles.sqlite')
+
+        self.lock = threading.Lock()
+        self.index = sqlite3.connect(self.index_path, check_same_thread=False, isolation_level=None)
+        self.index.execute('PRAGMA journal_mode=WAL')
+        self.index.execute('PRAGMA synchronous=NORMAL')
+        self.index.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)')
+        self.index.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, '
+                           'tile_row INTEGER, offset INTEGER, length INTEGER, '
+                           'PRIMARY KEY (zoom_level, tile_column, tile_row))')
+        self.index.execute('INSERT OR IGNORE INTO metadata VALUES (?, ?)', ('format', tile_format))
+        self.index.execute('INSERT OR IGNORE INTO metadata VALUES (?, ?)', ('data', 'tiles.0.dat'))
+        self.tile_format = self._metadata('format')
+        self.data_path = os.path.join(path, self._metadata('data'))
+        self.generation = int(self._metadata('data').split('.')[1])
+
+        # Remove data files of other generations, which an interrupted compaction may leave
+        for fname in os.listdir(path):
+            if fname.startswith('tiles.') and fname.endswith('.dat') and fname != os.path.basename(self.data_path):
+                os.remove(os.path.join(path, fname))
+
+        self.data = open(self.data_path, 'ab+')
+        self.data_length = self.data.seek(0, os.SEEK_END)
+        self.live_length = self.index.execute('SELECT COALESCE(SUM(length), 0) FROM tiles').fetchone()[0]
+        self.mapped = None
+
+    def _metadata(self, name):
+        return self.index.execute('SELECT value FROM metadata WHERE name = ?', (name,)).fetchone()[0]
+
+    def put(self, tiles):
+        """
+        Append tiles, and replace the ones already in the store
+        The store is compacted after, if replaced tiles make the data file over compact_ratio
+        :param tiles: A list of ((z, x, y), bytes of a tile)
+        """
+        if not tiles:
+            return
+        with self.lock:
+            records = []
+            # From the end of the file, which bytes of a failed batch may be left at
+            start = offset = self.data.seek(0, os.SEEK_END)
+            try:
+                for (z, x, y), tile_bytes in tiles:
+                    length = self.data.write(tile_bytes)
+                    records.append((z, x, y, offset, length))
+                    offset += length
+                self.data.flush()
+                os.fsync(self.data.fileno())
+            except OSError:
+                try:
+                    self.data.truncate(start)
+                except OSError:
+                    pass
+                raise
+            self.data_length = offset
+
+            # All tiles of a batch are in the index, or none of them
+            live_length = self.live_length
+            self.index.execute('BEGIN')
+            for record in records:
+                replaced = self.index.execute('SELECT length FROM tiles WHERE zoom_level = ? AND tile_column = ? '
+                                              'AND tile_row = ?', record[0:3]).fetchone()
+                live_length += record[4] - (0 if replaced is None else replaced[0])
+                self.index.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)', record)
+            self.index.execute('COMMIT')
+            self.live_length = live_length
+            compact = self.compact_ratio is not None and self.data_length > self.compact_ratio * self.live_length
+        if compact:
+            self.compact()
+
+    def locate(self, z, x, y):
+        """
+        :return: generation of the data file, offset and length of a tile in it, or None if the store does not have it
+                 Tiles are never overwritten, so an offset identifies the bytes of a tile in a generation
+        """
+        with self.lock:
+            location = self.index.execute('SELECT offset, length FROM tiles WHERE zoom_level = ? AND tile_column = ? '
+                                          'AND tile_row = ?', (z, x, y)).fetchone()
+            return None if location is None else (self.generation,) + location
+
+    def read(self, generation, offset, length):
+        """
+        :return: Bytes of a tile at offset, from locate, or None if the store is compacted to another generation since
+        """
+        with self.lock:
+            if generation != self.generation:
+                return None
+            if self.mapped is None or offset + length > len(self.mapped):
+                # Map the data file again, as it grew
+                if self.mapped is not None:
+                    self.mapped.close()
+                self.mapped = mmap.mmap(self.data.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.mapped[offset:offset + length]
+
+    def get(self, z, x, y):
+        """
+        :return: Bytes of a tile, or None if the store does not have it
+        """
+        while True:
+            location = self.locate(z, x, y)
+            if location is None:
+                return None
+            tile_bytes = self.read(*location)
+            if tile_bytes is not None:
+                return tile_bytes
+
+    def __len__(self):
+        with self.lock:
+            return self.index.execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+
+    def compact(self):
+        """
+        Rewrite the current tiles into a data file of the next generation, dropping bytes of replaced tiles
+        The offsets and the name of the data file are committed at once, so the store is consistent at any time
+        """
+        with self.lock:
+            records = self.index.execute('SELECT zoom_level, tile_column, tile_row, offset, length FROM tiles '
+                                         'ORDER BY offset').fetchall()
+            compact_path = os.path.join(self.path, 'tiles.%d.dat' % (self.generation + 1))
+            compacted = []
+            offset = 0
+            with open(self.data_path, 'rb') as src, open(compact_path, 'wb') as dst:
+                for z, x, y, old_offset, length in records:
+                    src.seek(old_offset)
+                    dst.write(src.read(length))
+                    compacted.append((offset, length, z, x, y))
+                    offset += length
+                dst.flush()
+                os.fsync(dst.fileno())
+
+            self.index.execute('BEGIN')
+            self.index.executemany('UPDATE tiles SET offset = ?, length = ? WHERE zoom_level = ? AND tile_column = ? '
+                                   'AND tile_row = ?', compacted)
+            self.index.execute('UPDATE metadata SET value = ? WHERE name = ?', (os.path.basename(compact_path), 'data'))
+            self.index.execute('COMMIT')
+
+            if self.mapped is not None:
+                self.mapped.close()
+                self.mapped = None
+            self.data.close()
+            os.remove(self.data_path)
+            self.data_path = compact_path
+            self.generation += 1
+            self.data = open(self.data_path, 'ab+')
+            self.data_length = self.live_length = offset
+
+    def close(self):
+        with self.lock:
+            if self.mapped is not None:
+                self.mapped.close()
+                self.mapped = None
+            self.data.close()
+            self.index.close()
+
+
+class TileCache:
+    """
+    An LRU of bytes of hot tiles, bounded by the total bytes
+    Keys have to identify bytes, e.g. (project, generation, offset) of a tile store, so entries are never stale
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.tiles = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """
+        :param load: A callable which returns the bytes of the tile, on a miss, or None which is not cached
+        :return: Bytes of the tile, or None from load
+        """
+        with self.lock:
+            tile_bytes = self.tiles.get(key)
+            if tile_bytes is not None:
+                self.tiles.move_to_end(key)
+                self.hits += 1
+                return tile_bytes
+            self.misses += 1
+
+        tile_bytes = load()
+        if tile_bytes is not None and len(tile_bytes) <= self.max_bytes:
+            with self.lock:
+                if key not in self.tiles:
+                    self.tiles[key] = tile_bytes
+                    self.num_bytes += len(tile_bytes)
+                while self.num_bytes > self.max_bytes:
+                    _, evicted = self.tiles.popitem(last=False)
+                    self.num_bytes -= len(evicted)
+        return tile_bytes
@@ -0,0 +1,118 @@
+"""
+IPOD messages to InnoMapViewer
+An IPOD message is a 16-byte header, metadata in JSON and an orthophoto
+    b'IPOD' | full length(i) | metadata length(i) | image length(i), little-endian
+where full length is metadata length + image length
+
+An encoder returns buffers of the image part of an IPOD message and img_encoding of the metadata,
+which tells the viewer how to decode them. img_encoding is None for png, as the viewer has always received png
+    png: PNG at a compression level, 0 - 9, or the default of OpenCV
+    webp: Lossless WebP
+    jpeg+mask: JPEG of BGR, followed by a 1-bit PNG of alpha - {"format": "jpeg+mask", "jpeg_length": int}
+    raw: Pixels as they are - {"format": "raw", "rows": int, "cols": int, "channels": int, "dtype": str}
+    tiles: XYZ tiles instead of an orthophoto, one after another -
+           {"format": "tiles", "tile_format": str, "tiles": [{"z": int, "x": int, "y": int, "length": int}, ...]}
+"""
+from struct import Struct
+
+import cv2
+import numpy as np
+
+from server.peer_connection import sendall_buffers
+
+IPOD_HEADER = Struct('<4siii')
+
+def encode_orthophoto(orthophoto, image_format='png', png_level=None, jpeg_quality=90):
+    """
+    :param orthophoto: An orthophoto - rows x cols x 4(BGRA) for optical, rows x cols for thermal
+    :param image_format: png, webp, jpeg+mask or raw
+    :param png_level: Compression level of png, 0 - 9, None: the default of OpenCV
+    :param jpeg_quality: Quality of jpeg+mask, 0 - 100
+    :return: buffers, img_encoding
+    """
+    is_bgra = orthophoto.ndim == 3 and orthophoto.shape[2] == 4
+    if image_format == 'jpeg+mask' and not is_bgra:
+        # No alpha to split
+        image_format = 'png'
+
+    if image_format == 'png':
+        params = [] if png_level is None else [cv2.IMWRITE_PNG_COMPRESSION, png_level]
+        return [cv2.imencode('.png', orthophoto, params)[1]], None
+    elif image_format == 'webp':
+        # Quality over 100 makes WebP lossless
+        return [cv2.imencode('.webp', orthophoto, [cv2.IMWRITE_WEBP_QUALITY, 101])[1]], {'format': 'webp'}
+    elif image_format == 'jpeg+mask':
+        bgr = cv2.cvtColor(orthophoto, cv2.COLOR_BGRA2BGR)
+        jpeg = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1]
+        mask = cv2.imencode('.png', cv2.extractChannel(orthophoto, 3), [cv2.IMWRITE_PNG_BILEVEL, 1])[1]
+        return [jpeg, mask], {'format': 'jpeg+mask', 'jpeg_length': len(jpeg)}
+    elif image_format == 'raw':
+        orthophoto = np.ascontiguousarray(orthophoto)
+        # A view of the pixels, not to copy them
+        return [memoryview(orthophoto).cast('B')], {
+            'format': 'raw',
+            'rows': orthophoto.shape[0],
+            'cols': orthophoto.shape[1],
+            'channels': 1 if orthophoto.ndim == 2 else orthophoto.shape[2],
+            'dtype': str(orthophoto.dtype)
+        }
+    raise ValueError('Unknown format of orthophotos: %s' % image_format)
+
+
+def encode_tiles(tiles, tile_format='png'):
+    """
+    :param tiles: A list of ((z, x, y), bytes of a tile encoded in tile_format)
+    :return: buffers, img_encoding
+    """
+    return [tile_bytes for _, tile_bytes in tiles], {
+        'format': 'tiles',
+        'tile_format': tile_format,
+        'tiles': [{'z': z, 'x': x, 'y': y, 'length': len(tile_bytes)} for (z, x, y), tile_bytes in tiles]
+    }
+
+
+def decode_tiles(image_bytes, img_encoding):
+    """
+    Split the image part of an IPOD message of tiles, as the viewer does
+    :return: A list of ((z, x, y), bytes of a tile)
+    """
+    tiles = []
+    offset = 0
+    for tile in img_encoding['tiles']:
+        tiles.append(((tile['z'], tile['x'], tile['y']), image_bytes[offset:offset + tile['length']]))
+        offset += tile['length']
+    return tiles
+
+
+def decode_orthophoto(image_bytes, img_encoding):
+    """
+    Decode the image part of an IPOD message, as the viewer does
+    :return: An orthophoto
+    """
+    if img_encoding is None or img_encoding['format'] in ('png', 'webp'):
+        return cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    elif img_encoding['format'] == 'jpeg+mask':
+        jpeg_length = img_encoding['jpeg_length']
+        bgr = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8, count=jpeg_length), cv2.IMREAD_COLOR)
+        mask = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8, offset=jpeg_length), cv2.IMREAD_GRAYSCALE)
+        return cv2.merge([bgr, mask])
+    elif img_encoding['format'] == 'raw':
+        orthophoto = np.frombuffer(image_bytes, dtype=img_encoding['dtype'])
+        if img_encoding['channels'] == 1:
+            return orthophoto.reshape((img_encoding['rows'], img_encoding['cols']))
+        return orthophoto.reshape((img_encoding['rows'], img_encoding['cols'], img_encoding['channels']))
+    raise ValueError('Unknown format of orthophotos: %s' % img_encoding['format'])
+
+
+def pack_ipod_header(metadata_length, image_length):
+    return IPOD_HEADER.pack(b'IPOD', metadata_length + image_length, metadata_length, image_length)
+
+
+def write_ipod_frame(sock, metadata_bytes, image_buffers):
+    """
+    Send an IPOD message with scatter-gather I/O, not to copy the orthophoto into the message
+    :param metadata_bytes: Metadata in JSON
+    :param image_buffers: A list of bytes-like objects of the orthophoto, e.g. from encode_orthophoto
+    """
+    image_length = sum(memoryview(buffer).nbytes for buffer in image_buffers)
+    sendall_buffers(sock, [pack_ipod_header(len(metadata_bytes), image_length), metadata_bytes] + image_buffers)
@@ -0,0 +1,78 @@
+"""
+Benchmark of georeferencing boundary boxes - a loop of transform_bbox against transform_bboxes, including WKT,
+and transform_bboxes on a terrain mesh of 2 x mesh_size^2 triangles, whose BVH is built once
+    python test/bench_georeferencing.py [--mesh-size 1000]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server.image_processing.orthophoto_generation.EoData import Rot3D
+from server.image_processing.orthophoto_generation.Boundary import transform_bbox, transform_bboxes, \
+    export_bbox_to_wkt3, export_bboxes_to_wkt
+from server.image_processing.orthophoto_generation.ray import Mesh
+
+ROWS, COLS = 3024, 4032
+PIXEL_SIZE = 0.0014     # mm/px
+FOCAL_LENGTH = 0.00432  # m
+GROUND_HEIGHT = 33.5    # m
+
+
+def measure(func, repeat):
+    elapsed = []
+    for _ in range(repeat):
+        start_time = time.time()
+        func()
+        elapsed.append(time.time() - start_time)
+    return min(elapsed)
+
+
+def terrain_mesh(center, size, cell=0.5):
+    """
+    Hills of a few meters around the ground height, 2 triangles per cell of a grid
+    """
+    x, y = np.meshgrid(center[0] + (np.arange(size + 1) - size / 2) * cell,
+                       center[1] + (np.arange(size + 1) - size / 2) * cell)
+    z = GROUND_HEIGHT + 3 * np.sin((x - center[0]) / 20) * np.cos((y - center[1]) / 30)
+    index = np.arange((size + 1) ** 2).reshape(size + 1, size + 1)
+    a, b, c, d = index[:-1, :-1].ravel(), index[:-1, 1:].ravel(), index[1:, 1:].ravel(), index[1:, :-1].ravel()
+    return np.stack([x.ravel(), y.ravel(), z.ravel()], axis=1), \
+        np.concatenate([np.stack([a, b, c], axis=1), np.stack([a, c, d], axis=1)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--mesh-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    eo = np.array([14134000.5, 4518000.25, 150, 0.05, -0.03, 0.7])
+    R_CG = Rot3D(eo).T
+    rng = np.random.default_rng(0)
+
+    start_time = time.time()
+    mesh = Mesh(*terrain_mesh(eo, args.mesh_size))
+    print("BVH of %d triangles: %f s, including compilation" % (len(mesh.faces), time.time() - start_time))
+    transform_bboxes([[0, 0, 1, 1]], ROWS, COLS, PIXEL_SIZE, FOCAL_LENGTH, eo, R_CG, GROUND_HEIGHT, mesh)
+
+    print("Boxes | Loop (s) | Batch (s) | Speedup | Batch on mesh (s)")
+    for num_boxes in [1, 100, 10000]:
+        # As the inference server returns them
+        bbox_coords = np.concatenate([rng.uniform(0, COLS, size=(num_boxes, 4)),
+                                      rng.integers(0, 5, size=(num_boxes, 1))], axis=1).tolist()
+
+        loop_time = measure(lambda: [export_bbox_to_wkt3(transform_bbox(bbox, ROWS, COLS, PIXEL_SIZE, FOCAL_LENGTH,
+                                                                        eo, R_CG, GROUND_HEIGHT).T)
+                                     for bbox in bbox_coords], args.repeat)
+        batch_time = measure(lambda: export_bboxes_to_wkt(transform_bboxes(bbox_coords, ROWS, COLS, PIXEL_SIZE,
+                                                                           FOCAL_LENGTH, eo, R_CG, GROUND_HEIGHT)),
+                             args.repeat)
+        mesh_time = measure(lambda: export_bboxes_to_wkt(transform_bboxes(bbox_coords, ROWS, COLS, PIXEL_SIZE,
+                                                                          FOCAL_LENGTH, eo, R_CG, GROUND_HEIGHT,
+                                                                          mesh)), args.repeat)
+        print("%d\t%f\t%f\t%.1f\t%f" % (num_boxes, loop_time, batch_time, loop_time / batch_time, mesh_time))
@@ -0,0 +1,56 @@
+"""
+Benchmark of formats of images for the inference server - encode time, decode time and bytes on the wire
+    python test/bench_inference_encoding.py
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server.inference_protocol import encode_image, decode_image
+
+FORMATS = [('png', None), ('raw', None), ('jpeg', 75), ('jpeg', 90), ('jpeg', 95), ('original', None)]
+
+
+def synthetic_frame(rows, cols):
+    """
+    A frame with smooth shading and fine texture, which compresses like an aerial photo rather than noise
+    """
+    rng = np.random.default_rng(0)
+    coarse = rng.integers(0, 256, size=(rows // 64 + 1, cols // 64 + 1, 3), dtype=np.uint8)
+    image = cv2.resize(coarse, (cols, rows), interpolation=cv2.INTER_CUBIC)
+    texture = rng.normal(0, 12, size=(rows, cols, 3))
+    return np.clip(image + texture, 0, 255).astype(np.uint8)
+
+
+def measure(func, repeat):
+    elapsed = []
+    for _ in range(repeat):
+        start_time = time.time()
+        result = func()
+        elapsed.append(time.time() - start_time)
+    return result, min(elapsed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print("Image | Format | Quality | Encode (s) | Decode (s) | Bytes | Ratio to raw")
+    for rows, cols in [(1080, 1920), (3024, 4032)]:
+        image = synthetic_frame(rows, cols)
+        # The uploaded file, as the camera encoded it
+        original = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+
+        for image_format, quality in FORMATS:
+            (payload, msg_type), encode_time = measure(
+                lambda: encode_image(image, image_format, quality or 90, original), args.repeat)
+            _, decode_time = measure(lambda: decode_image(msg_type, payload), args.repeat)
+            print("%dx%d\t%s\t%s\t%f\t%f\t%d\t%.3f" % (cols, rows, image_format, quality or '-', encode_time,
+                                                     decode_time, len(payload), len(payload) / image.nbytes))
@@ -0,0 +1,66 @@
+"""
+Benchmark of metadata extraction - get_metadata by pyexiv2 and cv2.imread, which read the file twice,
+against parse_metadata and cv2.imdecode of the bytes of a single read
+    python test/bench_metadata.py [--image DJI_0386.JPG]
+Without an image, a synthetic JPEG of 4032 x 3024 with EXIF and XMP of DLS is written to a temporary file
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server.image_processing.orthophoto_generation.ExifData import get_metadata, parse_metadata
+from test_exif_data import tagged_jpeg
+
+
+def measure(func, repeat):
+    elapsed = []
+    for _ in range(repeat):
+        start_time = time.time()
+        func()
+        elapsed.append(time.time() - start_time)
+    return min(elapsed)
+
+
+def single_read(path):
+    with open(path, 'rb') as f:
+        image_bytes = f.read()
+    image_metadata = parse_metadata(image_bytes)
+    return image_metadata, cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def pyexiv2_read(path):
+    return get_metadata(path, "Linux"), cv2.imread(path, cv2.IMREAD_COLOR)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image', default=None)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    path = args.image
+    if path is None:
+        image = np.random.default_rng(0).integers(0, 256, size=(3024, 4032, 3), dtype=np.uint8)
+        path = os.path.join(tempfile.mkdtemp(), 'synthetic.JPG')
+        with open(path, 'wb') as f:
+            f.write(tagged_jpeg(cv2.GaussianBlur(image, (0, 0), 3)))
+    with open(path, 'rb') as f:
+        image_bytes = f.read()
+
+    print("Method | Time (s)")
+    print("parse_metadata\t%f" % measure(lambda: parse_metadata(image_bytes), args.repeat))
+    print("read + parse_metadata + imdecode\t%f" % measure(lambda: single_read(path), args.repeat))
+    try:
+        pyexiv2_time = measure(lambda: pyexiv2_read(path), args.repeat)
+    except Exception as e:
+        print("get_metadata(pyexiv2) + imread\tnot available: %r" % e)
+    else:
+        print("get_metadata(pyexiv2) + imread\t%f" % pyexiv2_time)
@@ -0,0 +1,120 @@
+"""
+Benchmark of rectify_SIC per method - per-frame latency and peak RSS
+Each method runs in its own process, so that peak RSS of one method does not hide the other
+    python test/bench_rectify.py
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# (method, num_threads, resampling)
+METHODS = [('three_stage', 1, 'nearest'), ('fused', 1, 'nearest'),
+           ('three_stage', None, 'nearest'), ('fused', None, 'nearest'),
+           ('fused', None, 'bilinear'), ('fused', None, 'bicubic'),
+           ('homography', None, 'nearest'), ('homography', None, 'bilinear'), ('homography', None, 'bicubic'),
+           ('dem', None, 'nearest'), ('dem', None, 'bilinear')]
+
+
+def synthetic_frame(rows=1080, cols=1920, altitude=100, kappa=30):
+    """
+    A FHD frame of Galaxy S10 (SIC) over a flat ground
+    :return: image, focal_length(m), pixel_size(m), eo, ground_height
+    """
+    from server.my_drones import GalaxyS10_SIC
+    ipod_params = GalaxyS10_SIC().ipod_params
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(rows, cols, 3), dtype=np.uint8)
+    focal_length = ipod_params['focal_length']
+    pixel_size = ipod_params['sensor_width'] / cols / 1000
+    ground_height = ipod_params['ground_height']
+    eo = np.array([200000.0, 500000.0, ground_height + altitude, 0, 0, kappa * np.pi / 180])
+
+    return image, focal_length, pixel_size, eo, ground_height
+
+
+def synthetic_dem(eo, ground_height, cell=1.0, size=2000):
+    """
+    A DEM of hills of 5 m around ground_height, at cell m/px
+    """
+    from server.image_processing.orthophoto_generation.Dem import Dem
+
+    x = eo[0] - size * cell / 2 + (np.arange(size) + 0.5) * cell
+    y = eo[1] + size * cell / 2 - (np.arange(size) + 0.5) * cell
+    heights = ground_height + 5 * np.sin(x / 20)[np.newaxis, :] * np.cos(y / 15)[:, np.newaxis]
+    return Dem(heights.astype(np.float32), (eo[0] - size * cell / 2, cell, 0, eo[1] + size * cell / 2, 0, -cell))
+
+
+def run(method, num_threads, resampling, repeat):
+    from server.image_processing.orthophoto_generation.EoData import Rot3D
+    from server.image_processing.orthophoto_generation.Orthophoto import rectify_SIC
+
+    image, focal_length, pixel_size, eo, ground_height = synthetic_frame()
+    R_GC = Rot3D(eo)
+    # The DEM mode resamples through maps instead of a homography
+    dem = synthetic_dem(eo, ground_height) if method == 'dem' else None
+
+    def rectify(img, pixel_size):
+        return rectify_SIC(output_path='.', img_fname='bench.JPG', restored_image=img, focal_length=focal_length,
+                           pixel_size=pixel_size, eo=eo, R_GC=R_GC, ground_height=ground_height, epsg=3857,
+                           img_type=0, method=method, num_threads=num_threads,
+                           resampling=resampling, dem=dem)
+
+    # Compile the kernels on a small image first, not to count JIT in the results
+    rectify(np.ascontiguousarray(image[:64, :64]), pixel_size * 30)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    elapsed = []
+    for _ in range(repeat):
+        start_time = time.time()
+        _, orthophoto, _ = rectify(image, pixel_size)
+        elapsed.append(time.time() - start_time)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {
+        'method': method,
+        'num_threads': num_threads,
+        'resampling': resampling,
+        'shape': list(orthophoto.shape),
+        'latency_s': min(elapsed),
+        'peak_rss_mb': rss_after / 1024,
+        'peak_rss_increase_mb': (rss_after - rss_before) / 1024
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--method', default=None)
+    parser.add_argument('--num-threads', type=int, default=None)
+    parser.add_argument('--resampling', default='nearest')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.method is not None:
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            result = run(args.method, args.num_threads, args.resampling, args.repeat)
+            sys.stdout = stdout
+        print(json.dumps(result))
+    else:
+        print("Method | Threads | Resampling | Orthophoto shape | Latency (s) | Frames/s | "
+              "Peak RSS (MB) | Peak RSS increase (MB)")
+        for method, num_threads, resampling in METHODS:
+            cmd = [sys.executable, __file__, '--method', method, '--resampling', resampling,
+                   '--repeat', str(args.repeat)]
+            if num_threads is not None:
+                cmd += ['--num-threads', str(num_threads)]
+            out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout
+            result = json.loads(out.decode().strip().splitlines()[-1])
+            print("%s\t%s\t%s\t%s\t%f\t%.1f\t%.1f\t%.1f" % (result['method'], result['num_threads'] or 'all',
+                                                          result['resampling'], result['shape'],
+                                                          result['latency_s'], 1 / result['latency_s'],
+                                                          result['peak_rss_mb'], result['peak_rss_increase_mb']))
@@ -0,0 +1,54 @@
+"""
+Benchmark of formats of orthophotos for InnoMapViewer - encode time and payload size
+    python test/bench_viewer_encoding.py
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server.viewer_protocol import encode_orthophoto
+from bench_inference_encoding import synthetic_frame
+
+# (format, png level)
+FORMATS = [('png', None), ('png', 0), ('png', 1), ('png', 3), ('png', 6),
+           ('webp', None), ('jpeg+mask', None), ('raw', None)]
+
+
+def synthetic_orthophoto(rows, cols, kappa=30):
+    """
+    A frame rotated by kappa as rectify_SIC does, with alpha of 0 outside of the frame
+    """
+    image = cv2.cvtColor(synthetic_frame(rows, cols), cv2.COLOR_BGR2BGRA)
+    rotation = cv2.getRotationMatrix2D((cols / 2, rows / 2), kappa, 1.0)
+    cos, sin = abs(rotation[0, 0]), abs(rotation[0, 1])
+    boundary_cols, boundary_rows = int(rows * sin + cols * cos), int(rows * cos + cols * sin)
+    rotation[0, 2] += boundary_cols / 2 - cols / 2
+    rotation[1, 2] += boundary_rows / 2 - rows / 2
+    return cv2.warpAffine(image, rotation, (boundary_cols, boundary_rows), flags=cv2.INTER_NEAREST,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print("Orthophoto | Format | PNG level | Encode (s) | Bytes | Ratio to raw")
+    for rows, cols in [(1080, 1920), (3024, 4032)]:
+        orthophoto = synthetic_orthophoto(rows, cols)
+        for image_format, png_level in FORMATS:
+            elapsed = []
+            for _ in range(args.repeat):
+                start_time = time.time()
+                buffers, _ = encode_orthophoto(orthophoto, image_format, png_level=png_level)
+                elapsed.append(time.time() - start_time)
+            size = sum(memoryview(buffer).nbytes for buffer in buffers)
+            print("%dx%d\t%s\t%s\t%f\t%d\t%.3f" % (orthophoto.shape[1], orthophoto.shape[0], image_format,
+                                                 '-' if png_level is None else png_level, min(elapsed), size,
+                                                 size / orthophoto.nbytes))
@@ -0,0 +1,104 @@
+"""
+A stub inference server which speaks server/inference_protocol.py, for tests without the detector
+It answers each request on its own thread, so that responses of slow requests may come after later ones
+    python test/stub_inference_server.py --port 5010
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server.inference_protocol import read_frame, write_frame, decode_image, FORMATS, REQUEST_FORMATS, \
+    RESPONSE_BBOXES, RESPONSE_FORMATS, RESPONSE_ERROR
+
+
+class StubInferenceServer:
+    def __init__(self, host='127.0.0.1', port=0, detect=None, formats=None, answer_formats=True):
+        """
+        :param port: Port to listen - 0: any free port
+        :param detect: A function of a request payload to bboxes - detect(msg_type, payload), None: no bboxes
+        :param formats: Names of formats of images to support, None: all of FORMATS
+        :param answer_formats: False: REQUEST_FORMATS is ignored without an answer, as an old server does
+        """
+        self.detect = detect or (lambda msg_type, payload: [])
+        self.formats = list(FORMATS) if formats is None else formats
+        self.answer_formats = answer_formats
+        self.num_requests = 0
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(4)
+        self.port = self.server.getsockname()[1]
+        self.connections = []
+
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        self.server.close()
+        for conn in self.connections:
+            self.drop(conn)
+
+    def drop(self, conn):
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        write_lock = threading.Lock()
+        while True:
+            try:
+                msg_type, request_id, payload = read_frame(conn)
+            except (OSError, ValueError):
+                return
+            self.num_requests += 1
+            if msg_type == REQUEST_FORMATS and not self.answer_formats:
+                continue
+            threading.Thread(target=self._respond, args=(conn, write_lock, msg_type, request_id, payload),
+                             daemon=True).start()
+
+    def _respond(self, conn, write_lock, msg_type, request_id, payload):
+        try:
+            if msg_type == REQUEST_FORMATS:
+                response_type, response = RESPONSE_FORMATS, json.dumps(self.formats).encode()
+            else:
+                response_type, response = RESPONSE_BBOXES, json.dumps(self.detect(msg_type, payload)).encode()
+        except Exception as e:
+            response_type, response = RESPONSE_ERROR, str(e).encode()
+        try:
+            with write_lock:
+                write_frame(conn, response_type, request_id, response)
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=5010)
+    parser.add_argument('--delay', type=float, default=0.1, help='Seconds of inference per request')
+    args = parser.parse_args()
+
+    def detect(msg_type, payload):
+        image = decode_image(msg_type, payload)
+        time.sleep(args.delay)
+        return [[10, 20, min(110, image.shape[1]), min(220, image.shape[0]), 3]]
+
+    stub = StubInferenceServer(host='0.0.0.0', port=args.port, detect=detect)
+    print('Stub inference server on port %d' % stub.port)
+    while True:
+        time.sleep(1)
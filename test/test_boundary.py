@@ -0,0 +1,24 @@
+import numpy as np
+
+from server.image_processing.orthophoto_generation.EoData import Rot3D
+from server.image_processing.orthophoto_generation.Boundary import transform_bbox, transform_bboxes, \
+    export_bbox_to_wkt3, export_bboxes_to_wkt
+
+eo = np.array([14134000.5, 4518000.25, 150, 0.05, -0.03, 0.7])
+R_CG = Rot3D(eo).T
+
+
+def test_transform_bboxes():
+    rng = np.random.default_rng(0)
+    bboxes = np.concatenate([rng.uniform(0, 1900, size=(50, 4)), rng.integers(0, 5, size=(50, 1))], axis=1)
+    bboxes[0, 0:4] = [10.5, 11.5, 20.5, 21.5]   # Halves are rounded to even
+    corners = transform_bboxes(bboxes, 1080, 1920, 0.0014, 0.00432, eo, R_CG, 33.5)
+
+    assert corners.shape == (50, 4, 2)
+    for bbox, bbox_corners in zip(bboxes, corners):
+        expected = transform_bbox(bbox, 1080, 1920, 0.0014, 0.00432, eo, R_CG, 33.5).T
+        assert np.allclose(bbox_corners, expected, rtol=0, atol=1e-6)
+    assert export_bboxes_to_wkt(corners)[1] == export_bbox_to_wkt3(corners[1])
+
+    assert transform_bboxes([], 1080, 1920, 0.0014, 0.00432, eo, R_CG, 33.5).shape == (0, 4, 2)
+    assert export_bboxes_to_wkt(np.empty((0, 4, 2))) == []
@@ -0,0 +1,146 @@
+import time
+import tracemalloc
+
+import numpy as np
+
+from server.image_processing.orthophoto_generation.EoData import Rot3D
+from server.image_processing.orthophoto_generation.Orthophoto import rectify_SIC
+from server.image_processing.orthophoto_generation.BackprojectionResample import backProjectPoint
+from server.image_processing.orthophoto_generation.Dem import Dem, tileMinMax
+from test_rectify import synthetic_frame, sampled_pixels, focal_length, ground_height
+
+
+def sloped_dem(eo, slope=0.2, cell=0.5, size=800):
+    """
+    A DEM of a plane rising to the east through ground_height at the nadir
+    """
+    xmin = eo[0] - size * cell / 2
+    ymax = eo[1] + size * cell / 2
+    x = xmin + (np.arange(size) + 0.5) * cell
+    heights = np.tile(ground_height + slope * (x - eo[0]), (size, 1)).astype(np.float32)
+    return Dem(heights, (xmin, cell, 0, ymax, 0, -cell), tile_size=64)
+
+
+def rectify(image, pixel_size, eo, dem=None, method='homography'):
+    return rectify_SIC(output_path='.', img_fname='test.JPG', restored_image=image, focal_length=focal_length,
+                       pixel_size=pixel_size, eo=eo, R_GC=Rot3D(eo), ground_height=ground_height, epsg=3857,
+                       img_type=0, method=method, dem=dem)
+
+
+def test_tile_min_max():
+    heights = np.arange(16, dtype=np.float32).reshape(4, 4)
+    heights[0:2, 2:4] = np.nan
+    tile_min, tile_max = tileMinMax(heights, 2)
+    # Tiles include a pixel around them
+    assert tile_min[0, 0] == 0 and tile_max[0, 0] == 10
+    assert tile_min[0, 1] == 1 and tile_max[0, 1] == 11
+    assert tile_max[1, 1] == 15
+
+
+def test_intersect():
+    image, pixel_size, eo = synthetic_frame(kappa=37)
+    dem = sloped_dem(eo)
+    directions = np.array([[0, 0.3, -0.2, 0.25], [0, 0.1, -0.3, 0], [-1, -1, -0.5, -2]])
+
+    points = dem.intersect(eo, directions, ground_height)
+    # On the plane, and on the rays
+    assert np.allclose(points[2], ground_height + 0.2 * (points[0] - eo[0]), atol=1e-3)
+    scale = (eo[2] - points[2]) / -directions[2]
+    assert np.allclose(points[0:2], eo[0:2, np.newaxis] + directions[0:2] * scale, atol=1e-6)
+
+    # Out of the DEM, the ground is at default_height
+    far = dem.intersect(eo, np.array([[5], [0], [-1]]), ground_height)
+    assert np.isclose(far[2, 0], ground_height)
+
+
+def test_intersect_horizon():
+    image, pixel_size, eo = synthetic_frame(kappa=37)
+    dem = sloped_dem(eo)
+    # Horizontal and upward rays, and a ray just under the horizon, which leaves the DEM long before the plane
+    directions = np.array([[1, 1, 0, 1, 1], [0, 0, 0, 0.5, 0], [-1e-9, 0.1, 1, 0, -1e-6]])
+
+    # Compiled before timing
+    dem.intersect(eo, np.array([[0.0], [0], [-1]]), ground_height)
+    start_time = time.time()
+    points = dem.intersect(eo, directions, ground_height)
+    assert time.time() - start_time < 1
+    # On the plane of the ground, as the flat ground, and not under the projection center for the horizontal rays
+    assert np.all(points[2] == ground_height)
+    assert np.all(np.isfinite(points))
+    assert np.allclose(points[0:2, 4], eo[0:2] + directions[0:2, 4] * (eo[2] - ground_height) / 1e-6)
+    assert points[0, 0] > eo[0] + 1e9 and points[0, 3] > eo[0] + 1e9
+
+
+def test_flat_dem_matches_flat_ground():
+    image, pixel_size, eo = synthetic_frame(omega=5, phi=-3, kappa=37)
+    flat = Dem(np.full((800, 800), ground_height, dtype=np.float32),
+               (eo[0] - 200, 0.5, 0, eo[1] + 200, 0, -0.5))
+
+    bbox_wkt, expected, expected_geotransform = rectify(image, pixel_size, eo)
+    _, orthophoto, geotransform = rectify(image, pixel_size, eo, dem=flat)
+    assert np.allclose(geotransform, expected_geotransform, atol=1e-6)
+    assert orthophoto.shape == expected.shape
+    valid = (orthophoto[:, :, 3] == 255) & (expected[:, :, 3] == 255)
+    assert (orthophoto[:, :, 3] != expected[:, :, 3]).mean() < 0.001
+    # Both sample the same pixel, except for ground points on the edge of two pixels
+    assert (orthophoto[valid] == expected[valid]).all(axis=1).mean() > 0.99
+
+
+def test_sloped_dem():
+    image, pixel_size, eo = synthetic_frame(kappa=37)
+    dem = sloped_dem(eo)
+
+    _, orthophoto, geotransform = rectify(image, pixel_size, eo, dem=dem)
+    rows, cols = sampled_pixels(orthophoto)
+    R = Rot3D(eo)
+    rng = np.random.default_rng(0)
+    valid = np.argwhere(orthophoto[:, :, 3] == 255)
+    errors = []
+    for row, col in valid[rng.choice(len(valid), 200)]:
+        x = geotransform[0] + col * geotransform[1]
+        y = geotransform[3] + row * geotransform[5]
+        height = ground_height + 0.2 * (x - eo[0])
+        proj_row, proj_col = backProjectPoint(R, x - eo[0], y - eo[1], height - eo[2], focal_length, pixel_size,
+                                              image.shape[0], image.shape[1])
+        errors.append(max(abs(rows[row, col] - int(proj_row)), abs(cols[row, col] - int(proj_col))))
+    assert max(errors) <= 1
+
+    # The ground rises to the east, where the boundary is narrower than over the flat ground
+    _, flat, flat_geotransform = rectify(image, pixel_size, eo)
+    assert geotransform[0] + orthophoto.shape[1] * geotransform[1] < \
+        flat_geotransform[0] + flat.shape[1] * flat_geotransform[1]
+
+
+def test_budget_over_dem():
+    restored, pixel_size, eo = synthetic_frame(rows=270, cols=480, kappa=37)
+    dem = sloped_dem(eo)
+    # The image to restore, whose orientation is folded into the maps
+    image = np.ascontiguousarray(np.rot90(restored, -1))
+    max_bytes = 2500000
+
+    for img_type, resampling, orientation in [(0, 'bilinear', 6), (0, 'nearest', 1), (1, 'bilinear', 1)]:
+        kwargs = dict(output_path='.', img_fname='test.JPG', restored_image=image if orientation == 6 else restored,
+                      focal_length=focal_length, pixel_size=pixel_size, eo=eo, R_GC=Rot3D(eo),
+                      ground_height=ground_height, epsg=3857, img_type=img_type, resampling=resampling, dem=dem,
+                      orientation=orientation, num_threads=1)
+        # Copies of the image in BGRA, with a border of 2 px in BGR and BGRA for interpolation, not of the orthophoto
+        if img_type == 1:
+            image_bytes = 0
+        elif resampling == 'nearest':
+            image_bytes = restored.size // 3 * 4
+        else:
+            image_bytes = (restored.shape[0] + 4) * (restored.shape[1] + 4) * 7
+
+        peaks = []
+        for budget in [None, max_bytes]:
+            rectify_SIC(max_bytes=budget, **kwargs)  # Compiled before measuring
+            tracemalloc.start()
+            try:
+                start = tracemalloc.get_traced_memory()[0]
+                orthophoto = rectify_SIC(max_bytes=budget, **kwargs)[1]
+                peaks.append(tracemalloc.get_traced_memory()[1] - start - image_bytes)
+            finally:
+                tracemalloc.stop()
+        assert peaks[0] > max_bytes
+        assert max_bytes * 0.5 < peaks[1] <= max_bytes
+        assert orthophoto.shape[0] * orthophoto.shape[1] > 0
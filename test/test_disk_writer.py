@@ -0,0 +1,46 @@
+import os
+import threading
+
+from server.disk_writer import DiskWriter
+
+
+def test_write_and_join(tmp_path):
+    disk_writer = DiskWriter(max_bytes=1024)
+    paths = [str(tmp_path / 'project' / ('%d.JPG' % i)) for i in range(20)]
+    for i, path in enumerate(paths):
+        disk_writer.write(path, bytes([i]) * 100)
+    assert disk_writer.join(timeout=5)
+
+    for i, path in enumerate(paths):
+        with open(path, 'rb') as f:
+            assert f.read() == bytes([i]) * 100
+    assert not [fname for fname in os.listdir(str(tmp_path / 'project')) if fname.endswith('.tmp')]
+    metrics = disk_writer.metrics()
+    assert metrics['num_written'] == 20 and metrics['pending_files'] == 0 and metrics['pending_bytes'] == 0
+    assert metrics['max_pending_bytes'] <= 1024
+
+
+def test_write_blocks_over_max_bytes(tmp_path, monkeypatch):
+    release = threading.Event()
+    replace = os.replace
+    monkeypatch.setattr(os, 'replace', lambda src, dst: (release.wait(), replace(src, dst)))
+
+    disk_writer = DiskWriter(max_bytes=150)
+    disk_writer.write(str(tmp_path / 'a'), b'0' * 100)
+    written = threading.Event()
+    thread = threading.Thread(target=lambda: (disk_writer.write(str(tmp_path / 'b'), b'1' * 100), written.set()))
+    thread.start()
+    # The second file waits until the first one is written
+    assert not written.wait(timeout=0.2)
+    assert disk_writer.metrics()['pending_files'] == 1
+
+    release.set()
+    assert written.wait(timeout=5)
+    assert disk_writer.join(timeout=5)
+    assert disk_writer.metrics()['max_pending_bytes'] == 100
+
+    # A directory in the way fails the file, which still leaves the queue
+    (tmp_path / 'c').mkdir()
+    disk_writer.write(str(tmp_path / 'c'), b'2')
+    assert disk_writer.join(timeout=5)
+    assert disk_writer.metrics()['num_failed'] == 1 and disk_writer.metrics()['num_written'] == 2
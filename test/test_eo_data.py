@@ -0,0 +1,16 @@
+import numpy as np
+
+from server.image_processing.orthophoto_generation.EoData import get_transformation, geographic2plane, \
+    geographic2plane_many
+
+
+def test_geographic2plane_many():
+    eos = np.array([[126.97, 37.56, 150, 0, 0, 0],
+                    [126.98, 37.57, 150, 0, 0, 0],
+                    [129.07, 35.18, 150, 0, 0, 0]])
+    expected = np.array([geographic2plane(eo.copy(), 3857)[0:2] for eo in eos])
+    assert np.allclose(geographic2plane_many(eos, 3857), expected)
+    assert geographic2plane_many(np.empty((0, 2)), 3857).shape == (0, 2)
+
+    # Transformations are made once
+    assert get_transformation(4326, 3857) is get_transformation(4326, 3857)
@@ -0,0 +1,134 @@
+import struct
+
+import cv2
+import numpy as np
+import pytest
+
+from server.image_processing.orthophoto_generation.ExifData import ImageMetadata, get_metadata, parse_metadata, \
+    restoreOrientation, orientationHomography
+
+XMP = ('<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+       '<rdf:Description rdf:about="" xmlns:DLS="http://www.dls.com/" DLS:FrameID="frame-&amp;-1" '
+       'DLS:TaskID="task-7" DLS:GPSLongitude="126.9784" DLS:GPSLatitude="37.5665" '
+       'DLS:BeforeGPSLongitude="126.9783" DLS:BeforeGPSLatitude="37.5664">'
+       '<DLS:Roll>0.01</DLS:Roll><DLS:Pitch>-0.02</DLS:Pitch><DLS:Yaw>1.5</DLS:Yaw>'
+       '</rdf:Description></rdf:RDF></x:xmpmeta>')
+
+
+def ifd(entries, offset, endian):
+    """
+    :param entries: A list of (tag, type, count, bytes of values)
+    :param offset: The offset of the IFD in the TIFF structure
+    :return: Bytes of the IFD and its values which do not fit in the entries
+    """
+    header = struct.pack(endian + 'H', len(entries))
+    values = b''
+    values_offset = offset + 2 + 12 * len(entries) + 4
+    for tag, tiff_type, count, data in entries:
+        if len(data) > 4:
+            header += struct.pack(endian + 'HHII', tag, tiff_type, count, values_offset + len(values))
+            values += data
+        else:
+            header += struct.pack(endian + 'HHI', tag, tiff_type, count) + data.ljust(4, b'\x00')
+    return header + struct.pack(endian + 'I', 0) + values
+
+
+def tiff_structure(endian, maker='samsung', orientation=6, xmp=None):
+    """
+    IFD0, the EXIF IFD and the GPS IFD of a TIFF structure, with the XMP packet in IFD0 for a TIFF
+    """
+    head = (b'II*\x00' if endian == '<' else b'MM\x00*') + struct.pack(endian + 'I', 8)
+    ifd0_entries = [(0x010F, 2, len(maker) + 1, maker.encode() + b'\x00'),
+                    (0x0112, 3, 1, struct.pack(endian + 'H', orientation))]
+    if xmp is not None:
+        ifd0_entries.append((0x02BC, 1, len(xmp), xmp))
+    ifd0_entries += [(0x8769, 4, 1, b'\x00' * 4), (0x8825, 4, 1, b'\x00' * 4)]
+
+    ifd0 = ifd(ifd0_entries, 8, endian)
+    exif_offset = 8 + len(ifd0)
+    exif = ifd([(0x920A, 5, 1, struct.pack(endian + 'II', 43, 10))], exif_offset, endian)
+    gps_offset = exif_offset + len(exif)
+    gps = ifd([(0x0005, 1, 1, b'\x00'), (0x0006, 5, 1, struct.pack(endian + 'II', 1505, 10))], gps_offset, endian)
+
+    ifd0_entries[-2:] = [(0x8769, 4, 1, struct.pack(endian + 'I', exif_offset)),
+                         (0x8825, 4, 1, struct.pack(endian + 'I', gps_offset))]
+    return head + ifd(ifd0_entries, 8, endian) + exif + gps
+
+
+def tagged_jpeg(image, endian='<', maker='samsung', orientation=6, xmp=XMP):
+    """
+    A JPEG of the image with APP1 segments of EXIF and XMP, as a smartphone of DLS writes
+    """
+    jpeg = cv2.imencode('.jpg', image)[1].tobytes()
+    exif = b'Exif\x00\x00' + tiff_structure(endian, maker, orientation)
+    xmp = b'http://ns.adobe.com/xap/1.0/\x00' + xmp.encode()
+    segments = b''.join(b'\xff\xe1' + struct.pack('>H', len(data) + 2) + data for data in [exif, xmp])
+    return jpeg[0:2] + segments + jpeg[2:]
+
+
+def test_parse_metadata():
+    image = np.zeros((16, 24, 3), dtype=np.uint8)
+    for endian in ['<', '>']:
+        image_bytes = tagged_jpeg(image, endian)
+        image_metadata = parse_metadata(image_bytes)
+
+        assert isinstance(image_metadata, ImageMetadata)
+        assert not hasattr(image_metadata, '__dict__')
+        focal_length, orientation, eo, before_lonlat, uuid, task_id, maker = image_metadata
+        assert focal_length == pytest.approx(0.0043)
+        assert orientation == 6
+        assert uuid == 'frame-&-1' and task_id == 'task-7' and maker == 'samsung'
+        assert np.allclose(eo, [126.9784, 37.5665, 150.5, 0.01 * 180 / np.pi, -0.02 * 180 / np.pi,
+                                1.5 * 180 / np.pi])
+        assert np.allclose(before_lonlat, [126.9783, 37.5664])
+
+        # Bytes of a file are parsed as well, and still decoded
+        assert get_metadata(bytearray(image_bytes), 'Linux').uuid == 'frame-&-1'
+        decoded = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8),
+                               cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        assert decoded.shape == image.shape
+
+    # XMP in IFD0 of a TIFF
+    tiff = tiff_structure('>', xmp=XMP.encode())
+    assert parse_metadata(tiff).task_id == 'task-7'
+
+
+def test_parse_metadata_dji():
+    xmp = ('<rdf:Description xmlns:drone-dji="http://www.dji.com/drone-dji/1.0/" DLS:FrameID="f" DLS:TaskID="t" '
+           'DLS:GPSLongitude="127.1" DLS:GPSLatitude="37.2" drone-dji:RelativeAltitude="+80.30" '
+           'drone-dji:GimbalRollDegree="0.00" drone-dji:GimbalPitchDegree="-90.00" '
+           'drone-dji:GimbalYawDegree="+12.50"/>')
+    image_metadata = parse_metadata(tagged_jpeg(np.zeros((8, 8, 3), dtype=np.uint8), maker='DJI', xmp=xmp))
+    assert np.allclose(image_metadata.eo, [127.1, 37.2, 80.3, 0, -90, 12.5])
+    assert np.isnan(image_metadata.before_lonlat).all()
+
+    # A missing key fails as pyexiv2 does
+    with pytest.raises(KeyError, match='RelativeAltitude'):
+        parse_metadata(tagged_jpeg(np.zeros((8, 8, 3), dtype=np.uint8), maker='DJI', xmp=xmp[:150] + '/>'))
+    with pytest.raises(ValueError):
+        parse_metadata(cv2.imencode('.png', np.zeros((8, 8, 3), dtype=np.uint8))[1].tobytes())
+
+
+def test_restore_orientation():
+    image = np.random.default_rng(0).integers(0, 256, size=(5, 7, 3), dtype=np.uint8)
+    # 6 and 8 rotate by 90 counterclockwise and clockwise, which undo the rotations for display of OpenCV
+    assert np.array_equal(restoreOrientation(image, 6)[0, 0], image[0, -1])
+    assert np.array_equal(restoreOrientation(image, 8)[0, 0], image[-1, 0])
+    for orientation in range(0, 9):
+        restored = restoreOrientation(image, orientation)
+        assert restored.shape == ((7, 5, 3) if orientation >= 5 else image.shape)
+        assert np.array_equal(restoreOrientation(image, orientation, view=True), restored)
+        assert np.array_equal(restoreOrientation(image[:, :, 0], orientation), restored[:, :, 0])
+
+        # (col, row) of the restored image to (col, row) of the image
+        row, col = np.mgrid[0:restored.shape[0], 0:restored.shape[1]]
+        O = orientationHomography(orientation, image.shape)
+        assert np.array_equal(image[(O[1, 0] * col + O[1, 1] * row + O[1, 2]).astype(int),
+                                    (O[0, 0] * col + O[0, 1] * row + O[0, 2]).astype(int)], restored)
+
+    # Decoded with the orientation applied by OpenCV and restored, or decoded as it is
+    image_bytes = tagged_jpeg(cv2.resize(image, (64, 48), interpolation=cv2.INTER_CUBIC), orientation=6)
+    decoded = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    assert np.array_equal(restoreOrientation(decoded, 6),
+                          cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8),
+                                       cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION))
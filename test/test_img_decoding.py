@@ -0,0 +1,28 @@
+import cv2
+import numpy as np
+
+from server.image_processing.img_decoding import decode_image, scale_bboxes
+from test_exif_data import tagged_jpeg
+
+
+def test_decode_image():
+    image = cv2.GaussianBlur(np.random.default_rng(0).integers(0, 256, size=(300, 404, 3), dtype=np.uint8),
+                             (0, 0), 4)
+    # Decoded as it is, without the rotation for display of the orientation
+    image_bytes = tagged_jpeg(image, orientation=6)
+    images = decode_image(image_bytes, {1, 4, 8})
+    assert images[1].shape == (300, 404, 3)
+    assert images[4].shape == (75, 101, 3)
+    assert images[8].shape == (38, 51, 3)
+
+    images = decode_image(image_bytes, {4, 8})
+    assert images[4].shape == (75, 101, 3) and images[8].shape == (38, 51, 3)
+    # Scaling of JPEG is close to averaging blocks of pixels
+    assert np.abs(images[4].astype(int) - cv2.resize(image, (101, 75), interpolation=cv2.INTER_AREA)).mean() < 3
+
+
+def test_scale_bboxes():
+    bboxes = [[10, 20, 30.5, 40, 3], [0, 0, 101, 75, 1, 0.9]]
+    scaled = scale_bboxes(bboxes, (75, 101, 3), (300, 404, 3))
+    assert scaled == [[40, 80, 122, 160, 3], [0, 0, 404, 300, 1, 0.9]]
+    assert scale_bboxes(bboxes, (75, 101, 3), (75, 101)) is bboxes
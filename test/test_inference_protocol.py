@@ -0,0 +1,123 @@
+import json
+import socket
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from server.inference_protocol import InferenceClient, encode_image, decode_image, choose_format, \
+    REQUEST_PNG, REQUEST_RAW, REQUEST_JPEG, REQUEST_ORIGINAL
+from stub_inference_server import StubInferenceServer
+
+
+def test_concurrent_requests_out_of_order():
+    def detect(msg_type, payload):
+        # The first request is the slowest
+        time.sleep(0.3 if payload == b'x' else 0.05)
+        if payload == b'error':
+            raise ValueError('cannot decode')
+        return [[len(payload), 0, 1, 1, 3]]
+
+    stub = StubInferenceServer(detect=detect)
+    client = InferenceClient('stub', '127.0.0.1', stub.port, timeout=1)
+
+    results = {}
+
+    def infer(i):
+        results[i] = json.loads(client.request(b'x' * (i + 1)))
+
+    start_time = time.time()
+    threads = [threading.Thread(target=infer, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # All in flight at the same time over one connection
+    assert time.time() - start_time < 0.3 * 2
+    assert results == {i: [[i + 1, 0, 1, 1, 3]] for i in range(8)}
+    assert len(stub.connections) == 1
+
+    # Larger than 65535 bytes, which the header of the old protocol could not carry
+    big = client.submit(b'x' * 70000)
+    with pytest.raises(RuntimeError):
+        client.request(b'error')
+    assert json.loads(big.result(5)) == [[70000, 0, 1, 1, 3]]
+
+    client.close()
+    stub.close()
+
+
+def test_reconnect_after_drop():
+    stub = StubInferenceServer(detect=lambda msg_type, payload: [[1, 2, 3, 4, 5]])
+    client = InferenceClient('stub', '127.0.0.1', stub.port, timeout=1, retries=3, backoff=0.01)
+
+    assert json.loads(client.request(b'png')) == [[1, 2, 3, 4, 5]]
+    stub.drop(stub.connections[0])
+    time.sleep(0.05)
+    assert json.loads(client.request(b'png')) == [[1, 2, 3, 4, 5]]
+    assert len(stub.connections) == 2
+
+    client.close()
+    stub.close()
+
+
+def test_negotiate_formats():
+    row, col = np.mgrid[0:30, 0:40]
+    image = np.dstack([row * 8, col * 6, row + col]).astype(np.uint8)
+    original = cv2.imencode('.jpg', image)[1].tobytes()
+    decoded = {}
+
+    def detect(msg_type, payload):
+        decoded[msg_type] = decode_image(msg_type, payload)
+        return []
+
+    stub = StubInferenceServer(detect=detect, formats=['png', 'raw'])
+    client = InferenceClient('stub', '127.0.0.1', stub.port, timeout=1)
+
+    assert client.formats() == ['png', 'raw']
+    assert choose_format(['original', 'jpeg', 'raw'], client.formats(), passthrough=True) == 'raw'
+    assert choose_format(['jpeg'], client.formats(), passthrough=True) == 'png'
+
+    for image_format in ['png', 'raw', 'jpeg', 'original']:
+        client.request(*encode_image(image, image_format, jpeg_quality=95, original=original))
+    assert np.array_equal(decoded[REQUEST_PNG], image)
+    assert np.array_equal(decoded[REQUEST_RAW], image)
+    assert np.abs(decoded[REQUEST_JPEG].astype(int) - image).mean() < 10
+    assert np.array_equal(decoded[REQUEST_ORIGINAL], cv2.imdecode(np.frombuffer(original, np.uint8), 1))
+
+    client.close()
+    stub.close()
+
+
+def test_formats_of_old_server():
+    stub = StubInferenceServer(detect=lambda msg_type, payload: [[1, 2, 3, 4, 5]], answer_formats=False)
+    client = InferenceClient('stub', '127.0.0.1', stub.port, timeout=1)
+
+    # No answer falls back to png, once per connection
+    start_time = time.time()
+    assert client.formats(timeout=0.2) == ['png']
+    assert client.formats(timeout=0.2) == ['png']
+    assert time.time() - start_time < 0.4
+    assert stub.num_requests == 1
+    assert json.loads(client.request(b'png', REQUEST_PNG, timeout=1)) == [[1, 2, 3, 4, 5]]
+
+    # A new connection is queried again
+    stub.drop(stub.connections[0])
+    time.sleep(0.05)
+    assert client.formats(timeout=0.2) == ['png']
+    assert len(stub.connections) == 2 and stub.num_requests == 3
+
+    client.close()
+    stub.close()
+
+    # A server which is not up
+    unused = socket.socket()
+    unused.bind(('127.0.0.1', 0))
+    port = unused.getsockname()[1]
+    unused.close()
+    client = InferenceClient('stub', '127.0.0.1', port, timeout=0.2, retries=1)
+    assert client.formats(timeout=0.2) == ['png']
+    assert client.server_formats is None
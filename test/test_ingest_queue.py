@@ -0,0 +1,54 @@
+import threading
+import time
+
+from server.ingest_queue import IngestQueue
+
+
+def wait_for(ingest_queue, job_id, state, timeout=5):
+    start_time = time.time()
+    while ingest_queue.status(job_id)['state'] != state:
+        assert time.time() - start_time < timeout
+        time.sleep(0.01)
+
+
+def test_jobs_report_stage_and_state():
+    ingest_queue = IngestQueue(max_size=4, num_workers=1)
+    release = threading.Event()
+
+    def job_func(job, value):
+        job.stage = 'working on %d' % value
+        release.wait()
+        if value < 0:
+            raise ValueError('negative')
+
+    job_id = ingest_queue.submit(job_func, 1)
+    failing_job_id = ingest_queue.submit(job_func, -1)
+    wait_for(ingest_queue, job_id, 'processing')
+    assert ingest_queue.status(job_id)['stage'] == 'working on 1'
+    assert ingest_queue.status(failing_job_id)['state'] == 'queued'
+
+    release.set()
+    wait_for(ingest_queue, job_id, 'done')
+    wait_for(ingest_queue, failing_job_id, 'failed')
+    assert ingest_queue.status(failing_job_id)['error'] == 'negative'
+    assert ingest_queue.status('unknown') is None
+
+
+def test_full_queue_rejects():
+    ingest_queue = IngestQueue(max_size=2, num_workers=1)
+    release = threading.Event()
+
+    first_job_id = ingest_queue.submit(lambda job: release.wait())
+    wait_for(ingest_queue, first_job_id, 'processing')
+    assert ingest_queue.submit(lambda job: None) is not None
+    assert ingest_queue.submit(lambda job: None) is not None
+    assert ingest_queue.submit(lambda job: None) is None
+    assert ingest_queue.submit(lambda job: None, timeout=0.05) is None
+
+    metrics = ingest_queue.metrics()
+    assert metrics['queue_depth'] == 2 and metrics['max_queue_depth'] == 2
+    assert metrics['busy_workers'] == 1 and metrics['num_rejected'] == 2
+
+    release.set()
+    ingest_queue.queue.join()
+    assert ingest_queue.metrics()['queue_depth'] == 0
@@ -0,0 +1,162 @@
+import numpy as np
+import pytest
+
+from server.image_processing.orthophoto_generation import Mosaic as mosaic_module
+from server.image_processing.orthophoto_generation.EoData import Rot3D
+from server.image_processing.orthophoto_generation.Orthophoto import rectify_SIC
+from server.image_processing.orthophoto_generation.Tiles import TILE_SIZE, resolution, tile_bounds, tile_range
+from server.image_processing.orthophoto_generation.Mosaic import Mosaic
+
+
+def solid_orthophoto(z, x, y, rows, cols, color):
+    """
+    A solid orthophoto whose north-west corner is the one of tile (z, x, y), with gsd of zoom level z
+    """
+    orthophoto = np.empty((rows, cols, 4), dtype=np.uint8)
+    orthophoto[:] = color + (255,)
+    xmin, _, _, ymax = tile_bounds(z, x, y)
+    return orthophoto, (xmin, resolution(z), 0, ymax, 0, -resolution(z))
+
+
+def center(z, x, y):
+    xmin, ymin, xmax, ymax = tile_bounds(z, x, y)
+    return (xmin + xmax) / 2, (ymin + ymax) / 2
+
+
+def test_dirty_tiles(tmp_path):
+    z, x, y = 20, 1000, 2000
+    mosaic = Mosaic(str(tmp_path), zoom=z, min_zoom=z - 1)
+    orthophoto, geotransform = solid_orthophoto(z, x, y, TILE_SIZE, 2 * TILE_SIZE, (10, 20, 30))
+    assert mosaic.add(orthophoto, geotransform) == 2
+
+    changed = dict(mosaic.flush())
+    assert sorted(changed) == [(z - 1, 500, 1000), (z, x, y), (z, x + 1, y)]
+    assert (changed[(z, x, y)] == (10, 20, 30, 255)).all()
+    # The orthophoto is at the north half of the overview
+    assert (changed[(z - 1, 500, 1000)][:TILE_SIZE // 2] == (10, 20, 30, 255)).all()
+    assert not changed[(z - 1, 500, 1000)][TILE_SIZE // 2:, :, 3].any()
+    # Nothing changed since the last flush
+    assert mosaic.flush() == []
+
+    # Only the touched tile is dirty
+    orthophoto, geotransform = solid_orthophoto(z, x + 1, y, TILE_SIZE, TILE_SIZE, (40, 50, 60))
+    mosaic.add(orthophoto, geotransform)
+    assert [key for key, _ in mosaic.flush()] == [(z, x + 1, y), (z - 1, 500, 1000)]
+    assert (mosaic.tile(z, x, y) == (10, 20, 30, 255)).all()
+    assert mosaic.tile(z, x, y + 5) is None
+
+
+def test_blending(tmp_path):
+    z, x, y = 20, 1000, 2000
+    first, geotransform = solid_orthophoto(z, x, y, TILE_SIZE, 2 * TILE_SIZE, (100, 100, 100))
+    second = solid_orthophoto(z, x, y, TILE_SIZE, 2 * TILE_SIZE, (200, 200, 200))[0]
+
+    mosaic = Mosaic(str(tmp_path / 'last'), zoom=z, min_zoom=z, blending='last')
+    mosaic.add(first, geotransform)
+    mosaic.add(second, geotransform)
+    assert (mosaic.tile(z, x, y)[:, :, 0] == 200).all()
+
+    # The nadir of the first one is over the west tile, and the one of the second one is over the east tile
+    mosaic = Mosaic(str(tmp_path / 'nadir'), zoom=z, min_zoom=z, blending='nadir')
+    mosaic.add(first, geotransform, center(z, x, y))
+    mosaic.add(second, geotransform, center(z, x + 1, y))
+    assert (mosaic.tile(z, x, y)[:, :TILE_SIZE - 1, 0] == 100).all()
+    assert (mosaic.tile(z, x + 1, y)[:, 1:, 0] == 200).all()
+
+    # The second one fades in from its boundary
+    mosaic = Mosaic(str(tmp_path / 'feather'), zoom=z, min_zoom=z, blending='feather', feather_width=32)
+    mosaic.add(first, geotransform)
+    mosaic.add(second, geotransform)
+    tile = mosaic.tile(z, x, y)
+    assert tile[128, 0, 0] < 110
+    assert 100 < tile[128, 16, 0] < 200
+    assert tile[128, 128, 0] == 200
+    assert (tile[:, :, 3] == 255).all()
+
+    with pytest.raises(ValueError):
+        Mosaic(str(tmp_path), zoom=z, min_zoom=z, blending='average')
+
+
+def test_spill(tmp_path):
+    z, x, y = 20, 1000, 2000
+    mosaic = Mosaic(str(tmp_path), zoom=z, min_zoom=z - 2, blending='nadir', max_tiles=2)
+    orthophoto, geotransform = solid_orthophoto(z, x, y, 2 * TILE_SIZE, 4 * TILE_SIZE, (1, 2, 3))
+    mosaic.add(orthophoto, geotransform, center(z, x, y))
+    assert len(mosaic.tiles) == 2
+
+    changed = dict(mosaic.flush())
+    assert len(changed) == 8 + 2 + 1
+    assert len(mosaic.tiles) == 2
+    # Spilled tiles come back from disk, with distances to the nadir
+    assert (mosaic.tile(z, x + 3, y + 1) == (1, 2, 3, 255)).all()
+    assert (changed[(z - 2, 250, 500)][:TILE_SIZE // 2] == (1, 2, 3, 255)).all()
+    orthophoto[:] = (7, 8, 9, 255)
+    mosaic.add(orthophoto, geotransform, center(z, x + 3, y + 1))
+    assert (mosaic.tile(z, x + 3, y + 1) == (7, 8, 9, 255)).all()
+    assert (mosaic.tile(z, x, y) == (1, 2, 3, 255)).all()
+
+
+def test_restart(tmp_path):
+    z, x, y = 20, 1000, 2000
+    mosaic = Mosaic(str(tmp_path), zoom=z, min_zoom=z - 1, blending='nadir', max_tiles=2)
+    orthophoto, geotransform = solid_orthophoto(z, x, y, TILE_SIZE, 2 * TILE_SIZE, (1, 2, 3))
+    mosaic.add(orthophoto, geotransform, center(z, x + 2, y))
+    mosaic.flush()
+    # Both tiles change again, the east one in memory after it is spilled
+    orthophoto[:] = (4, 5, 6, 255)
+    mosaic.add(orthophoto, geotransform, center(z, x + 1, y))
+    mosaic.flush()
+    assert (z, x + 1, y) in mosaic.tiles
+
+    # A restarted mosaic has the tiles and the distances to the nadir of the last flush
+    mosaic = Mosaic(str(tmp_path), zoom=z, min_zoom=z - 1, blending='nadir', max_tiles=2)
+    assert (mosaic.tile(z, x, y) == (4, 5, 6, 255)).all()
+    orthophoto, geotransform = solid_orthophoto(z, x + 1, y, TILE_SIZE, TILE_SIZE, (7, 8, 9))
+    mosaic.add(orthophoto, geotransform, center(z, x + 4, y))
+    changed = dict(mosaic.flush())
+    assert sorted(changed) == [(z - 1, 500, 1000), (z, x + 1, y)]
+    assert (changed[(z, x + 1, y)] == (4, 5, 6, 255)).all()
+    # The overview is of both tiles, not only the one which changed after the restart
+    assert (changed[(z - 1, 500, 1000)][:TILE_SIZE // 2] == (4, 5, 6, 255)).all()
+
+
+def test_budget(tmp_path, monkeypatch):
+    # An oblique frame from 1000 m, whose footprint is far larger than the orthophoto budgeted for it
+    rows, cols = 540, 960
+    image = np.full((rows, cols, 3), 128, dtype=np.uint8)
+    image[::16] = 0
+    image[:, ::16] = 255
+    pixel_size = 6.27 / cols / 1000  # m
+    eo = np.array([200000.0, 500000.0, 1033.5, 40 * np.pi / 180, 0, 30 * np.pi / 180])
+    _, orthophoto, geotransform = rectify_SIC(output_path='.', img_fname='test.JPG', restored_image=image,
+                                              focal_length=0.00432, pixel_size=pixel_size, eo=eo, R_GC=Rot3D(eo),
+                                              ground_height=33.5, epsg=3857, img_type=0, max_pixels=1000000)
+    z = 18
+    x0, y0, x1, y1 = tile_range(geotransform, orthophoto.shape[0], orthophoto.shape[1], z)
+    assert (x1 - x0) * (y1 - y0) > 100
+
+    canvases = []
+    warp_to_tiles = mosaic_module.warp_to_tiles
+
+    def recorded_warp_to_tiles(*args):
+        canvas, tiles = warp_to_tiles(*args)
+        canvases.append(canvas.shape[0] * canvas.shape[1])
+        return canvas, tiles
+
+    monkeypatch.setattr(mosaic_module, 'warp_to_tiles', recorded_warp_to_tiles)
+    for blending in ['last', 'nadir', 'feather']:
+        whole = Mosaic(str(tmp_path / blending / 'whole'), zoom=z, min_zoom=z, blending=blending, max_tiles=1000)
+        whole.add(orthophoto, geotransform, eo[0:2])
+        canvases.clear()
+
+        # Tiles are resampled in blocks of the budget, to the same mosaic
+        budgeted = Mosaic(str(tmp_path / blending / 'budgeted'), zoom=z, min_zoom=z, blending=blending,
+                          max_tiles=1000, max_pixels=5 * TILE_SIZE ** 2)
+        budgeted.add(orthophoto, geotransform, eo[0:2])
+        assert max(canvases) <= 5 * TILE_SIZE ** 2
+        assert sorted(budgeted.tiles) == sorted(whole.tiles)
+        for key in whole.tiles:
+            assert np.array_equal(budgeted.tiles[key][0], whole.tiles[key][0])
+            if blending == 'nadir':
+                # Distances are relative to the corner of each block, in float32
+                assert np.allclose(budgeted.tiles[key][1], whole.tiles[key][1], rtol=1e-5)
@@ -0,0 +1,59 @@
+import socket
+import threading
+
+import pytest
+
+from server.peer_connection import PeerConnection
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def echo_server(port, num_connections, max_messages):
+    """
+    Accept num_connections connections one by one, echo max_messages messages of each and close it
+    """
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', port))
+    server.listen(1)
+
+    def serve():
+        for _ in range(num_connections):
+            conn, _ = server.accept()
+            with conn:
+                for _ in range(max_messages):
+                    data = conn.recv(5)
+                    if not data:
+                        break
+                    conn.sendall(data)
+        server.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    return thread
+
+
+def receive(sock):
+    return sock.recv(5) or None
+
+
+def test_lazy_connect_and_reconnect():
+    port = free_port()
+    # The peer is not up yet
+    connection = PeerConnection('echo', '127.0.0.1', port, timeout=1, retries=3, backoff=0.01)
+
+    echo_server(port, num_connections=2, max_messages=1)
+    assert connection.request(b'hello', receive) == b'hello'
+    # The server closed the first connection
+    assert connection.request(b'world', receive) == b'world'
+    connection.close()
+
+
+def test_connect_fails_after_retries():
+    connection = PeerConnection('nobody', '127.0.0.1', free_port(), timeout=1, retries=2, backoff=0.01)
+    with pytest.raises(ConnectionError):
+        connection.send(b'hello')
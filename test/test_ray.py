@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+
+from server.image_processing.orthophoto_generation.EoData import Rot3D
+from server.image_processing.orthophoto_generation.Boundary import transform_bboxes
+from server.image_processing.orthophoto_generation.ray import Mesh
+
+
+def grid_mesh(size=40, cell=1.0, height=lambda x, y: 0.1 * x):
+    """
+    A terrain of 2 triangles per cell of a grid, centered at (0, 0)
+    """
+    x, y = np.meshgrid((np.arange(size + 1) - size / 2) * cell, (np.arange(size + 1) - size / 2) * cell)
+    vertices = np.stack([x.ravel(), y.ravel(), height(x, y).ravel()], axis=1)
+    index = np.arange((size + 1) ** 2).reshape(size + 1, size + 1)
+    a, b, c, d = index[:-1, :-1].ravel(), index[:-1, 1:].ravel(), index[1:, 1:].ravel(), index[1:, :-1].ravel()
+    faces = np.concatenate([np.stack([a, b, c], axis=1), np.stack([a, c, d], axis=1)])
+    return vertices, faces
+
+
+def brute_force(vertices, faces, origins, directions):
+    t_hit = np.full(len(directions), np.inf)
+    hit = np.full(len(directions), -1)
+    for tri, (v0, v1, v2) in enumerate(vertices[faces]):
+        e1, e2 = v1 - v0, v2 - v0
+        p = np.cross(directions, e2)
+        det = p @ e1
+        s = origins - v0
+        q = np.cross(s, e1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u = np.sum(s * p, axis=1) / det
+            v = np.sum(directions * q, axis=1) / det
+            t = q @ e2 / det
+        closer = (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 0) & (t < t_hit)
+        t_hit[closer] = t[closer]
+        hit[closer] = tri
+    return t_hit, hit
+
+
+def test_intersect():
+    rng = np.random.default_rng(0)
+    vertices = rng.uniform(0, 10, size=(300, 3))
+    faces = rng.integers(0, 300, size=(200, 3))
+    origins = rng.uniform(-5, 15, size=(1000, 3))
+    directions = rng.normal(size=(1000, 3))
+
+    mesh = Mesh(vertices, faces, leaf_size=3)
+    t_hit, hit = brute_force(vertices, faces, origins, directions)
+    for num_threads in [1, None]:
+        locations, index_tri = mesh.intersect(origins, directions, num_threads)
+        assert np.array_equal(index_tri, hit)
+        assert np.allclose(locations[hit >= 0], (origins + t_hit[:, np.newaxis] * directions)[hit >= 0])
+        assert np.isnan(locations[hit < 0]).all()
+
+
+def test_open(tmp_path):
+    vertices, faces = grid_mesh(size=4)
+    obj_path = str(tmp_path / 'terrain.obj')
+    with open(obj_path, 'w') as f:
+        f.writelines('v %r %r %r\n' % tuple(vertex) for vertex in vertices.tolist())
+        # Quads, which are split into the same triangles as grid_mesh
+        f.writelines('f %d/1 %d/1 %d/1 %d/1\n' % tuple(quad) for quad in
+                     (np.concatenate([faces[:16], faces[16:, 2:3]], axis=1) + 1).tolist())
+
+    mesh = Mesh.open(obj_path)
+    assert os.path.exists(str(tmp_path / 'terrain.bvh.npz'))
+    assert sorted(map(tuple, mesh.faces.tolist())) == sorted(map(tuple, faces.tolist()))
+
+    # From the saved BVH
+    cached = Mesh.open(obj_path)
+    for name in ['node_min', 'node_max', 'node_child', 'node_first', 'node_count', 'order']:
+        assert np.array_equal(getattr(cached, name), getattr(mesh, name))
+
+
+def test_transform_bboxes_on_mesh():
+    eo = np.array([0.5, -0.25, 50, 0.05, -0.03, 0.7])
+    R_CG = Rot3D(eo).T
+    bboxes = np.array([[100, 200, 400, 500], [1500, 800, 1900, 1000]])
+
+    # A flat mesh at ground_height is the flat ground
+    mesh = Mesh(*grid_mesh(size=200, height=lambda x, y: np.full_like(x, 3.5)))
+    flat = transform_bboxes(bboxes, 1080, 1920, 0.0014, 0.00432, eo, R_CG, 3.5)
+    assert np.allclose(transform_bboxes(bboxes, 1080, 1920, 0.0014, 0.00432, eo, R_CG, 3.5, mesh), flat)
+
+    # Over a slope rising to the east, corners in the east are pulled closer to the nadir
+    mesh = Mesh(*grid_mesh(size=200))
+    sloped = transform_bboxes(bboxes, 1080, 1920, 0.0014, 0.00432, eo, R_CG, 0, mesh)
+    flat = transform_bboxes(bboxes, 1080, 1920, 0.0014, 0.00432, eo, R_CG, 0)
+    east = flat[:, :, 0] > eo[0]
+    assert np.all(np.abs(sloped[:, :, 0] - eo[0])[east] < np.abs(flat[:, :, 0] - eo[0])[east])
+
+    # Rays which miss the mesh are projected to the flat ground
+    mesh = Mesh(*grid_mesh(size=2, cell=0.1))
+    assert np.allclose(transform_bboxes(bboxes, 1080, 1920, 0.0014, 0.00432, eo, R_CG, 0, mesh), flat)
@@ -0,0 +1,186 @@
+import numpy as np
+
+from server.image_processing.orthophoto_generation.EoData import Rot3D
+from server.image_processing.orthophoto_generation.Orthophoto import rectify_SIC, rectifyBytesPerPixel
+from server.image_processing.orthophoto_generation.Camera import Camera
+from server.image_processing.orthophoto_generation.ExifData import orientationHomography
+from server.image_processing.orthophoto_generation.BackprojectionResample import resample, sampleNearest, sampleBilinear
+
+focal_length = 0.00432  # m
+ground_height = 33.5    # m
+
+
+def synthetic_frame(rows=540, cols=960, altitude=100, omega=0, phi=0, kappa=30):
+    """
+    An image over a flat ground whose pixels encode their own row and column
+    """
+    row, col = np.mgrid[0:rows, 0:cols]
+    image = np.empty(shape=(rows, cols, 3), dtype=np.uint8)
+    image[:, :, 0] = col % 256
+    image[:, :, 1] = row % 256
+    image[:, :, 2] = col // 256 + row // 256 * 16
+
+    pixel_size = 6.27 / cols / 1000  # m
+    eo = np.array([200000.0, 500000.0, ground_height + altitude,
+                   omega * np.pi / 180, phi * np.pi / 180, kappa * np.pi / 180])
+
+    return image, pixel_size, eo
+
+
+def sampled_pixels(orthophoto):
+    """
+    Rows and columns of the image sampled to each pixel of an orthophoto of synthetic_frame
+    """
+    b, g, r = [orthophoto[:, :, i].astype(int) for i in range(3)]
+    return g + r // 16 * 256, b + r % 16 * 256
+
+
+def rectify(image, pixel_size, eo, method, img_type=0, resampling='nearest'):
+    _, orthophoto, _ = rectify_SIC(output_path='.', img_fname='test.JPG', restored_image=image,
+                                focal_length=focal_length, pixel_size=pixel_size, eo=eo, R_GC=Rot3D(eo),
+                                ground_height=ground_height, epsg=3857, img_type=img_type, method=method,
+                                resampling=resampling)
+    return orthophoto
+
+
+def test_fused_matches_three_stage():
+    image, pixel_size, eo = synthetic_frame(kappa=37)
+
+    for resampling in ['nearest', 'bilinear', 'bicubic']:
+        expected = rectify(image, pixel_size, eo, 'three_stage', resampling=resampling)
+        orthophoto = rectify(image, pixel_size, eo, 'fused', resampling=resampling)
+
+        assert np.array_equal(orthophoto, expected)
+
+
+def test_homography_matches_resample():
+    for omega, phi, kappa in [(0, 0, 0), (0, 0, 37), (5, -3, 120)]:
+        image, pixel_size, eo = synthetic_frame(omega=omega, phi=phi, kappa=kappa)
+
+        expected = rectify(image, pixel_size, eo, 'three_stage')
+        orthophoto = rectify(image, pixel_size, eo, 'homography')
+        assert orthophoto.shape == expected.shape
+
+        alpha_diff = orthophoto[:, :, 3] != expected[:, :, 3]
+        assert alpha_diff.mean() < 0.001
+
+        # Both sample the same pixel, except for ground points on the edge of two pixels
+        valid = (orthophoto[:, :, 3] == 255) & (expected[:, :, 3] == 255)
+        rows, cols = sampled_pixels(orthophoto)
+        expected_rows, expected_cols = sampled_pixels(expected)
+        assert np.abs(rows - expected_rows)[valid].max() <= 1
+        assert np.abs(cols - expected_cols)[valid].max() <= 1
+        if kappa != 0:
+            assert ((rows == expected_rows) & (cols == expected_cols))[valid].mean() > 0.99
+
+
+def test_homography_thermal():
+    image, pixel_size, eo = synthetic_frame(kappa=37)
+    gray = image[:, :, 0].copy()
+
+    expected = rectify(gray, pixel_size, eo, 'three_stage', img_type=1)
+    orthophoto = rectify(gray, pixel_size, eo, 'homography', img_type=1)
+
+    assert orthophoto.dtype == expected.dtype
+    assert (np.abs(orthophoto - expected) <= 1).mean() > 0.99
+
+
+def test_homography_bilinear_matches_kernel():
+    image, pixel_size, eo = synthetic_frame(kappa=37)
+    smooth = np.repeat(image[:, :, 0:1], 3, axis=2) // 2  # no wrap around of col % 256 in 2 px
+
+    for resampling in ['bilinear', 'bicubic']:
+        expected = rectify(smooth, pixel_size, eo, 'fused', resampling=resampling)
+        orthophoto = rectify(smooth, pixel_size, eo, 'homography', resampling=resampling)
+
+        valid = (orthophoto[:, :, 3] == 255) & (expected[:, :, 3] == 255)
+        diff = np.abs(orthophoto[:, :, 0:3].astype(int) - expected[:, :, 0:3].astype(int))[valid]
+        assert diff.max() <= 2
+
+
+def test_resample_wide_image():
+    # Columns over 32767 px overflowed int16
+    image = np.zeros(shape=(2, 40000, 3), dtype=np.uint8)
+    image[1, 35000] = [1, 2, 3]
+    image[1, 35001] = [3, 4, 5]
+    coord = np.array([[35000.5, 35001.0, -0.5],
+                      [1.5, 1.5, 1.5]])
+
+    b, g, r, a = resample(coord, 1, 3, image, sampleNearest)
+    assert list(b[0]) == [1, 3, 0] and list(g[0]) == [2, 4, 0] and list(r[0]) == [3, 5, 0]
+    assert list(a[0]) == [255, 255, 0]
+
+    b, g, r, a = resample(coord, 1, 3, image, sampleBilinear)
+    assert list(b[0]) == [1, 2, 0] and list(g[0]) == [2, 3, 0]
+
+
+def test_camera_geometry():
+    image, pixel_size, eo = synthetic_frame(omega=5, phi=-3, kappa=120)
+    camera = Camera(sensor_width=6.27, focal_length=focal_length)
+    geometry = camera.geometry(*image.shape[0:2])
+    assert camera.geometry(*image.shape[0:2]) is geometry
+    assert np.isclose(geometry.pixel_size / 1000, pixel_size)
+
+    expected = rectify_SIC(output_path='.', img_fname='test.JPG', restored_image=image, focal_length=focal_length,
+                           pixel_size=pixel_size, eo=eo, R_GC=Rot3D(eo), ground_height=ground_height, epsg=3857,
+                           img_type=0)
+    result = rectify_SIC(output_path='.', img_fname='test.JPG', restored_image=image, focal_length=focal_length,
+                         pixel_size=pixel_size, eo=eo, R_GC=Rot3D(eo), ground_height=ground_height, epsg=3857,
+                         img_type=0, camera=geometry)
+    assert result[0] == expected[0]
+    assert np.allclose(result[2], expected[2])
+    assert np.isclose(result[2][1], geometry.gsd(eo, ground_height))
+    assert np.array_equal(result[1], expected[1])
+
+
+def test_fold_orientation():
+    restored, pixel_size, eo = synthetic_frame(rows=270, cols=480)
+    expected = rectify(restored, pixel_size, eo, 'homography')
+    expected_fused = rectify(restored, pixel_size, eo, 'fused')
+    row, col = np.mgrid[0:restored.shape[0], 0:restored.shape[1]]
+
+    for orientation in range(2, 9):
+        # The image as it is decoded, which restoreOrientation restores to restored
+        O = orientationHomography(orientation, restored.shape if orientation < 5 else (480, 270))
+        image = np.empty((270, 480, 3) if orientation < 5 else (480, 270, 3), dtype=np.uint8)
+        image[(O[1, 0] * col + O[1, 1] * row + O[1, 2]).astype(int),
+              (O[0, 0] * col + O[0, 1] * row + O[0, 2]).astype(int)] = restored
+
+        for method, result in [('homography', expected), ('fused', expected_fused)]:
+            _, orthophoto, _ = rectify_SIC(output_path='.', img_fname='test.JPG', restored_image=image,
+                                           focal_length=focal_length, pixel_size=pixel_size, eo=eo, R_GC=Rot3D(eo),
+                                           ground_height=ground_height, epsg=3857, img_type=0, method=method,
+                                           orientation=orientation)
+            if method == 'fused':
+                assert np.array_equal(orthophoto, result)
+                continue
+            # Nearest of OpenCV rounds ties of mirrored coordinates the other way, to the next pixel
+            both = (orthophoto[:, :, 3] > 0) & (result[:, :, 3] > 0)
+            assert np.count_nonzero(orthophoto[:, :, 3] != result[:, :, 3]) < 0.002 * both.size
+            for index, expected_index in zip(sampled_pixels(orthophoto), sampled_pixels(result)):
+                assert np.abs(index - expected_index)[both].max() <= 1
+            assert np.mean(np.any(orthophoto != result, axis=2)) < 0.002
+
+
+def test_budget():
+    image, pixel_size, eo = synthetic_frame(kappa=45)
+    kwargs = dict(output_path='.', img_fname='test.JPG', restored_image=image, focal_length=focal_length,
+                  pixel_size=pixel_size, eo=eo, R_GC=Rot3D(eo), ground_height=ground_height, epsg=3857, img_type=0)
+    bbox_wkt, orthophoto, geotransform = rectify_SIC(**kwargs)
+    pixels = orthophoto.shape[0] * orthophoto.shape[1]
+
+    # A budget over the orthophoto keeps the GSD
+    result = rectify_SIC(max_pixels=pixels, **kwargs)
+    assert result[2] == geotransform and np.array_equal(result[1], orthophoto)
+
+    for method in ['homography', 'fused', 'three_stage']:
+        budgeted = rectify_SIC(method=method, max_pixels=pixels // 4, **kwargs)
+        assert budgeted[0] == bbox_wkt
+        assert budgeted[1].shape[0] * budgeted[1].shape[1] <= pixels // 4
+        assert budgeted[1].shape[0] * budgeted[1].shape[1] > pixels // 4 * 0.99
+        assert np.isclose(budgeted[2][1], geotransform[1] * 2, rtol=0.01)
+        assert budgeted[2][5] == -budgeted[2][1]
+
+        # Bytes of the intermediate arrays of the method are counted as well
+        max_bytes = pixels // 4 * rectifyBytesPerPixel(method, 0)
+        assert rectify_SIC(method=method, max_bytes=max_bytes, **kwargs)[2] == budgeted[2]
@@ -0,0 +1,132 @@
+import pytest
+
+from server.tile_store import TileStore, TileCache
+
+
+def test_put_and_get(tmp_path):
+    store = TileStore(str(tmp_path))
+    store.put([((20, 1, 2), b'first'), ((20, 1, 3), b'second')])
+    assert store.get(20, 1, 2) == b'first'
+    assert store.get(20, 1, 3) == b'second'
+    assert store.get(20, 1, 4) is None
+
+    # A replaced tile is appended, so the old offset keeps its bytes
+    old_location = store.locate(20, 1, 2)
+    store.put([((20, 1, 2), b'replaced')])
+    assert store.locate(20, 1, 2) != old_location
+    assert store.get(20, 1, 2) == b'replaced'
+    assert len(store) == 2
+    store.close()
+
+    # The store is reopened as it was
+    store = TileStore(str(tmp_path), tile_format='webp')
+    assert store.tile_format == 'png'
+    assert store.get(20, 1, 2) == b'replaced'
+    assert store.get(20, 1, 3) == b'second'
+    store.close()
+
+
+class FailingFile:
+    """
+    A data file whose write fails after writing a part of the bytes, as on a full disk
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def write(self, tile_bytes):
+        self.data.write(tile_bytes[:3])
+        self.data.flush()
+        raise OSError(28, 'No space left on device')
+
+    def __getattr__(self, name):
+        return getattr(self.data, name)
+
+
+def test_put_after_failed_write(tmp_path):
+    store = TileStore(str(tmp_path))
+    store.put([((20, 1, 2), b'first')])
+
+    data = store.data
+    store.data = FailingFile(data)
+    with pytest.raises(OSError):
+        store.put([((20, 1, 3), b'lost')])
+    assert store.get(20, 1, 3) is None
+    store.data = data
+
+    # Offsets of later tiles are at the end of the file, whatever the failed batch left
+    data.write(b'partial')
+    store.put([((20, 1, 3), b'second')])
+    assert store.get(20, 1, 2) == b'first'
+    assert store.get(20, 1, 3) == b'second'
+    store.close()
+
+
+def test_compact(tmp_path):
+    store = TileStore(str(tmp_path), compact_ratio=None)
+    for i in range(10):
+        store.put([((20, x, 0), b'%d-%d' % (x, i)) for x in range(5)])
+    store.compact()
+    assert store.generation == 1
+    assert sorted(f.name for f in tmp_path.iterdir() if f.suffix == '.dat') == ['tiles.1.dat']
+    assert (tmp_path / 'tiles.1.dat').stat().st_size == 5 * len(b'0-9')
+    assert [store.get(20, x, 0) for x in range(5)] == [b'%d-9' % x for x in range(5)]
+
+    store.put([((20, 0, 0), b'new')])
+    store.close()
+    # A data file which an interrupted compaction left is removed
+    (tmp_path / 'tiles.2.dat').write_bytes(b'partial')
+    store = TileStore(str(tmp_path))
+    assert not (tmp_path / 'tiles.2.dat').exists()
+    assert store.get(20, 0, 0) == b'new'
+    assert store.get(20, 4, 0) == b'4-9'
+
+    # A location before compaction does not read bytes of the next generation
+    location = store.locate(20, 4, 0)
+    assert location[0] == 1 and store.read(*location) == b'4-9'
+    store.compact()
+    assert store.read(*location) is None
+    assert store.locate(20, 4, 0)[0] == 2 and store.get(20, 4, 0) == b'4-9'
+    store.close()
+
+
+def test_compact_on_put(tmp_path):
+    store = TileStore(str(tmp_path), compact_ratio=2)
+    store.put([((20, x, 0), b'%d-0' % x) for x in range(5)])
+    store.put([((20, x, 0), b'%d-1' % x) for x in range(4)])
+    assert store.generation == 0
+    # Replaced bytes reach the ratio
+    store.put([((20, 4, 0), b'4-1'), ((20, 0, 0), b'0-2')])
+    assert store.generation == 1
+    assert (tmp_path / 'tiles.1.dat').stat().st_size == store.live_length == 5 * len(b'0-0')
+    assert [store.get(20, x, 0) for x in range(5)] == [b'0-2'] + [b'%d-1' % x for x in range(1, 5)]
+    store.close()
+
+    # The bytes of the current tiles are counted at start
+    store = TileStore(str(tmp_path), compact_ratio=2)
+    assert store.live_length == 5 * len(b'0-0')
+    store.close()
+
+
+def test_tile_cache():
+    cache = TileCache(max_bytes=10)
+    loads = []
+
+    def load(tile_bytes):
+        loads.append(tile_bytes)
+        return tile_bytes
+
+    assert cache.get(('a', 0, 0), lambda: load(b'1234')) == b'1234'
+    assert cache.get(('a', 0, 0), lambda: load(b'1234')) == b'1234'
+    assert loads == [b'1234'] and cache.hits == 1 and cache.misses == 1
+
+    # The least recently used tile is evicted over max_bytes
+    cache.get(('a', 0, 4), lambda: load(b'5678'))
+    cache.get(('a', 0, 0), lambda: load(b'1234'))
+    cache.get(('a', 0, 8), lambda: load(b'90ab'))
+    assert list(cache.tiles) == [('a', 0, 0), ('a', 0, 8)] and cache.num_bytes == 8
+    # A tile over max_bytes is not cached
+    cache.get(('a', 0, 12), lambda: load(b'x' * 11))
+    assert ('a', 0, 12) not in cache.tiles
+    # Nor is a tile which load does not find
+    assert cache.get(('a', 0, 16), lambda: None) is None
+    assert ('a', 0, 16) not in cache.tiles
@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+
+from server.image_processing.orthophoto_generation.Tiles import TILE_SIZE, ORIGIN_SHIFT, resolution, native_zoom, \
+    tile_bounds, tile_range, cut_tiles, encode_tile, save_tiles
+
+
+def aligned_orthophoto(z, x, y, rows, cols):
+    """
+    An orthophoto whose north-west corner is the one of tile (z, x, y), with gsd of zoom level z
+    """
+    rng = np.random.default_rng(0)
+    orthophoto = rng.integers(0, 256, size=(rows, cols, 4), dtype=np.uint8)
+    orthophoto[:, :, 3] = 255
+    xmin, _, _, ymax = tile_bounds(z, x, y)
+    return orthophoto, (xmin, resolution(z), 0, ymax, 0, -resolution(z))
+
+
+def test_tile_grid():
+    assert tile_bounds(0, 0, 0) == (-ORIGIN_SHIFT, -ORIGIN_SHIFT, ORIGIN_SHIFT, ORIGIN_SHIFT)
+    assert native_zoom(resolution(20)) == 20
+    assert native_zoom(resolution(20) * (1 + 1e-12)) == 20
+    # Between two zoom levels, the coarser one
+    assert native_zoom(resolution(20) * 0.9) == 20
+    assert native_zoom(resolution(20) * 1.5) == 19
+    assert native_zoom(resolution(21) * 1.01) == 20
+
+    orthophoto, geotransform = aligned_orthophoto(20, 1000, 2000, rows=300, cols=600)
+    assert tile_range(geotransform, 300, 600, 20) == (1000, 2000, 1003, 2002)
+    assert tile_range(geotransform, 300, 600, 19) == (500, 1000, 502, 1001)
+
+
+def test_cut_tiles():
+    z, x, y = 20, 1001, 2001
+    orthophoto, geotransform = aligned_orthophoto(z, x, y, rows=2 * TILE_SIZE, cols=TILE_SIZE + 101)
+    tiles = dict(cut_tiles(orthophoto, geotransform, min_zoom=18, max_zoom=25))
+
+    # max_zoom is clamped to the native zoom level
+    assert max(key[0] for key in tiles) == z
+    assert sorted(key for key in tiles if key[0] == z) == [(z, x, y), (z, x, y + 1), (z, x + 1, y), (z, x + 1, y + 1)]
+    assert np.array_equal(tiles[(z, x, y + 1)], orthophoto[TILE_SIZE:, :TILE_SIZE])
+    assert not tiles[(z, x + 1, y)][:, 101:, 3].any()
+
+    # Tile (z - 1, 500, 1000) covers (z, 1000 - 1001, 2000 - 2001), so the orthophoto is at its south-east quarter
+    overview = tiles[(z - 1, 500, 1000)]
+    assert not overview[:TILE_SIZE // 2, :, 3].any() and not overview[:, :TILE_SIZE // 2, 3].any()
+    expected = orthophoto[0:2, 0:2, 0:3].reshape(4, 3).mean(axis=0)
+    assert np.abs(overview[TILE_SIZE // 2, TILE_SIZE // 2, 0:3] - expected).max() <= 1
+    # Colors along the boundary are not darkened by transparent pixels
+    # The last column of the orthophoto(356) goes to column 128 + 178 = 306 of the overview, i.e. 50 of the next tile
+    boundary = tiles[(z - 1, 501, 1000)][TILE_SIZE // 2, 50]
+    assert np.abs(boundary[0:3] - orthophoto[0:2, 356, 0:3].mean(axis=0)).max() <= 1
+    assert boundary[3] == 128
+    assert (z - 2, 250, 500) in tiles and min(key[0] for key in tiles) == 18
+
+    # At a GSD between zoom levels z - 1 and z, tiles of z - 1 are the finest ones, which are not upsampled
+    coarser = geotransform[0:1] + (geotransform[1] * 1.4,) + geotransform[2:5] + (-geotransform[1] * 1.4,)
+    assert max(key[0] for key, _ in cut_tiles(orthophoto, coarser, min_zoom=18, max_zoom=25)) == z - 1
+
+
+def test_save_tiles(tmp_path):
+    orthophoto, geotransform = aligned_orthophoto(20, 1000, 2000, rows=TILE_SIZE, cols=TILE_SIZE)
+    tiles = [(key, encode_tile(tile)) for key, tile in cut_tiles(orthophoto, geotransform, 20, 20)]
+    save_tiles(tiles, str(tmp_path))
+    assert os.listdir(os.path.join(str(tmp_path), '20', '1000')) == ['2000.png']
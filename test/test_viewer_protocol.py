@@ -0,0 +1,98 @@
+import socket
+import threading
+
+import cv2
+import numpy as np
+
+from server.peer_connection import sendall_buffers
+from server.viewer_protocol import encode_orthophoto, decode_orthophoto, write_ipod_frame, IPOD_HEADER
+
+
+def synthetic_orthophoto(rows=200, cols=300):
+    row, col = np.mgrid[0:rows, 0:cols]
+    orthophoto = np.zeros(shape=(rows, cols, 4), dtype=np.uint8)
+    inside = (row > 20) & (row < 180) & (col > row / 2) & (col < 250)
+    orthophoto[:, :, 0] = row
+    orthophoto[:, :, 1] = col % 256
+    orthophoto[:, :, 2] = (row + col) // 2
+    orthophoto[:, :, 3] = inside * 255
+    orthophoto[~inside, 0:3] = 0
+    return orthophoto
+
+
+def test_encode_decode():
+    orthophoto = synthetic_orthophoto()
+    # JPEG rings along the boundary of alpha
+    inside = cv2.erode(orthophoto[:, :, 3], np.ones((17, 17), dtype=np.uint8)) == 255
+
+    for image_format, max_diff in [('png', 0), ('webp', 0), ('jpeg+mask', 16), ('raw', 0)]:
+        buffers, img_encoding = encode_orthophoto(orthophoto, image_format, jpeg_quality=95)
+        decoded = decode_orthophoto(b''.join(bytes(buffer) for buffer in buffers), img_encoding)
+
+        assert decoded.shape == orthophoto.shape
+        assert np.array_equal(decoded[:, :, 3], orthophoto[:, :, 3])
+        assert np.abs(decoded.astype(int) - orthophoto)[inside].max() <= max_diff
+
+    # The pixels of raw are not copied
+    buffers, _ = encode_orthophoto(orthophoto, 'raw')
+    assert np.shares_memory(np.frombuffer(buffers[0], dtype=np.uint8), orthophoto)
+
+
+def test_sendall_buffers():
+    sender, receiver = socket.socketpair()
+    sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    orthophoto = synthetic_orthophoto(1000, 1000)
+    buffers = [b'IPOD', b'', b'{"metadata": 1}', memoryview(orthophoto).cast('B')]
+    expected = b''.join(bytes(buffer) for buffer in buffers)
+
+    received = bytearray()
+
+    def receive():
+        while len(received) < len(expected):
+            received.extend(receiver.recv(65536))
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    sendall_buffers(sender, buffers)
+    thread.join()
+
+    assert bytes(received) == expected
+    sender.close()
+    receiver.close()
+
+
+def receive_ipod_frame(sock):
+    def recv_exactly(size):
+        buf = b''
+        while len(buf) < size:
+            buf += sock.recv(size - len(buf))
+        return buf
+
+    magic, full_length, metadata_length, image_length = IPOD_HEADER.unpack(recv_exactly(IPOD_HEADER.size))
+    assert magic == b'IPOD' and full_length == metadata_length + image_length
+    return recv_exactly(metadata_length), recv_exactly(image_length)
+
+
+def test_write_ipod_frame():
+    sender, receiver = socket.socketpair()
+    orthophoto = synthetic_orthophoto()
+    metadata_bytes = b'{"img_name": "test.JPG"}'
+    received = []
+
+    def receive(count):
+        for _ in range(count):
+            received.append(receive_ipod_frame(receiver))
+
+    thread = threading.Thread(target=receive, args=(2,))
+    thread.start()
+    buffers, img_encoding = encode_orthophoto(orthophoto, 'jpeg+mask')
+    write_ipod_frame(sender, metadata_bytes, buffers)
+    raw_buffers, raw_encoding = encode_orthophoto(orthophoto, 'raw')
+    write_ipod_frame(sender, metadata_bytes, raw_buffers)
+    thread.join()
+
+    assert received[0][0] == metadata_bytes and received[1][0] == metadata_bytes
+    assert np.array_equal(decode_orthophoto(received[0][1], img_encoding)[:, :, 3], orthophoto[:, :, 3])
+    assert np.array_equal(decode_orthophoto(received[1][1], raw_encoding), orthophoto)
+    sender.close()
+    receiver.close()